@@ -3,25 +3,374 @@
 # Licence: BSD 3-clause
 
 import numpy as np
-from jr.utils import tile_memory_free, pairwise
+from jr.utils import tile_memory_free
 from jr.stats import repeated_spearman, fast_mannwhitneyu
-from mne.stats import ttest_1samp_no_p
-from mne.stats import spatio_temporal_cluster_1samp_test
 
 
 # STATISTICS ##################################################################
 
 
-def _stat_fun(x, sigma=0, method='relative'):
-    """Aux. function of stats"""
-    t_values = ttest_1samp_no_p(x, sigma=sigma, method=method)
-    t_values[np.isnan(t_values)] = 0
-    return t_values
+def _sign_flips(n_samples, n_permutations, seed=None):
+    """Sign-flip matrix, shape (n_samples, n_permutations), whose first column
+    is the identity. If there are fewer distinct permutations than
+    n_permutations, all of them are enumerated: the first sample is never
+    flipped, as opposite flips give opposite t-values. They are shuffled, so
+    that the first columns are a random subset, e.g. to stop early."""
+    rng = np.random.RandomState(seed)
+    if 2 ** (n_samples - 1) <= n_permutations:
+        codes = np.arange(2 ** (n_samples - 1))
+        codes[1:] = codes[1 + rng.permutation(len(codes) - 1)]
+        bits = (codes[np.newaxis, :] >> np.arange(n_samples - 1)[:, None]) & 1
+        return np.vstack((np.ones((1, len(codes))), 1. - 2. * bits))
+    flips = np.sign(.5 - rng.rand(n_samples, n_permutations))
+    flips[:, 0] = 1.
+    return flips
 
 
-def stats(X, connectivity=None, n_jobs=-1):
+def _t_stats(X, flips, sum_sq, sigma=0., method='relative'):
+    """One-sample t-values of the sign-flipped data, shape (n_flips, n_tests),
+    computed with a single matrix product: the sums of squares do not depend
+    on the signs."""
+    return _t_from_sums(np.dot(flips.T, X), sum_sq, len(X), sigma, method)
+
+
+def _t_from_sums(sums, sum_sq, n_samples, sigma=0., method='relative'):
+    """One-sample t-values from the sums and sums of squares, in place"""
+    mean = sums
+    mean /= n_samples
+    var = sum_sq - n_samples * mean ** 2
+    var /= n_samples - 1
+    np.maximum(var, 0., out=var)  # rounding errors
+    if sigma > 0:
+        # "hat" variance adjustment (see mne.stats.ttest_1samp_no_p)
+        var += (sigma * np.max(var, axis=1, keepdims=True)
+                if method == 'relative' else sigma)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean /= np.sqrt(var / n_samples)
+    mean[np.isnan(mean)] = 0
+    return mean
+
+
+def _gray_sums(X, start, stop):
+    """Sums of the sign-flipped data for the permutations start to stop of
+    the Gray code, shape (stop - start, n_tests). Consecutive permutations
+    only differ by the sign of one sample, so that each sum is obtained from
+    the previous one by a single update. The first sample is never flipped.
+    """
+    n_samples = len(X)
+    codes = np.arange(start, stop)
+    gray = codes ^ (codes >> 1)
+    # signs of the first permutation
+    bits = (gray[0] >> np.arange(n_samples - 1)) & 1
+    signs = np.r_[1., 1. - 2. * bits]
+    # the sample flipped at each step is the lowest set bit of the step
+    steps = codes[1:]
+    flipped = np.log2(steps & -steps).astype(int)
+    previous = 1. - 2. * ((gray[:-1] >> flipped) & 1)
+    sums = np.empty((len(codes), X.shape[1]))
+    sums[0] = np.dot(signs, X)
+    sums[1:] = X[flipped + 1] * (-2. * previous[:, np.newaxis])
+    return np.cumsum(sums, axis=0, out=sums)
+
+
+def _setup_connectivity(connectivity, sample_shape):
+    """Edges of the spatio-temporal graph, computed once for all the
+    permutations.
+
+    Parameters
+    ----------
+    connectivity : sparse matrix, shape (n_space, n_space)
+        The spatial connectivity. Each sample is also connected to the same
+        sample at the neighboring time points. If its size matches the number
+        of tests, it is used as the full connectivity.
+    sample_shape : tuple
+        The shape (n_times, n_space) of the maps.
+
+    Returns
+    -------
+    edges : array, shape (2, n_edges)
+        The pairs of connected flat indices.
+    """
+    from scipy import sparse
+    n_tests = int(np.prod(sample_shape))
+    connectivity = sparse.coo_matrix(connectivity)
+    connectivity = sparse.triu(connectivity + connectivity.T, 1).tocoo()
+    edges = np.vstack((connectivity.row, connectivity.col))
+    if connectivity.shape[0] == n_tests:
+        return edges
+    n_times, n_space = sample_shape
+    if connectivity.shape[0] != n_space:
+        raise ValueError('connectivity must be of shape (%i, %i), got %s'
+                         % (n_space, n_space, connectivity.shape))
+    offsets = n_space * np.arange(n_times)
+    spatial = (edges[:, :, np.newaxis] + offsets).reshape(2, -1)
+    temporal = np.arange(n_space * (n_times - 1))
+    temporal = np.vstack((temporal, temporal + n_space))
+    return np.hstack((spatial, temporal))
+
+
+def _lattice_edges(sample_shape):
+    """Edges between the neighboring cells of a grid, shape (2, n_edges)"""
+    index = np.arange(int(np.prod(sample_shape))).reshape(sample_shape)
+    edges = list()
+    for axis in range(len(sample_shape)):
+        lo = [slice(None)] * len(sample_shape)
+        hi = [slice(None)] * len(sample_shape)
+        lo[axis], hi[axis] = slice(None, -1), slice(1, None)
+        edges.append(np.vstack((index[tuple(lo)].ravel(),
+                                index[tuple(hi)].ravel())))
+    return np.hstack(edges)
+
+
+def _label(t_values, threshold, edges=None):
+    """Label the clusters of t-values above threshold or below -threshold.
+
+    Parameters
+    ----------
+    t_values : array, shape (n_times, n_space)
+        The statistical map.
+    threshold : float
+        The cluster forming threshold.
+    edges : None | array, shape (2, n_edges)
+        The connectivity graph (see _setup_connectivity). If None,
+        neighboring cells are connected.
+
+    Returns
+    -------
+    labels : array of int32, shape (n_times, n_space)
+        The cluster of each sample, from 1 to n_clusters, 0 outside
+        clusters. Positive and negative samples are never in the same
+        cluster.
+    n_clusters : int
+        The number of clusters.
+    """
+    if edges is None:
+        from scipy import ndimage
+        labels, n_pos = ndimage.label(t_values > threshold)
+        negative, n_neg = ndimage.label(t_values < -threshold)
+        labels[negative > 0] = negative[negative > 0] + n_pos
+        return labels, n_pos + n_neg
+    # Connected components of the subgraph of the supra-threshold samples
+    # whose edges link samples of the same sign.
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    sign = ((t_values > threshold).astype(np.int8) -
+            (t_values < -threshold)).ravel()
+    nodes = np.flatnonzero(sign)
+    labels = np.zeros(t_values.shape, np.int32)
+    if not len(nodes):
+        return labels, 0
+    keep = sign[edges[0]] != 0
+    keep &= sign[edges[0]] == sign[edges[1]]
+    index = np.cumsum(sign != 0) - 1
+    graph = coo_matrix((np.ones(keep.sum(), bool),
+                        (index[edges[0, keep]], index[edges[1, keep]])),
+                       shape=(len(nodes), len(nodes)))
+    n_clusters, components = connected_components(graph, directed=False)
+    labels.ravel()[nodes] = components + 1
+    return labels, n_clusters
+
+
+def _find_clusters(t_values, threshold, edges=None):
+    """Clusters of t-values above threshold or below -threshold.
+
+    Returns
+    -------
+    labels : array of int32, shape (n_times, n_space)
+        The cluster of each sample, from 1 to n_clusters, 0 outside clusters
+        (see _label).
+    sums : array, shape (n_clusters,)
+        The sum of the t-values in each cluster.
+    """
+    labels, n_clusters = _label(t_values, threshold, edges)
+    sums = np.bincount(labels.ravel(), t_values.ravel(), n_clusters + 1)[1:]
+    return labels, sums
+
+
+def _tfce(t_values, dh=.2, edges=None, E=.5, H=2.):
+    """Threshold-free cluster enhancement (Smith & Nichols, 2009) of
+    t-values, two-tailed.
+
+    The t-values are quantized once into the number of thresholds (dh, 2 dh,
+    ...) that each sample exceeds. The subgraphs of the supra-threshold
+    samples of all thresholds are then stacked and labeled at once, without
+    connectivity across thresholds.
+
+    Parameters
+    ----------
+    t_values : array, shape (n_times, n_space)
+        The statistical map.
+    dh : float
+        The step between thresholds.
+    edges : None | array, shape (2, n_edges)
+        The connectivity graph (see _setup_connectivity). If None,
+        neighboring cells are connected.
+    E, H : float
+        The extent and height exponents.
+
+    Returns
+    -------
+    tfce : array, shape (n_times, n_space)
+        The signed enhanced map: the sum over the thresholds h exceeded by
+        each sample of extent ** E * h ** H * dh, where extent is the size of
+        its cluster at threshold h.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    t_flat = t_values.ravel()
+    abs_t = np.abs(t_flat)
+    # infinite t-values (e.g. null variance without sigma) are clipped to the
+    # largest finite one, NaNs are ignored
+    finite = np.isfinite(abs_t)
+    if not finite.all():
+        abs_t = np.where(np.isnan(abs_t), 0., abs_t)
+        abs_t = np.minimum(abs_t, abs_t[finite].max() if finite.any() else 0.)
+    sign = np.where(abs_t > 0, np.sign(t_flat), 0).astype(np.int8)
+    heights = np.arange(0., abs_t.max() if len(t_flat) else 0., dh)[1:]
+    if not len(heights):
+        return np.zeros(t_values.shape)
+    # number of heights < |t|, as the smallest signed ints holding them, to
+    # be sorted with a radix sort
+    levels = np.searchsorted(heights, abs_t).astype(
+        np.min_scalar_type(-len(heights)))
+    if edges is None:
+        edges = _lattice_edges(t_values.shape)
+    # Sort the samples and the same-sign edges by level, such that the
+    # samples and the edges above each threshold are the first ones.
+    order = np.argsort(-levels, kind='mergesort')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    edge_levels = np.minimum(levels[edges[0]], levels[edges[1]])
+    edge_levels[sign[edges[0]] != sign[edges[1]]] = 0
+    edge_order = np.argsort(-edge_levels, kind='mergesort')
+    edges = rank[edges[:, edge_order]]
+    n_nodes = np.searchsorted(-levels[order],
+                              -np.arange(1, len(heights) + 1), 'right')
+    n_edges = np.searchsorted(-edge_levels[edge_order],
+                              -np.arange(1, len(heights) + 1), 'right')
+    # Stack the subgraphs of the thresholds, and label them at once. Their
+    # total size is the sum of the levels, instead of the number of
+    # thresholds times the number of samples.
+    offsets = np.r_[0, np.cumsum(n_nodes)]
+    nodes = np.concatenate([order[:n_node] for n_node in n_nodes])
+    graph = np.hstack([offset + edges[:, :n_edge]
+                       for offset, n_edge in zip(offsets, n_edges)])
+    graph = coo_matrix((np.ones(graph.shape[1], bool), graph),
+                       shape=(len(nodes), len(nodes)))
+    _, components = connected_components(graph, directed=False)
+    extent = np.bincount(components) ** E
+    weights = heights ** H * dh
+    tfce = np.bincount(nodes, extent[components] * np.repeat(weights, n_nodes),
+                       len(t_flat))
+    return (tfce * sign).reshape(t_values.shape)
+
+
+def _max_stat(t_values, threshold, edges, method):
+    """Maximum absolute cluster sum or TFCE of a map"""
+    if method == 'tfce':
+        return np.max(np.abs(_tfce(t_values, threshold, edges)))
+    _, sums = _find_clusters(t_values, threshold, edges)
+    return np.max(np.abs(sums)) if len(sums) else 0.
+
+
+def _observed_clusters(t_values, threshold, edges, method):
+    """Label map and statistic of the observed clusters. With TFCE, each
+    enhanced sample is its own cluster."""
+    if method != 'tfce':
+        return _find_clusters(t_values, threshold, edges)
+    tfce = _tfce(t_values, threshold, edges)
+    labels = np.zeros(t_values.shape, np.int32)
+    inside = np.flatnonzero(tfce)
+    labels.ravel()[inside] = np.arange(1, len(inside) + 1)
+    return labels, tfce.ravel()[inside]
+
+
+def _default_threshold(n_samples, method):
+    """p < .05 two-tailed for clusters, a step of .2 for TFCE"""
+    if method == 'tfce':
+        return .2
+    from scipy.stats import t as t_dist
+    return -t_dist.ppf(.05 / 2., n_samples - 1)
+
+
+def _max_cluster_sums(Xs, sum_sqs, flips, threshold, connectivities,
+                      sample_shapes, sigma, method='cluster'):
+    """Maximum absolute cluster sum (or TFCE) of each map and permutation"""
+    max_sums = np.zeros((len(Xs), flips.shape[1]))
+    for jj, (X, sum_sq, connectivity, sample_shape) in enumerate(zip(
+            Xs, sum_sqs, connectivities, sample_shapes)):
+        # the t-values are computed in batches of permutations to bound
+        # memory
+        batch = max(1, 2 ** 22 // X.shape[1])
+        for start in range(0, flips.shape[1], batch):
+            t_perms = _t_stats(X, flips[:, start:start + batch], sum_sq,
+                               sigma)
+            for ii, t_values in enumerate(t_perms):
+                max_sums[jj, start + ii] = _max_stat(
+                    t_values.reshape(sample_shape), threshold, connectivity,
+                    method)
+    return max_sums
+
+
+def _max_cluster_sums_gray(Xs, sum_sqs, start, stop, threshold,
+                           connectivities, sample_shapes, sigma,
+                           method='cluster'):
+    """Maximum absolute cluster sum (or TFCE) of each map for the
+    permutations start to stop of the Gray code"""
+    max_sums = np.zeros((len(Xs), stop - start))
+    for jj, (X, sum_sq, connectivity, sample_shape) in enumerate(zip(
+            Xs, sum_sqs, connectivities, sample_shapes)):
+        batch = max(1, 2 ** 22 // X.shape[1])
+        for this_start in range(start, stop, batch):
+            this_stop = min(this_start + batch, stop)
+            # the sums are recomputed at each batch to avoid the accumulation
+            # of rounding errors
+            t_perms = _t_from_sums(_gray_sums(X, this_start, this_stop),
+                                   sum_sq, len(X), sigma)
+            for ii, t_values in enumerate(t_perms):
+                max_sums[jj, this_start - start + ii] = _max_stat(
+                    t_values.reshape(sample_shape), threshold, connectivity,
+                    method)
+    return max_sums
+
+
+def _max_cluster_sums_from_sums(sums, sum_sq, n_samples, threshold,
+                                connectivity, sample_shape, sigma,
+                                method='cluster'):
+    """Maximum absolute cluster sum (or TFCE) of each row of sign-flipped
+    sums (see GroupStats)"""
+    max_sums = np.zeros(len(sums))
+    batch = max(1, 2 ** 22 // sums.shape[1])
+    for start in range(0, len(sums), batch):
+        t_perms = _t_from_sums(np.array(sums[start:start + batch]), sum_sq,
+                               n_samples, sigma)
+        for ii, t_values in enumerate(t_perms):
+            max_sums[start + ii] = _max_stat(t_values.reshape(sample_shape),
+                                             threshold, connectivity, method)
+    return max_sums
+
+
+def _resolved(counts, n_perms, alpha, precision, confidence=.999):
+    """Whether the p-value of each cluster is known precisely enough: its
+    Clopper-Pearson interval excludes alpha or is narrower than precision"""
+    from scipy.stats import beta
+    tail = (1. - confidence) / 2.
+    lower = beta.ppf(tail, counts, n_perms - counts + 1)
+    upper = np.ones_like(lower)
+    below = counts < n_perms
+    upper[below] = beta.ppf(1. - tail, counts[below] + 1,
+                            n_perms[below] - counts[below])
+    return (upper < alpha) | (lower > alpha) | (upper - lower < precision)
+
+
+def stats(X, connectivity=None, n_jobs=-1, n_permutations=2 ** 12,
+          threshold=None, sigma=0., seed=None, max_permutations=2 ** 12,
+          alpha=.05, precision=.005, method='cluster', full_output=False):
     """Cluster statistics to control for multiple comparisons.
 
+    The sign-flip permutations are drawn at once, and the t-values of all
+    permutations are computed with matrix products.
+
     Parameters
     ----------
     X : array, shape (n_samples, n_space, n_times)
@@ -31,22 +380,382 @@ def stats(X, connectivity=None, n_jobs=-1):
         neighboring cells of X.
     n_jobs : int
         The number of parallel processors.
+    n_permutations : int | 'auto' | 'exact'
+        The number of sign-flip permutations, including the identity. If
+        larger than the number of distinct permutations, all of them are
+        used, in random order. If 'auto', the permutations are drawn by
+        increasing blocks until the p-value of each cluster is resolved (see
+        alpha and precision), or max_permutations is reached. If 'exact', all
+        the 2 ** (n_samples - 1) distinct permutations are enumerated in Gray
+        code order, which gives exact and reproducible p-values. Each
+        permutation still requires labeling its clusters: with 20 subjects,
+        this is 2 ** 19, i.e. 128 times the cost of 4096 permutations, and a
+        warning is emitted when the enumeration exceeds 16 times
+        max_permutations.
+    threshold : None | float
+        The cluster forming t-value. If None, corresponds to p < .05
+        two-tailed. If method is 'tfce', the step between the thresholds,
+        defaults to .2.
+    sigma : float
+        The "hat" variance adjustment of the t-test (see
+        mne.stats.ttest_1samp_no_p). Defaults to 0 (no adjustment).
+    seed : None | int
+        The seed of the random sign flips.
+    max_permutations : int
+        The maximum number of permutations if n_permutations is 'auto'.
+    alpha : float
+        If n_permutations is 'auto', a cluster stops being permuted once the
+        confidence interval of its p-value excludes alpha...
+    precision : float
+        ... or is narrower than precision.
+    method : 'cluster' | 'tfce'
+        If 'cluster', the cluster sums above threshold are compared to the
+        maximum cluster sum of each permutation. If 'tfce', the threshold
+        free cluster enhancement (E=.5, H=2) of each sample is compared to
+        the maximum enhancement of each permutation, and each sample is
+        treated as a cluster in the details.
+    full_output : bool
+        If True, also return the details of each cluster.
+
+    Returns
+    -------
+    p_values : array, shape (n_space, n_times)
+        The p-value of the cluster of each sample, 1 outside clusters.
+    clusters : dict
+        Only returned if full_output. 'labels': the int32 map of the cluster
+        of each sample, from 1 to n_clusters, 0 outside clusters,
+        'cluster_p_values', 'n_permutations': the number of permutations
+        used for each cluster, 'mc_errors': the Monte Carlo standard error of
+        each cluster p-value.
+    """
+    out = stats_many([X], connectivity=connectivity, n_jobs=n_jobs,
+                     n_permutations=n_permutations, threshold=threshold,
+                     sigma=sigma, seed=seed,
+                     max_permutations=max_permutations, alpha=alpha,
+                     precision=precision, method=method,
+                     full_output=full_output)
+    return (out[0][0], out[1][0]) if full_output else out[0]
+
+
+def stats_many(Xs, connectivity=None, n_jobs=-1, n_permutations=2 ** 12,
+               threshold=None, sigma=0., seed=None, max_permutations=2 ** 12,
+               alpha=.05, precision=.005, method='cluster',
+               full_output=False):
+    """Cluster statistics of several maps with the same samples (e.g.
+    subjects), sharing the sign-flip permutations and the parallel workers.
+
+    Parameters
+    ----------
+    Xs : list of array, shape (n_samples, n_space, n_times)
+        The data of each map, chance is assumed to be 0. The maps can have
+        different shapes but must have the same number of samples.
+
+    See stats for the other parameters.
+
+    Returns
+    -------
+    p_values : list of array, shape (n_space, n_times)
+        The p-values of each map.
+    clusters : list of dict
+        Only returned if full_output. The details of the clusters of each
+        map (see stats).
+    """
+    from mne.parallel import parallel_func
+    Xs = [np.array(X) for X in Xs]
+    Xs = [X[:, :, None] if X.ndim == 2 else X for X in Xs]
+    n_samples = len(Xs[0])
+    if any(len(X) != n_samples for X in Xs):
+        raise ValueError('All maps must have the same number of samples: '
+                         '%s' % [len(X) for X in Xs])
+    auto = isinstance(n_permutations, str) and n_permutations == 'auto'
+    exact = isinstance(n_permutations, str) and n_permutations == 'exact'
+    if isinstance(n_permutations, str) and not (auto or exact):
+        raise ValueError("n_permutations must be an int, 'auto' or 'exact', "
+                         "got %s" % n_permutations)
+    sample_shapes = [X.shape[1:] for X in Xs]
+    Xs = [X.reshape(n_samples, -1) for X in Xs]
+    if method not in ('cluster', 'tfce'):
+        raise ValueError("method must be 'cluster' or 'tfce', got %s"
+                         % method)
+    if threshold is None:
+        threshold = _default_threshold(n_samples, method)
+    connectivities = [None] * len(Xs)
+    if connectivity is not None:
+        connectivities = [_setup_connectivity(connectivity, shape)
+                          for shape in sample_shapes]
+    elif method == 'tfce':
+        connectivities = [_lattice_edges(shape) for shape in sample_shapes]
+    if exact:
+        flips = np.ones((n_samples, 1))
+        if 2 ** (n_samples - 1) > 16 * max_permutations:
+            import warnings
+            warnings.warn('Enumerating the %i sign flips of %i samples costs '
+                          '%i times max_permutations (%i)' % (
+                              2 ** (n_samples - 1), n_samples,
+                              2 ** (n_samples - 1) // max_permutations,
+                              max_permutations), RuntimeWarning)
+    else:
+        flips = _sign_flips(n_samples, max_permutations if auto else
+                            int(n_permutations), seed=seed)
+    sum_sqs = [np.sum(X ** 2, axis=0) for X in Xs]
+
+    # Observed clusters
+    observed = list()
+    for X, sum_sq, connectivity, sample_shape in zip(
+            Xs, sum_sqs, connectivities, sample_shapes):
+        t_obs = _t_stats(X, flips[:, :1], sum_sq, sigma)[0]
+        observed.append(_observed_clusters(t_obs.reshape(sample_shape),
+                                           threshold, connectivity, method))
+
+    # For each cluster, count the permutations whose maximum cluster sum
+    # exceeds it. The identity is counted from the observed clusters, to be
+    # robust to rounding errors.
+    abs_sums = [np.abs(sums) for _, sums in observed]
+    counts = [np.ones(len(sums)) for sums in abs_sums]
+    n_perms = [np.ones(len(sums)) for sums in abs_sums]
+    active = [np.ones(len(sums), bool) for sums in abs_sums]
+    if exact:
+        # all permutations, enumerated by chunks of the Gray code
+        parallel, p_func, n_jobs = parallel_func(_max_cluster_sums_gray,
+                                                 n_jobs)
+        n_total = 2 ** (n_samples - 1)
+    else:
+        parallel, p_func, n_jobs = parallel_func(_max_cluster_sums, n_jobs)
+        n_total = flips.shape[1]
+    start, block = 1, 256 if auto else n_total
+    while start < n_total:
+        todo = [ii for ii in range(len(Xs)) if active[ii].any()]
+        if not len(todo):
+            break
+        stop = min(start + block, n_total)
+        n_chunks = max(1, min(n_jobs, stop - start))
+        bounds = np.linspace(start, stop, n_chunks + 1).astype(int)
+        args = ([Xs[ii] for ii in todo], [sum_sqs[ii] for ii in todo])
+        kwargs = dict(threshold=threshold,
+                      connectivities=[connectivities[ii] for ii in todo],
+                      sample_shapes=[sample_shapes[ii] for ii in todo],
+                      sigma=sigma, method=method)
+        chunks = [dict(start=lo, stop=hi) if exact else
+                  dict(flips=flips[:, lo:hi])
+                  for lo, hi in zip(bounds[:-1], bounds[1:])]
+        H0 = np.concatenate(parallel(p_func(*args, **dict(kwargs, **chunk))
+                                     for chunk in chunks), axis=1)
+        for ii, this_H0 in zip(todo, H0):
+            act = active[ii]
+            # with TFCE, there can be as many clusters as samples
+            counts[ii][act] += len(this_H0) - np.searchsorted(
+                np.sort(this_H0), abs_sums[ii][act])
+            n_perms[ii][act] += len(this_H0)
+            if auto:
+                act[act] = ~_resolved(counts[ii][act], n_perms[ii][act],
+                                      alpha, precision)
+        start = stop
+        block *= 2  # amortize the parallel overhead
+
+    # Assemble the p-value maps
+    p_values, details = list(), list()
+    for ii, (labels, sums) in enumerate(observed):
+        cluster_p = counts[ii] / n_perms[ii]
+        # the label 0 is outside clusters
+        p_values.append(np.squeeze(np.r_[1., cluster_p][labels]))
+        details.append(dict(
+            labels=np.squeeze(labels), cluster_p_values=cluster_p,
+            n_permutations=n_perms[ii].astype(int),
+            mc_errors=np.sqrt(cluster_p * (1. - cluster_p) / n_perms[ii])))
+    return (p_values, details) if full_output else p_values
+
+
+class GroupStats(object):
+    """Cluster statistics across subjects, updated incrementally.
+
+    Each subject has its own column of sign flips, fixed by the seed and its
+    name. The running sums of the sign-flipped maps and their sums of
+    squares can thus be updated when a subject is added, replaced or
+    removed, in O(n_permutations x n_tests), without the data of the other
+    subjects. The object is meant to be pickled between runs (see the
+    'group_stats' files of config.py): only the maps are stored, the sums
+    being rebuilt on loading with a single matrix product of the sign flips
+    and the maps.
+
+    Parameters
+    ----------
+    n_permutations : int
+        The number of sign-flip permutations, including the identity.
+    seed : int
+        The seed of the sign flips.
+    connectivity : None | sparse matrix
+        The spatial connectivity (see stats).
+    threshold : None | float
+        The cluster forming t-value, or the TFCE step (see stats).
+    sigma : float
+        The "hat" variance adjustment (see stats).
+    method : 'cluster' | 'tfce'
+        The cluster statistic (see stats).
+
+    Attributes
+    ----------
+    maps : dict
+        The map of each subject, shape (n_space, n_times).
+    stamps : dict
+        The version of the data of each subject, e.g. a checksum of its
+        file, to check whether it needs to be updated.
+    sums : array, shape (n_permutations, n_tests)
+        The sums of the sign-flipped maps, the first one being the identity.
+        They are not pickled.
+    sum_sq : array, shape (n_tests,)
+        The sum of the squared maps.
     """
-    X = np.array(X)
-    X = X[:, :, None] if X.ndim == 2 else X
-    T_obs_, clusters, p_values, _ = spatio_temporal_cluster_1samp_test(
-        X, out_type='mask', stat_fun=_stat_fun, n_permutations=2**12,
-        n_jobs=n_jobs, connectivity=connectivity)
-    p_values_ = np.ones_like(X[0]).T
-    for cluster, pval in zip(clusters, p_values):
-        p_values_[cluster.T] = pval
-    return np.squeeze(p_values_).T
+
+    def __init__(self, n_permutations=2 ** 12, seed=0, connectivity=None,
+                 threshold=None, sigma=0., method='cluster'):
+        if method not in ('cluster', 'tfce'):
+            raise ValueError("method must be 'cluster' or 'tfce', got %s"
+                             % method)
+        self.n_permutations = int(n_permutations)
+        self.seed = seed
+        self.connectivity = connectivity
+        self.threshold = threshold
+        self.sigma = sigma
+        self.method = method
+        self.maps = dict()
+        self.stamps = dict()
+        self.sample_shape = None
+        self.sums = None
+        self.sum_sq = None
+
+    def _signs(self, subject):
+        """The sign flips of a subject, identity first"""
+        import zlib
+        key = zlib.crc32(str(subject).encode('utf-8')) & 0xffffffff
+        rng = np.random.RandomState([self.seed, key])
+        signs = np.sign(.5 - rng.rand(self.n_permutations))
+        signs[0] = 1.
+        return signs
+
+    def _rebuild(self):
+        """Compute the sums and the sums of squares from the maps"""
+        subjects = list(self.maps)
+        n_tests = int(np.prod(self.sample_shape))
+        X = np.array([self.maps[subject].ravel() for subject in subjects])
+        signs = np.array([self._signs(subject) for subject in subjects])
+        X = X.reshape(len(subjects), n_tests)
+        signs = signs.reshape(len(subjects), self.n_permutations)
+        self.sums = np.dot(signs.T, X)
+        self.sum_sq = np.sum(X ** 2, axis=0)
+
+    def __getstate__(self):
+        # the sums are about n_permutations times larger than a map
+        state = self.__dict__.copy()
+        state['sums'] = state['sum_sq'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.sample_shape is not None:
+            self._rebuild()
+
+    def update(self, subject, X, stamp=None):
+        """Add or replace the map of a subject.
+
+        Parameters
+        ----------
+        subject : str | int
+            The subject identifier, which determines its sign flips.
+        X : array, shape (n_space, n_times)
+            The map of the subject, chance is assumed to be 0.
+        stamp : object
+            The version of the data (see stamps).
+        """
+        X = np.array(X, float)
+        X = X[:, None] if X.ndim == 1 else X
+        if self.sample_shape is None:
+            self.sample_shape = X.shape
+            self.sums = np.zeros((self.n_permutations, X.size))
+            self.sum_sq = np.zeros(X.size)
+        elif X.shape != self.sample_shape:
+            raise ValueError('All maps must be of shape %s, got %s'
+                             % (self.sample_shape, X.shape))
+        if subject in self.maps:
+            self.remove(subject)
+        X_flat = X.ravel()
+        self.sums += self._signs(subject)[:, np.newaxis] * X_flat
+        self.sum_sq += X_flat ** 2
+        self.maps[subject] = X
+        self.stamps[subject] = stamp
+
+    def remove(self, subject):
+        """Remove the map of a subject"""
+        X_flat = self.maps.pop(subject).ravel()
+        self.stamps.pop(subject, None)
+        self.sums -= self._signs(subject)[:, np.newaxis] * X_flat
+        self.sum_sq -= X_flat ** 2
+
+    def p_values(self, n_jobs=1, full_output=False):
+        """The cluster p-values of the current subjects.
+
+        Parameters
+        ----------
+        n_jobs : int
+            The number of parallel processors.
+        full_output : bool
+            If True, also return the details of each cluster (see stats).
+
+        Returns
+        -------
+        p_values : array, shape (n_space, n_times)
+            The p-value of the cluster of each sample, 1 outside clusters.
+        """
+        from mne.parallel import parallel_func
+        n_samples = len(self.maps)
+        if n_samples < 2:
+            raise ValueError('At least two subjects are needed, got %i'
+                             % n_samples)
+        threshold = self.threshold
+        if threshold is None:
+            threshold = _default_threshold(n_samples, self.method)
+        connectivity = None
+        if self.connectivity is not None:
+            connectivity = _setup_connectivity(self.connectivity,
+                                               self.sample_shape)
+        elif self.method == 'tfce':
+            connectivity = _lattice_edges(self.sample_shape)
+
+        # The observed clusters are computed from the maps, which are not
+        # affected by the rounding errors of the updates.
+        X = np.array([X.ravel() for X in self.maps.values()])
+        t_obs = _t_stats(X, np.ones((n_samples, 1)), np.sum(X ** 2, axis=0),
+                         self.sigma)[0]
+        labels, sums = _observed_clusters(t_obs.reshape(self.sample_shape),
+                                          threshold, connectivity,
+                                          self.method)
+
+        parallel, p_func, n_jobs = parallel_func(_max_cluster_sums_from_sums,
+                                                 n_jobs)
+        bounds = np.linspace(1, self.n_permutations,
+                             max(1, n_jobs) + 1).astype(int)
+        H0 = np.concatenate(parallel(p_func(
+            self.sums[start:stop], self.sum_sq, n_samples, threshold,
+            connectivity, self.sample_shape, self.sigma, self.method)
+            for start, stop in zip(bounds[:-1], bounds[1:])))
+        # the identity is counted from the observed clusters
+        counts = 1. + len(H0) - np.searchsorted(np.sort(H0), np.abs(sums))
+        cluster_p = counts / self.n_permutations
+        p_values = np.squeeze(np.r_[1., cluster_p][labels])
+        if not full_output:
+            return p_values
+        n_perms = np.tile(self.n_permutations, len(sums))
+        return p_values, dict(
+            labels=np.squeeze(labels), cluster_p_values=cluster_p,
+            n_permutations=n_perms,
+            mc_errors=np.sqrt(cluster_p * (1. - cluster_p) / n_perms))
+
 
 # ANALYSES ####################################################################
 
 
 def nested_analysis(X, df, condition, function=None, query=None,
-                    single_trial=False, y=None, n_jobs=-1):
+                    single_trial=False, y=None, n_jobs=-1, max_bytes=None,
+                    n_times=None):
     """ Apply a nested set of analyses. Note that this is an overkill in this
     study has only main effects are modeled.
 
@@ -56,8 +765,10 @@ def nested_analysis(X, df, condition, function=None, query=None,
 
     Parameters
     ----------
-    X : np.array, shape(n_samples, ...)
-        Data array.
+    X : np.array, shape(n_samples, ..., n_times) | generator
+        Data array. Can also be a generator of consecutive blocks of the last
+        dimension, each of shape (n_samples, ..., n_block), e.g. to compute
+        source estimates on the fly. n_times must then be given.
     df : pandas.DataFrame
         Condition DataFrame
     condition : str | list
@@ -71,6 +782,11 @@ def nested_analysis(X, df, condition, function=None, query=None,
     y : np.array, shape(n_conditions)
     n_jobs : int
         Number of core to compute the function. Defaults to -1.
+    max_bytes : float | None
+        If not None, X is processed by blocks of its last dimension of at most
+        max_bytes each, and the results are written in preallocated arrays.
+    n_times : int | None
+        The total length of the last dimension if X is a generator.
 
     Returns
     -------
@@ -79,71 +795,295 @@ def nested_analysis(X, df, condition, function=None, query=None,
     sub : dict()
         Contains results of sub levels.
     """
+    # The trials of each condition are identified once for all the blocks
+    groups = _nested_groups(df, condition, query)
+    if isinstance(X, np.ndarray):
+        if max_bytes is None:
+            return _nested_block(X, groups, function, single_trial, y, n_jobs)
+        n_times = X.shape[-1]
+        step = max(1, int(max_bytes // (X.nbytes // max(1, n_times))))
+        blocks = (X[..., start:start + step]
+                  for start in range(0, n_times, step))
+    elif n_times is None:
+        raise ValueError('n_times must be given when X is a generator')
+    else:
+        blocks = X
+
+    scores, sub_list, start = None, None, 0
+    for X_block in blocks:
+        stop = start + X_block.shape[-1]
+        these_scores, this_sub = _nested_block(X_block, groups, function,
+                                               single_trial, y, n_jobs)
+        if scores is None:
+            scores = np.empty(these_scores.shape[:-1] + (n_times,),
+                              these_scores.dtype)
+            sub_list = _allocate_sub(this_sub, n_times)
+        scores[..., start:stop] = these_scores
+        _fill_sub(sub_list, this_sub, slice(start, stop))
+        start = stop
+    if start != n_times:
+        raise ValueError('The blocks of X cover %i time samples, expected %i'
+                         % (start, n_times))
+    return scores, sub_list
+
 
+def _nested_groups(df, condition, query=None):
+    """Aux. function to nested_analysis: trials of each condition"""
     if isinstance(condition, str):
         # Subselect data using pandas.DataFrame queries
-        sel = range(len(X)) if query is None else df.query(query).index
-        X = X.take(sel, axis=0)
+        sel = range(len(df)) if query is None else df.query(query).index
         y = np.array(df[condition][sel])
-        # Find unique conditions
-        values = list()
-        for ii in np.unique(y):
-            if (ii is not None) and (ii not in [np.nan]):
-                try:
-                    if np.isnan(ii):
-                        continue
-                    else:
-                        values.append(ii)
-                except TypeError:
-                    values.append(ii)
-        # Subsubselect for each unique condition
-        y_sel = [np.where(y == value)[0] for value in values]
-        # Mean condition:
-        X_mean = np.zeros(np.hstack((len(y_sel), X.shape[1:])))
-        y_mean = np.zeros(len(y_sel))
-        for ii, sel_ in enumerate(y_sel):
-            X_mean[ii, ...] = np.mean(X[sel_, ...], axis=0)
-            if isinstance(y[sel_[0]], str):
-                y_mean[ii] = ii
-            else:
-                y_mean[ii] = y[sel_[0]]
+        # Factorize the conditions once, ignoring the missing ones
+        values, inverse, valid = _factorize(y)
+        y_mean = np.array([ii if isinstance(value, str) else value
+                           for ii, value in enumerate(values)], float)
+        return dict(condition=condition, query=query, sel=sel,
+                    values=values, inverse=inverse, y=y[valid], y_mean=y_mean,
+                    trials=np.asarray(sel, int)[valid])
+    elif isinstance(condition, list):
+        return dict(condition=condition, sub=[
+            _nested_groups(df, subcondition['condition'],
+                           subcondition.get('query', None))
+            for subcondition in condition])
+    raise ValueError('condition must be a str or a list, got %s' % condition)
+
+
+def _nested_block(X, groups, function, single_trial, y, n_jobs):
+    """Aux. function to nested_analysis: results on a block of X"""
+    condition = groups['condition']
+    if isinstance(condition, str):
+        trials = groups['trials']
+        # Mean condition, with a single product of a sparse indicator matrix
+        # that reads X in place
+        X_mean = _group_means(X, trials, groups['inverse'],
+                              len(groups['values']))
         if single_trial:
-            X = X.take(np.hstack(y_sel), axis=0)  # ERROR COME FROM HERE
-            y = y.take(np.hstack(y_sel), axis=0)
+            # the trials do not need to be sorted by condition
+            if not np.array_equal(trials, np.arange(len(X))):
+                X = X.take(trials, axis=0)
+            y = groups['y']
         else:
             X = X_mean
-            y = y_mean
+            y = groups['y_mean']
         # Store values to keep track
-        sub_list = dict(X=X_mean, y=y_mean, sel=sel, query=query,
-                        condition=condition, values=values,
-                        single_trial=True)
-    elif isinstance(condition, list):
+        sub_list = _condition_sub(X_mean, groups)
+    else:
         # If condition is a list, we must recall the function to gather
         # the results of the lower levels
         sub_list = list()
         X_list = list()  # FIXME use numpy array
-        for subcondition in condition:
-            scores, sub = nested_analysis(
-                X, df, subcondition['condition'], n_jobs=n_jobs,
-                function=subcondition.get('function', None),
-                query=subcondition.get('query', None))
+        for subcondition, subgroups in zip(condition, groups['sub']):
+            scores, sub = _nested_block(
+                X, subgroups, subcondition.get('function', None), False,
+                None, n_jobs)
             X_list.append(scores)
             sub_list.append(sub)
         X = np.array(X_list)
         if y is None:
             y = np.arange(len(condition))
         if len(y) != len(X):
-            raise ValueError('X and y must be of identical shape: ' +
-                             '%s <> %s') % (len(X), len(y))
+            raise ValueError('X and y must be of identical shape: '
+                             '%s <> %s' % (len(X), len(y)))
         sub_list = dict(X=X, y=y, sub=sub_list, condition=condition)
 
     # Default function
     function = _default_analysis if function is None else function
 
-    scores = pairwise(X, y, function, n_jobs=n_jobs)
+    scores = _pairwise(X, y, function, n_jobs=n_jobs)
     return scores, sub_list
 
 
+def _condition_sub(X_mean, groups):
+    """Aux. function to nested_analysis: results of a condition level"""
+    return dict(X=X_mean, y=groups['y_mean'], sel=groups['sel'],
+                query=groups['query'], condition=groups['condition'],
+                values=list(groups['values']), single_trial=True)
+
+
+def _allocate_sub(sub, n_times):
+    """Aux. function to nested_analysis: sub levels of the whole data"""
+    sub = dict(sub)
+    sub['X'] = np.empty(sub['X'].shape[:-1] + (n_times,), sub['X'].dtype)
+    if 'sub' in sub:
+        sub['sub'] = [_allocate_sub(this_sub, n_times)
+                      for this_sub in sub['sub']]
+    return sub
+
+
+def _fill_sub(sub, block_sub, times):
+    """Aux. function to nested_analysis: fill the sub levels of a block"""
+    sub['X'][..., times] = block_sub['X']
+    for this_sub, this_block_sub in zip(sub.get('sub', []),
+                                        block_sub.get('sub', [])):
+        _fill_sub(this_sub, this_block_sub, times)
+
+
+def nested_analyses(X, df, analyses, n_jobs=-1, max_bytes=None):
+    """Apply several analyses (see conditions.analyses) to the same data.
+
+    The single-trial analyses with the default function (AUC or Spearman)
+    that select the same trials share the ranks of X: each feature is ranked
+    once across these trials, the AUCs are then derived from the rank sums
+    and the Spearman correlations from the correlations of the ranks. The
+    other analyses are applied with nested_analysis.
+
+    Parameters
+    ----------
+    X : np.array, shape(n_samples, ..., n_times)
+        Data array.
+    df : pandas.DataFrame
+        Condition DataFrame
+    analyses : list of dict
+        The analyses, with their 'condition', and optionally 'query',
+        'erf_function', 'single_trial' and 'y' (see nested_analysis).
+    n_jobs : int
+        Number of core to compute the function. Defaults to -1.
+    max_bytes : float | None
+        If not None, X is processed by blocks of its last dimension of at most
+        max_bytes each.
+
+    Returns
+    -------
+    results : list of tuple
+        The scores and sub levels of each analysis (see nested_analysis).
+    """
+    results = [None] * len(analyses)
+    subsets = dict()
+    for ii, analysis in enumerate(analyses):
+        condition = analysis['condition']
+        if (analysis.get('erf_function', None) is None and
+                analysis.get('single_trial', False) and
+                analysis.get('y', None) is None and
+                isinstance(condition, str)):
+            groups = _nested_groups(df, condition, analysis.get('query', None))
+            # same cases as _default_analysis
+            if len(groups['y']) > 2 and len(groups['values']) >= 2:
+                key = groups['trials'].tobytes()
+                subsets.setdefault(key, list()).append((ii, groups))
+                continue
+        results[ii] = nested_analysis(
+            X, df, condition, function=analysis.get('erf_function', None),
+            query=analysis.get('query', None),
+            single_trial=analysis.get('single_trial', False),
+            y=analysis.get('y', None), n_jobs=n_jobs, max_bytes=max_bytes)
+
+    n_times = X.shape[-1]
+    step = n_times
+    if max_bytes is not None:
+        step = max(1, int(max_bytes // (X.nbytes // max(1, n_times))))
+    for members in subsets.values():
+        trials = members[0][1]['trials']
+        ys = [groups['y'] for _, groups in members]
+        scores = [np.empty(X.shape[1:]) for _ in members]
+        for start in range(0, n_times, step):
+            X_block = X[..., start:start + step]
+            if not np.array_equal(trials, np.arange(len(X))):
+                X_block = X_block.take(trials, axis=0)
+            for score, block_score in zip(scores, _pairwise(
+                    X_block, ys, _ranked_analyses, n_jobs=n_jobs)):
+                score[..., start:start + step] = block_score
+        for (ii, groups), score in zip(members, scores):
+            X_mean = _group_means(X, trials, groups['inverse'],
+                                  len(groups['values']))
+            results[ii] = score, _condition_sub(X_mean, groups)
+    return results
+
+
+def _rank(X):
+    """Ranks of each column of X, ties having their average rank"""
+    n_samples = len(X)
+    order = np.argsort(X, axis=0, kind='mergesort')
+    columns = np.arange(X.shape[1])
+    X_sorted = X[order, columns]
+    # first and last position of the ties of each sorted sample
+    index = np.arange(n_samples)[:, np.newaxis]
+    new = np.ones(X.shape, bool)
+    new[1:] = X_sorted[1:] != X_sorted[:-1]
+    first = np.maximum.accumulate(np.where(new, index, 0), axis=0)
+    last = np.ones(X.shape, bool)
+    last[:-1] = new[1:]
+    last = np.minimum.accumulate(np.where(last, index, n_samples)[::-1],
+                                 axis=0)[::-1]
+    ranks = np.empty(X.shape)
+    ranks[order, columns] = (first + last) / 2. + 1.
+    return ranks
+
+
+def _ranked_analyses(X, ys):
+    """Aux. function to nested_analyses: AUC (binary y) or Spearman
+    correlation (ordinal y) of each y, with X ranked once"""
+    n_samples = len(X)
+    ranks = _rank(X)
+    ranks -= (n_samples + 1.) / 2.
+    out = list()
+    for y in ys:
+        values = np.unique(y)
+        if len(values) == 2:
+            # Mann-Whitney U from the rank sums: P(X[y == values[1]] >
+            # X[y == values[0]]) + .5 P(ties)
+            positive = y == values[1]
+            n_pos = np.sum(positive)
+            n_neg = n_samples - n_pos
+            rank_sum = np.sum(ranks[positive], axis=0)
+            rank_sum += n_pos * (n_samples + 1.) / 2.
+            out.append((rank_sum - n_pos * (n_pos + 1.) / 2.) /
+                       (n_pos * n_neg))
+        else:
+            y_ranks = _rank(np.asarray(y, float)[:, np.newaxis])[:, 0]
+            y_ranks -= (n_samples + 1.) / 2.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out.append(np.dot(y_ranks, ranks) / np.sqrt(
+                    np.sum(y_ranks ** 2) * np.sum(ranks ** 2, axis=0)))
+    return tuple(out)
+
+
+def _factorize(y):
+    """Unique conditions of y, index of the condition of each valid trial,
+    and mask of the valid trials (neither None nor NaN)"""
+    import pandas as pd
+    valid = ~np.asarray(pd.isnull(y), bool)
+    values, inverse = np.unique(y[valid], return_inverse=True)
+    return values, inverse.ravel(), valid
+
+
+def _group_means(X, trials, inverse, n_groups):
+    """Mean of X[trials] within each group, shape (n_groups, ...)"""
+    from scipy.sparse import csr_matrix
+    counts = np.bincount(inverse, minlength=n_groups).astype(float)
+    indicator = csr_matrix((1. / counts[inverse], (inverse, trials)),
+                           shape=(n_groups, len(X)))
+    X_mean = indicator.dot(X.reshape(len(X), -1))
+    return X_mean.reshape((n_groups,) + X.shape[1:])
+
+
+def _pairwise(X, y, function, n_jobs=-1):
+    """Apply function(X[:, chunk], y) on contiguous chunks of the features of
+    X in parallel, and reshape the results as X.shape[1:]. If y has more than
+    one dimension, it must have the shape of X and is chunked identically:
+    function(X[:, chunk], y[:, chunk]).
+
+    Same as jr.utils.pairwise, which resizes X in place and thus fails on
+    views, subselections and memory-mapped arrays."""
+    from mne.parallel import parallel_func
+    dims = X.shape
+    X = X.reshape(dims[0], -1)
+    paired = isinstance(y, np.ndarray) and y.ndim > 1
+    if paired:
+        if y.shape != dims:
+            raise ValueError('X and y must have identical shapes, got %s and '
+                             '%s' % (dims, y.shape))
+        y = y.reshape(dims[0], -1)
+    parallel, p_func, n_jobs = parallel_func(function, n_jobs)
+    n_chunks = max(1, min(X.shape[1], n_jobs))
+    bounds = np.linspace(0, X.shape[1], n_chunks + 1).astype(int)
+    out = parallel(p_func(X[:, start:stop],
+                          y[:, start:stop] if paired else y)
+                   for start, stop in zip(bounds[:-1], bounds[1:]))
+    if isinstance(out[0], tuple):
+        return [np.reshape(np.hstack(out_), dims[1:]) for out_ in zip(*out)]
+    return np.reshape(np.hstack(out), dims[1:])
+
+
 def _default_analysis(X, y):
     """Aux. function to nested_analysis"""
     # Binary contrast
@@ -169,68 +1109,956 @@ def _default_analysis(X, y):
         raise RuntimeError('Please specify a function for this kind of data')
 
 
+class SelectionIndex(object):
+    """Trials selected by each analysis and subscore of a subject.
+
+    The queries are evaluated once, into a boolean matrix of trials x
+    selections, and the integer indices of each selection are cached, so
+    that selecting trials is a lookup.
+
+    Parameters
+    ----------
+    events : pandas.DataFrame
+        The events of a subject (see read_events).
+    analyses : list of dict | None
+        The analyses: their query, and the trials whose condition is not NaN.
+        Defaults to conditions.analyses.
+    subscores : list of (str, str) | None
+        The names and queries of the subscores. Defaults to
+        conditions.subscores.
+
+    Attributes
+    ----------
+    names : list of str
+        The name of each selection.
+    mask : array of bool, shape (n_trials, n_selections)
+        Whether each trial is selected.
+    """
+
+    def __init__(self, events, analyses=None, subscores=None):
+        if analyses is None or subscores is None:
+            import conditions
+            analyses = conditions.analyses if analyses is None else analyses
+            subscores = (conditions.subscores if subscores is None
+                         else subscores)
+        selections = [(analysis['name'], analysis['query'],
+                       analysis['condition']) for analysis in analyses]
+        selections += [(name, query, None) for name, query in subscores]
+        self.names = [name for name, _, _ in selections]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError('The names of the selections must be unique')
+        self.mask = np.ones((len(events), len(selections)), bool)
+        queries = dict()
+        for ii, (name, query, condition) in enumerate(selections):
+            if query is not None:
+                if query not in queries:
+                    queries[query] = np.asarray(events.eval(query), bool)
+                self.mask[:, ii] &= queries[query]
+            if condition is not None:
+                self.mask[:, ii] &= ~np.isnan(np.asarray(events[condition],
+                                                         float))
+        self._columns = dict((name, ii) for ii, name in enumerate(self.names))
+        self._indices = dict()
+
+    def __getitem__(self, name):
+        """The indices of the trials of a selection"""
+        if name not in self._indices:
+            self._indices[name] = np.flatnonzero(
+                self.mask[:, self._columns[name]])
+        return self._indices[name]
+
+
+_selection_indices = list()
+
+
+def selection_index(events):
+    """The SelectionIndex of the analyses and subscores of conditions.py,
+    built once for each events DataFrame"""
+    for these_events, index in _selection_indices:
+        if these_events is events:
+            return index
+    index = SelectionIndex(events)
+    # only keep the indices of the last subjects
+    _selection_indices[:] = _selection_indices[-7:] + [(events, index)]
+    return index
+
+
+# DECODING ####################################################################
+
+
+def fit_gat(gat, epochs, y=None, n_jobs=None, max_bytes=1e9):
+    """Fit a GeneralizationAcrossTime object by solving the linear estimators
+    of all training times at once.
+
+    The estimators of conditions.py are a StandardScaler followed by a Ridge,
+    a PolarRegression(Ridge) or a force_predict(LogisticRegression). For each
+    fold, the data of all training times are standardized together. The
+    ridge problems have closed-form solutions, solved as a stack of linear
+    systems; the logistic regressions are solved together by Newton's method.
+    The resulting gat.estimators_ are fitted sklearn pipelines, identical to
+    those of gat.fit up to the tolerance of its solvers. Other estimators
+    fall back on gat.fit.
+
+    Parameters
+    ----------
+    gat : GeneralizationAcrossTime
+        The object to fit.
+    epochs : mne.Epochs
+        The epochs.
+    y : list | array, shape (n_epochs,) | None
+        The to-be-predicted values, as in gat.fit.
+    n_jobs : int | None
+        The number of parallel processors. Defaults to gat.n_jobs.
+    max_bytes : float
+        The training times are solved by chunks of at most max_bytes each.
+
+    Returns
+    -------
+    gat : GeneralizationAcrossTime
+        The fitted object.
+    """
+    from mne.parallel import parallel_func
+    kind = _linear_kind(gat.clf)
+    if kind is None:
+        return gat.fit(epochs, y=y)
+    X, y = _gat_setup(gat, epochs, y)
+
+    # the cosine and sine of circular regressions are solved together
+    if kind == 'circ_regress':
+        Y = np.c_[np.cos(y), np.sin(y)].astype(float)
+    elif kind == 'categorize':
+        Y = np.array(y)
+    else:
+        Y = np.array(y, float)[:, np.newaxis]
+
+    # chunk the training times to bound the memory of their data, standardized
+    # data and grams
+    slices = gat.train_times_['slices']
+    n_features = X.shape[1] * len(slices[0])
+    size = 8. * (n_features + 1) * (2 * len(X) + 2 * n_features)
+    step = max(1, int(max_bytes // size))
+    if n_jobs is None:
+        n_jobs = gat.n_jobs
+    parallel, p_func, n_jobs = parallel_func(_fit_linear_slices, n_jobs)
+    n_chunks = max(min(len(slices), n_jobs), -(-len(slices) // step))
+    chunks = np.array_split(np.arange(len(slices)), n_chunks)
+    out = parallel(p_func(gat.clf, kind,
+                          _slice_data(X, [slices[t] for t in chunk]),
+                          Y, gat._cv_splits)
+                   for chunk in chunks)
+    gat.estimators_ = sum(out, list())
+    return gat
+
+
+def _linear_kind(clf):
+    """The type of analysis ('regress', 'circ_regress', 'categorize') of the
+    estimators of conditions.py that fit_gat can solve, None for other
+    estimators"""
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    if not isinstance(clf, Pipeline) or len(clf.steps) != 2:
+        return None
+    scaler, estimator = [step for _, step in clf.steps]
+    if not (isinstance(scaler, StandardScaler) and scaler.with_mean and
+            scaler.with_std):
+        return None
+    if _is_ridge(estimator):
+        return 'regress'
+    elif (type(estimator).__name__ == 'PolarRegression' and
+          _is_ridge(estimator.clf)):
+        return 'circ_regress'
+    elif (type(estimator).__name__ == 'force_predict' and
+          _is_logistic(estimator._clf)):
+        return 'categorize'
+    return None
+
+
+def _is_logistic(estimator):
+    """Whether the estimator is a L2 LogisticRegression that fit_gat can
+    solve"""
+    from sklearn.linear_model import LogisticRegression
+    return (isinstance(estimator, LogisticRegression) and
+            getattr(estimator, 'penalty', 'l2') in ('l2', 'deprecated') and
+            not getattr(estimator, 'l1_ratio', None) and
+            estimator.fit_intercept and
+            estimator.class_weight in (None, 'balanced'))
+
+
+def _is_ridge(estimator):
+    """Whether the estimator is a Ridge with a plain intercept"""
+    from sklearn.linear_model import Ridge
+    return (isinstance(estimator, Ridge) and estimator.fit_intercept and
+            not getattr(estimator, 'normalize', False) and
+            np.isscalar(estimator.alpha))
+
+
+def _gat_setup(gat, epochs, y):
+    """Same bookkeeping as GeneralizationAcrossTime.fit: sets the picks,
+    cross-validation and training times of gat, and returns the data and the
+    to-be-predicted values"""
+    from mne.decoding.time_gen import (_check_epochs_input, _set_cv,
+                                       _sliding_window)
+    for att in ['picks_', 'ch_names', 'y_train_', 'cv_', 'train_times_',
+                'estimators_', 'test_times_', 'y_pred_', 'y_true_',
+                'scores_', 'scorer_']:
+        if hasattr(gat, att):
+            delattr(gat, att)
+    X, y, gat.picks_ = _check_epochs_input(epochs, y, gat.picks)
+    gat.ch_names = [epochs.ch_names[p] for p in gat.picks_]
+    gat.cv_, gat._cv_splits = _set_cv(gat.cv, gat.clf, X=X, y=y)
+    gat.y_train_ = y
+    gat.train_times_ = _sliding_window(epochs.times, gat.train_times,
+                                       epochs.info['sfreq'])
+    return X, y
+
+
+def _slice_data(X, slices):
+    """Features of each time slice, shape (n_slices, n_trials, n_features),
+    flattened in the same order as GeneralizationAcrossTime"""
+    X = X[..., np.array(slices)]  # n_trials, n_chans, n_slices, n_samples
+    return np.transpose(X, [2, 0, 1, 3]).reshape(len(slices), len(X), -1)
+
+
+def _fold_moments(X, gram, cross, Y, train, test):
+    """Means, variances and centered cross-products of the training trials,
+    obtained by removing the test trials from the products of all trials"""
+    n_train = len(train)
+    X_test = X[:, test]
+    mean = (X.sum(1) - X_test.sum(1)) / n_train
+    Y_mean = Y[train].mean(0)
+    # the centering, n_train * mean' mean, is removed with the test trials
+    root = np.sqrt(n_train)
+    X_test = np.concatenate((X_test, root * mean[:, np.newaxis]), axis=1)
+    Y_test = np.concatenate((np.tile(Y[test], (len(X), 1, 1)),
+                             np.tile(root * Y_mean, (len(X), 1, 1))), axis=1)
+    X_test_T = X_test.transpose(0, 2, 1)
+    gram_ = np.matmul(X_test_T, X_test)
+    np.subtract(gram, gram_, out=gram_)
+    cross_ = cross - np.matmul(X_test_T, Y_test)
+    var = np.diagonal(gram_, axis1=1, axis2=2) / n_train
+    return mean, var, Y_mean, gram_, cross_
+
+
+def _ridge_slices(X, Y, splits, alpha):
+    """Ridge regressions of the standardized data of each slice and fold.
+
+    Parameters
+    ----------
+    X : array, shape (n_slices, n_trials, n_features)
+        The data.
+    Y : array, shape (n_trials, n_targets)
+        The to-be-predicted values.
+    splits : list of (train, test)
+        The cross-validation folds.
+    alpha : float
+        The regularization of the ridge.
+
+    Returns
+    -------
+    out : list of (mean, var, scale, coef, intercept, n_iter), one per fold
+        The fitted parameters, of shapes (n_slices, n_features) for the
+        standardization, (n_slices, n_features, n_targets) for the
+        coefficients and (n_slices, n_targets) for the intercepts. n_iter is
+        None.
+    """
+    n_slices, n_trials, n_features = X.shape
+    diag = range(n_features)
+    # center the data on all trials to limit the cancellations of the folds
+    offset = X.mean(1)
+    X = X - offset[:, np.newaxis]
+    X_T = X.transpose(0, 2, 1)
+    primal = min(len(train) for train, _ in splits) >= n_features
+    if primal:
+        gram, cross = np.matmul(X_T, X), np.matmul(X_T, Y)
+    out = list()
+    for train, test in splits:
+        n_train = len(train)
+        if primal:
+            # primal, with the grams of all trials minus those of the test
+            # trials. With S the scales, the standardized problem
+            # (S^-1 G S^-1 + alpha I) w = S^-1 c is (G + alpha S^2) v = c,
+            # with w = S v.
+            mean, var, Y_mean, gram_, cross_ = _fold_moments(
+                X, gram, cross, Y, train, test)
+            scale = _scale(var)
+            gram_[:, diag, diag] += alpha * scale ** 2
+            coef = np.linalg.solve(gram_, cross_)
+            coef *= scale[:, :, np.newaxis]
+        else:
+            # dual: w = Z' (ZZ' + alpha I)^-1 y, cheaper with few trials
+            X_train = X[:, train]
+            mean = X_train.mean(1)
+            var = X_train.var(1)
+            scale = _scale(var)
+            Z = (X_train - mean[:, np.newaxis]) / scale[:, np.newaxis]
+            Y_mean = Y[train].mean(0)
+            kernel = np.matmul(Z, Z.transpose(0, 2, 1))
+            kernel[:, range(n_train), range(n_train)] += alpha
+            dual = np.linalg.solve(kernel, np.tile(Y[train] - Y_mean,
+                                                   (n_slices, 1, 1)))
+            coef = np.matmul(Z.transpose(0, 2, 1), dual)
+        out.append((mean + offset, var, scale, coef,
+                    np.tile(Y_mean, (n_slices, 1)), None))
+    return out
+
+
+def _scale(var):
+    """Standard deviations, set to 1 for constant features as in
+    StandardScaler"""
+    scale = np.sqrt(np.maximum(var, 0.))
+    scale[scale == 0.] = 1.
+    return scale
+
+
+def _fit_linear_slices(clf, kind, X, Y, splits):
+    """Fitted clones of clf for each time slice and fold, as
+    GeneralizationAcrossTime.estimators_"""
+    from copy import deepcopy
+    from sklearn.base import clone
+    clf = clone(clf)
+    _, estimator = clf.steps[-1]
+    if kind == 'categorize':
+        folds = _logistic_slices(X, Y, splits, estimator._clf)
+    else:
+        alpha = estimator.clf.alpha if kind == 'circ_regress' else \
+            estimator.alpha
+        folds = _ridge_slices(X, Y, splits, alpha)
+    estimators = list()
+    for t in range(len(X)):
+        estimators_ = list()
+        for (train, _), fold in zip(splits, folds):
+            mean, var, scale, coef, intercept, n_iter = fold
+            clf_ = deepcopy(clf)  # faster than clone
+            scaler, estimator = [step for _, step in clf_.steps]
+            _set_scaler(scaler, mean[t], var[t], scale[t], len(train))
+            if kind == 'regress':
+                _set_ridge(estimator, coef[t][:, 0], intercept[t][0])
+            elif kind == 'categorize':
+                _set_logistic(estimator, coef[t][:, 0], intercept[t][0],
+                              np.unique(Y[train]), n_iter[t])
+            elif getattr(estimator, 'independent', True):
+                _set_ridge(estimator.clf_cos, coef[t][:, 0], intercept[t][0])
+                _set_ridge(estimator.clf_sin, coef[t][:, 1], intercept[t][1])
+            else:
+                _set_ridge(estimator.clf, coef[t].T, intercept[t])
+            estimators_.append(clf_)
+        estimators.append(estimators_)
+    return estimators
+
+
+def _set_scaler(scaler, mean, var, scale, n_samples):
+    """Set the fitted attributes of a StandardScaler"""
+    scaler.mean_, scaler.var_, scaler.scale_ = mean, var, scale
+    scaler.n_samples_seen_ = n_samples
+    scaler.n_features_in_ = len(mean)
+
+
+def _set_ridge(ridge, coef, intercept):
+    """Set the fitted attributes of a Ridge"""
+    ridge.coef_, ridge.intercept_ = coef, intercept
+    ridge.n_iter_ = None
+    ridge.n_features_in_ = coef.shape[-1]
+
+
+def _set_logistic(predictor, coef, intercept, classes, n_iter):
+    """Set the fitted attributes of a force_predict(LogisticRegression)"""
+    logistic = predictor._clf
+    logistic.coef_ = coef[np.newaxis]
+    logistic.intercept_ = np.array([intercept])
+    logistic.classes_ = classes
+    logistic.n_iter_ = np.array([n_iter], np.int32)
+    logistic.n_features_in_ = len(coef)
+    predictor._copyattr()
+
+
+def _logistic_slices(X, y, splits, logistic, stride=8):
+    """L2 logistic regressions of the standardized data of each slice and
+    fold, with the objective and the tolerance of the LogisticRegression.
+
+    The problems of the slices of a fold are solved together by Newton's
+    method. One slice every stride slices starts from zero in the first
+    fold, and from the solution of the previous fold in the others. The
+    other slices are then solved by bisection, each starting from the
+    interpolation of the solutions of its two solved neighbors.
+
+    Parameters
+    ----------
+    X : array, shape (n_slices, n_trials, n_features)
+        The data.
+    y : array, shape (n_trials,)
+        The two classes.
+    splits : list of (train, test)
+        The cross-validation folds.
+    logistic : LogisticRegression
+        The parameters of the regressions.
+    stride : int
+        The spacing of the slices solved first, a power of 2.
+
+    Returns
+    -------
+    out : list of (mean, var, scale, coef, intercept, n_iter), one per fold
+        The fitted parameters, of shapes (n_slices, n_features) for the
+        standardization, (n_slices, n_features, 1) for the coefficients,
+        (n_slices, 1) for the intercepts and (n_slices,) for the number of
+        Newton iterations.
+    """
+    from scipy.special import expit
+    n_slices, n_trials, n_features = X.shape
+    # liblinear, sklearn's solver until 0.22, penalizes the intercept as an
+    # additional feature equal to intercept_scaling
+    scaling = float(logistic.intercept_scaling)
+    penalty = np.ones(n_features + 1)
+    if logistic.solver not in ('liblinear', 'warn'):
+        penalty[-1] = 0.
+    first, levels = _bisection(n_slices, stride)
+    theta = np.zeros((n_slices, n_features + 1))
+    out = list()
+    for train, _ in splits:
+        classes, y_train = np.unique(y[train], return_inverse=True)
+        if len(classes) != 2:
+            raise ValueError('The logistic regressions need two classes in '
+                             'each fold, got %i' % len(classes))
+        # the class weights scale the loss of each trial
+        counts = np.bincount(y_train)
+        weights = logistic.C * np.ones(len(train))
+        if logistic.class_weight == 'balanced':
+            weights *= len(train) / (2. * counts[y_train])
+        y_train = 2. * y_train - 1.
+
+        # standardize and add the intercept feature
+        X_train = X[:, train]
+        mean = X_train.mean(1)
+        var = X_train.var(1)
+        scale = _scale(var)
+        Z = np.empty((n_slices, len(train), n_features + 1))
+        Z[..., :-1] = (X_train - mean[:, np.newaxis]) / scale[:, np.newaxis]
+        Z[..., -1] = scaling
+
+        # stop as liblinear, when the norm of the gradient falls below
+        # tol * min(n_pos, n_neg) / n times its norm at zero
+        problem = (y_train, weights, penalty)
+        grad = np.matmul(Z.transpose(0, 2, 1),
+                         weights * y_train * expit(0.))
+        threshold = (logistic.tol * max(counts.min(), 1) / len(train) *
+                     np.sqrt(np.sum(grad ** 2, 1)))
+
+        n_iter = np.zeros(n_slices, int)
+        theta[first], n_iter[first] = _logistic_newton(
+            Z[first], problem, theta[first], threshold[first],
+            logistic.max_iter)
+        for slices, left, right, ratio in levels:
+            start = theta[left] + ratio[:, np.newaxis] * (theta[right] -
+                                                          theta[left])
+            theta[slices], n_iter[slices] = _logistic_newton(
+                Z[slices], problem, start, threshold[slices],
+                logistic.max_iter)
+        out.append((mean, var, scale, theta[:, :-1, np.newaxis].copy(),
+                    scaling * theta[:, -1:], n_iter))
+    return out
+
+
+def _bisection(n_slices, stride):
+    """Order in which _logistic_slices solves the slices: first one every
+    stride slices (a power of 2) and the last one, then levels of
+    (slices, left, right, ratio), where each slice lies at ratio between its
+    left and right neighbors, solved at the previous levels."""
+    first = np.union1d(np.arange(0, n_slices, stride), [n_slices - 1])
+    levels = list()
+    step = stride
+    while step > 1:
+        step //= 2
+        slices = np.setdiff1d(np.arange(step, n_slices, 2 * step), first)
+        left = slices - step
+        right = np.minimum(slices + step, n_slices - 1)
+        levels.append((slices, left, right,
+                       (slices - left) / (right - left).astype(float)))
+    return first, levels
+
+
+def _logistic_newton(Z, problem, theta, threshold, max_iter=100):
+    """Minimize 0.5 * sum(penalty * theta ** 2) +
+    sum(weights * log(1 + exp(-y * Z theta))) for each problem, by Newton's
+    method with backtracking.
+
+    Parameters
+    ----------
+    Z : array, shape (n_problems, n_trials, n_features)
+        The data.
+    problem : (y, weights, penalty)
+        The classes (-1 or 1) and the weights of the loss of each trial, and
+        the L2 penalty of each feature.
+    theta : array, shape (n_problems, n_features)
+        The initial parameters.
+    threshold : array, shape (n_problems,)
+        The problems are solved when the norm of their gradient falls below
+        their threshold.
+    max_iter : int
+        The maximum number of iterations.
+
+    Returns
+    -------
+    theta : array, shape (n_problems, n_features)
+        The solutions.
+    n_iter : array, shape (n_problems,)
+        The number of iterations of each problem.
+    """
+    from scipy.special import expit
+    y, weights, penalty = problem
+    theta = np.array(theta, float)
+    # the Hessians only set the directions of the steps: single precision
+    # halves their cost without changing the solutions
+    Z32 = Z.astype(np.float32)
+    n_iter = np.zeros(len(Z), int)
+    margin = y * np.matmul(Z, theta[..., np.newaxis])[..., 0]
+    loss = _logistic_loss(margin, theta, problem)
+    # only the problems that have not converged are iterated
+    active = np.arange(len(Z))
+    for _ in range(max_iter):
+        if len(active) == len(Z):
+            Z_, Z32_ = Z, Z32
+        else:
+            Z_, Z32_ = Z[active], Z32[active]
+        theta_, margin_ = theta[active], margin[active]
+        grad = penalty * theta_ - np.matmul(
+            Z_.transpose(0, 2, 1),
+            (weights * y * expit(-margin_))[..., np.newaxis])[..., 0]
+        todo = np.sum(grad ** 2, 1) > threshold[active] ** 2
+        if not todo.all():
+            active, grad = active[todo], grad[todo]
+            Z_, Z32_ = Z_[todo], Z32_[todo]
+            theta_, margin_ = theta_[todo], margin_[todo]
+        if not len(active):
+            break
+        hessian = _logistic_hessian(Z32_, problem, margin_)
+        step = np.linalg.solve(hessian, grad[..., np.newaxis])[..., 0]
+        n_iter[active] += 1
+
+        # halve the steps that do not decrease the objective
+        theta_ = theta_ - step
+        margin_ = y * np.matmul(Z_, theta_[..., np.newaxis])[..., 0]
+        loss_ = _logistic_loss(margin_, theta_, problem)
+        rate = 1.
+        for _ in range(30):
+            worse = np.where(loss_ > loss[active])[0]
+            if not len(worse):
+                break
+            rate /= 2.
+            theta_[worse] += rate * step[worse]
+            margin_[worse] = y * np.matmul(
+                Z_[worse], theta_[worse][..., np.newaxis])[..., 0]
+            loss_[worse] = _logistic_loss(margin_[worse], theta_[worse],
+                                          problem)
+        theta[active], margin[active], loss[active] = theta_, margin_, loss_
+    return theta, n_iter
+
+
+def _logistic_hessian(Z, problem, margin):
+    """Hessians of the L2 logistic regressions, shape (n_problems,
+    n_features, n_features), in the precision of Z"""
+    from scipy.special import expit
+    _, weights, penalty = problem
+    proba = expit(margin)
+    curvature = weights * proba * (1. - proba)
+    Z = Z * np.sqrt(curvature).astype(Z.dtype)[..., np.newaxis]
+    hessian = np.matmul(Z.transpose(0, 2, 1), Z).astype(float)
+    diag = range(Z.shape[2])
+    hessian[:, diag, diag] += penalty
+    return hessian
+
+
+def _logistic_loss(margin, theta, problem):
+    """Objectives of the L2 logistic regressions, shape (n_problems,)"""
+    _, weights, penalty = problem
+    return (.5 * np.sum(penalty * theta ** 2, 1) +
+            np.sum(weights * np.logaddexp(0., -margin), 1))
+
+
+def predict_gat(gat, epochs, dtype=np.float64, max_bytes=1e9):
+    """Predict with a fitted GeneralizationAcrossTime object, with one
+    matrix product per fold and chunk of training times.
+
+    The estimators of conditions.py are linear: their standardization is
+    folded into their weights, so that the decisions of all training and
+    testing times of a fold are the product of the data with the stacked
+    weights. The decisions are then mapped to the output of each estimator:
+    identity for a Ridge, angle and radius for a PolarRegression, and
+    probability for a force_predict(LogisticRegression). Sets gat.y_pred_
+    and gat.test_times_ as gat.predict. Other estimators, or test times that
+    vary across training times (e.g. 'diagonal'), fall back on gat.predict.
+
+    Parameters
+    ----------
+    gat : GeneralizationAcrossTime
+        The fitted object.
+    epochs : mne.Epochs
+        The epochs.
+    dtype : numpy dtype
+        The precision of the computations and of gat.y_pred_, e.g. np.float32
+        to halve the memory.
+    max_bytes : float
+        The decisions are computed by chunks of training times of at most
+        max_bytes each.
+
+    Returns
+    -------
+    y_pred : array, shape (n_train_times, n_test_times, n_epochs, n_dim)
+        The predictions.
+    """
+    setup = _predict_setup(gat, epochs, dtype)
+    if setup is None:
+        return gat.predict(epochs)
+    y_pred = None
+    for start, stop, y_pred_ in _predict_blocks(gat, setup, max_bytes):
+        if y_pred is None:
+            y_pred = np.empty((len(gat.estimators_),) + y_pred_.shape[1:],
+                              dtype)
+        y_pred[start:stop] = y_pred_
+    gat.y_pred_ = y_pred
+    return y_pred
+
+
+def score_gat(gat, epochs, y=None, reduce=None, dtype=np.float32,
+              n_jobs=None, max_bytes=1e8):
+    """Predict and score with a fitted GeneralizationAcrossTime object, one
+    block of training times at a time.
+
+    Each block of predictions (see predict_gat) is scored with gat.scorer as
+    soon as it is computed, then dropped, so that the predictions of all
+    training and testing times are never in memory together. Sets
+    gat.scores_, gat.y_true_, gat.scorer_ and gat.test_times_ as gat.score.
+    Estimators that predict_gat cannot handle fall back on gat.score.
+
+    Parameters
+    ----------
+    gat : GeneralizationAcrossTime
+        The fitted object.
+    epochs : mne.Epochs
+        The epochs.
+    y : list | array, shape (n_epochs,) | None
+        The true values. Defaults to gat.y_train_.
+    reduce : None | 'diagonal' | array, shape (n_tois, 2)
+        The predictions to keep in gat.y_pred_: None to keep none, 'diagonal'
+        for those of the testing times equal to the training times, shape
+        (n_train_times, 1, n_epochs, n_dim), or the times of interest (e.g.
+        conditions.tois) to average the predictions across the testing times
+        of each, shape (n_train_times, n_tois, n_epochs, n_dim).
+    dtype : numpy dtype
+        The precision of the predictions.
+    n_jobs : int | None
+        The number of parallel processors. Defaults to gat.n_jobs.
+    max_bytes : float
+        The size of the blocks of predictions.
+
+    Returns
+    -------
+    scores : array, shape (n_train_times, n_test_times)
+        The scores.
+    """
+    from mne.parallel import parallel_func
+    if gat.scorer is None or gat.score_mode not in (
+            'fold-wise', 'mean-fold-wise', 'mean-sample-wise'):
+        setup = None
+    else:
+        setup = _predict_setup(gat, epochs, dtype)
+    if setup is None:
+        scores = gat.score(epochs, y=y)
+        if reduce is not None:
+            gat.y_pred_ = _reduce_predictions(gat, gat.y_pred_, 0, reduce)
+        elif hasattr(gat, 'y_pred_'):
+            del gat.y_pred_
+        return scores
+    if (gat.predict_mode == 'mean-prediction' and
+            gat.score_mode != 'mean-sample-wise'):
+        raise ValueError('score_mode could only be "mean-sample-wise" when '
+                         'predict_mode is "mean-prediction"')
+    y = np.array(gat.y_train_ if y is None else y)
+
+    if n_jobs is None:
+        n_jobs = gat.n_jobs
+    parallel, p_func, n_jobs = parallel_func(_score_block, n_jobs)
+    scores, y_pred = list(), list()
+    for start, stop, y_pred_ in _predict_blocks(gat, setup, max_bytes):
+        chunks = np.array_split(np.arange(stop - start),
+                                min(n_jobs, stop - start))
+        out = parallel(p_func(y, y_pred_[chunk], gat.scorer, gat.score_mode,
+                              gat._cv_splits) for chunk in chunks)
+        scores.extend(sum(out, list()))
+        if reduce is not None:
+            y_pred.append(_reduce_predictions(gat, y_pred_, start, reduce))
+    gat.y_true_, gat.scorer_ = y, gat.scorer
+    gat.scores_ = np.array(scores)
+    if reduce is not None:
+        gat.y_pred_ = np.concatenate(y_pred)
+    return gat.scores_
+
+
+def _score_block(y_true, y_pred, scorer, score_mode, splits):
+    """Scores of the predictions of a block of training times, shape
+    (n_train_times, n_test_times, n_epochs, n_dim), as
+    GeneralizationAcrossTime.score"""
+    scores = list()
+    for y_pred_train in y_pred:
+        scores_train = list()
+        for y_pred_test in y_pred_train:
+            if score_mode == 'mean-sample-wise':
+                score = scorer(y_true, y_pred_test)
+            else:
+                score = np.array([scorer(y_true[test], y_pred_test[test])
+                                  for _, test in splits])
+                if score_mode == 'mean-fold-wise':
+                    score = np.mean(score, axis=0)
+            scores_train.append(score)
+        scores.append(scores_train)
+    return scores
+
+
+def _reduce_predictions(gat, y_pred, start, reduce):
+    """Diagonal, or means across the testing times of each time of interest,
+    of the predictions of the training times from start"""
+    if isinstance(reduce, str) and reduce == 'diagonal':
+        train_slices = gat.train_times_['slices'][start:start + len(y_pred)]
+        tests = [[list(test) for test in slices] for slices in
+                 gat.test_times_['slices'][start:start + len(y_pred)]]
+        diagonal = list()
+        for y_pred_, train, slices in zip(y_pred, train_slices, tests):
+            if list(train) not in slices:
+                raise ValueError('The training time %s is not tested'
+                                 % list(train))
+            diagonal.append(y_pred_[slices.index(list(train))])
+        return np.array(diagonal)[:, np.newaxis]
+    times = np.array(gat.test_times_['times'][0])
+    means = np.nan * np.ones((len(y_pred), len(reduce)) + y_pred.shape[2:],
+                             y_pred.dtype)
+    for ii, (tmin, tmax) in enumerate(reduce):
+        toi = (times >= tmin) & (times < tmax)
+        if toi.any():
+            means[:, ii] = np.mean(y_pred[:, toi], axis=1)
+    return means
+
+
+def _predict_setup(gat, epochs, dtype):
+    """Checks and sets the testing times of gat as
+    GeneralizationAcrossTime.predict, and returns the stacked weights and the
+    test data of each fold; None when gat cannot be predicted from linear
+    weights"""
+    from mne.decoding.time_gen import _check_epochs_input
+    if not hasattr(gat, 'estimators_'):
+        return None
+    predictors = [[_linear_predictor(estimator) for estimator in estimators]
+                  for estimators in gat.estimators_]
+    test_times = _gat_test_times(gat, epochs)
+    slices = test_times['slices']
+    if (None in sum(predictors, list()) or gat.predict_method != 'predict' or
+            any(test != slices[0] for test in slices) or
+            gat.predict_mode not in ('cross-validation', 'mean-prediction')):
+        return None
+    slices = slices[0]
+    if any(len(test) != len(train) for test in slices
+           for train in gat.train_times_['slices']):
+        raise ValueError('train_times and test_times must have identical '
+                         'lengths')
+    if gat.predict_mode == 'cross-validation':
+        if (len(set(len(estimators) for estimators in gat.estimators_)) != 1 or
+                len(gat.estimators_[0]) != len(gat._cv_splits) or
+                len(gat.y_train_) != len(epochs)):
+            raise ValueError('When predict_mode = "cross-validation", the '
+                             'training and predicting cv schemes must be '
+                             'identical.')
+        tests = [test for _, test in gat._cv_splits]
+    else:
+        tests = [slice(None)] * len(gat.estimators_[0])
+    for att in ['y_pred_', 'test_times_', 'scores_', 'scorer_', 'y_true_']:
+        if hasattr(gat, att):
+            delattr(gat, att)
+    gat.test_times_ = test_times
+
+    # stack the weights: n_train_times, n_folds, n_features, n_outputs
+    coefs = np.array([[coef for coef, _, _ in estimators]
+                      for estimators in predictors], dtype)
+    intercepts = np.array([[intercept for _, intercept, _ in estimators]
+                           for estimators in predictors], dtype)
+    output = predictors[0][0][2]
+    X, _, _ = _check_epochs_input(epochs, None, gat.picks_)
+    X = _slice_data(X, slices).astype(dtype)  # n_test, n_epochs, n_features
+    # the test trials of each fold: n_test * n_trials, n_features
+    X_tests = [X[:, test].reshape(-1, X.shape[2]) for test in tests]
+    return coefs, intercepts, output, X.shape[:2], tests, X_tests
+
+
+def _predict_blocks(gat, setup, max_bytes):
+    """Predictions of each block of training times: yields start, stop and
+    the predictions, shape (stop - start, n_test_times, n_epochs, n_dim)"""
+    coefs, intercepts, output, (n_test, n_epochs), tests, X_tests = setup
+    n_train, n_folds, n_features, n_outputs = coefs.shape
+    n_dim = 2 if output[0] == 'polar' else 1
+    step = max(1, int(max_bytes // (coefs.itemsize * n_test * n_epochs *
+                                    max(n_outputs, n_dim))))
+    for start in range(0, n_train, step):
+        stop = min(start + step, n_train)
+        y_pred = np.zeros((stop - start, n_test, n_epochs, n_dim),
+                          coefs.dtype)
+        for fold, (test, X_test) in enumerate(zip(tests, X_tests)):
+            if not len(X_test):
+                continue
+            # one product for all the training and testing times
+            coef = coefs[start:stop, fold].transpose(1, 0, 2)
+            decision = np.dot(X_test, coef.reshape(n_features, -1))
+            decision = decision.reshape(n_test, -1, stop - start, n_outputs)
+            decision += intercepts[start:stop, fold]
+            y_pred_ = _linear_output(decision, output).transpose(2, 0, 1, 3)
+            if gat.predict_mode == 'cross-validation':
+                y_pred[:, :, test] = y_pred_
+            else:
+                # mean-prediction: average the predictions of all folds
+                y_pred += y_pred_ / n_folds
+        yield start, stop, y_pred
+
+
+def _gat_test_times(gat, epochs):
+    """Same testing times as GeneralizationAcrossTime.predict"""
+    import copy
+    from mne.decoding.time_gen import _sliding_window, _set_window_time
+    if gat.test_times == 'diagonal':
+        test_times = dict()
+        test_times['slices'] = [[s] for s in gat.train_times_['slices']]
+    elif gat.test_times is None:
+        test_times = dict()
+    elif isinstance(gat.test_times, dict):
+        test_times = copy.deepcopy(gat.test_times)
+    else:
+        raise ValueError('test_times must be a dict or "diagonal"')
+    if 'slices' not in test_times:
+        # a sliding window for each training time
+        test_times['length'] = test_times.get('length',
+                                              gat.train_times_['length'])
+        slices = _sliding_window(epochs.times, test_times,
+                                 epochs.info['sfreq'])['slices']
+        test_times['slices'] = [slices] * len(gat.train_times_['slices'])
+    test_times['times'] = [_set_window_time(test, epochs.times)
+                           for test in test_times['slices']]
+    return test_times
+
+
+def _linear_predictor(clf):
+    """Weights, shape (n_features, n_outputs), intercepts and output of a
+    fitted estimator of conditions.py, with the standardization folded in the
+    weights. None for other estimators."""
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.linear_model import LogisticRegression, Ridge
+    if not isinstance(clf, Pipeline) or len(clf.steps) != 2:
+        return None
+    scaler, estimator = [step for _, step in clf.steps]
+    if not isinstance(scaler, StandardScaler):
+        return None
+    if isinstance(estimator, Ridge):
+        ridges, output = [estimator], ('identity',)
+    elif (type(estimator).__name__ == 'PolarRegression' and
+          getattr(estimator, 'independent', True)):
+        ridges, output = [estimator.clf_cos, estimator.clf_sin], ('polar',)
+    elif (type(estimator).__name__ == 'force_predict' and
+          isinstance(estimator._clf, LogisticRegression) and
+          len(estimator._clf.classes_) == 2 and
+          estimator._mode in ('predict_proba', 'decision_function')):
+        ridges = [estimator._clf]
+        output = (('proba', estimator._axis)
+                  if estimator._mode == 'predict_proba' else ('identity',))
+    else:
+        return None
+    coef = np.concatenate([np.atleast_2d(ridge.coef_) for ridge in ridges]).T
+    intercept = np.concatenate([np.atleast_1d(ridge.intercept_)
+                                for ridge in ridges])
+    if scaler.with_std:
+        coef = coef / scaler.scale_[:, np.newaxis]
+    if scaler.with_mean:
+        intercept = intercept - np.dot(scaler.mean_, coef)
+    return coef, intercept, output
+
+
+def _linear_output(decision, output):
+    """Map the decisions, shape (..., n_outputs), to the predictions of the
+    estimators, shape (..., n_dim)"""
+    from scipy.special import expit
+    if output[0] == 'polar':
+        cos, sin = decision[..., 0], decision[..., 1]
+        return np.stack((np.arctan2(sin, cos), np.sqrt(cos ** 2 + sin ** 2)),
+                        axis=-1)
+    elif output[0] == 'proba':
+        # probability of the second class; of the first one with axis=0
+        return expit(decision if output[1] == 1 else -decision)
+    return decision
+
+
 # LOAD DATA ###################################################################
 
 
 def read_events(bhv_fname):
     """Reads events from mat file, convert and clean them into readable
-    variables."""
+    variables.
+
+    The conversion is vectorized over the trials: each field of the trials
+    is read as a column. Columns mixing booleans and NaNs are floats."""
     import scipy.io as sio
     import pandas as pd
     # Load behavioral file
     trials = sio.loadmat(bhv_fname, squeeze_me=True,
                          struct_as_record=False)["trials"]
+    trials = np.atleast_1d(trials)
+
+    def column(*names):
+        """Field of all trials, e.g. column('gabors', 'target', 'phase')"""
+        values = list()
+        for trial in trials:
+            for name in names:
+                trial = getattr(trial, name)
+            values.append(trial)
+        return np.array(values)
+
+    def phasebin(v):
+        return np.digitize(v, np.linspace(0, 1, 7)) * 2 * np.pi / 6.
+
+    events = dict()
+    # Change meaningless values with NaNs
+    present = column('present') == 1
+    events['target_present'] = present
+    events['discrim_pressed'] = column('response_responsed') == 1
+    detect_pressed = column('response_vis_responsed') == 1
+    events['detect_pressed'] = detect_pressed
+    # Target
+    # XXX contrast should be 25, 75 or 100 FIXME
+    events['target_contrast'] = np.array([0, .5, .75, 1])[
+        column('contrast') - 1]
+    events['target_spatialFreq'] = np.where(present, column('lambda'),
+                                            np.nan)
+    orientation = column('orientation')
+    events['target_angle'] = np.where(present, orientation * 30. - 15,
+                                      np.nan)
+    events['target_circAngle'] = angle2circle(events['target_angle'])
+    events['target_phase'] = np.where(
+        present, phasebin(column('gabors', 'target', 'phase')), np.nan)
 
-    def trial2event(trial):
-        event = dict()
-        # Change meaningless values with NaNs
-        event['target_present'] = trial.present == 1
-        event['discrim_pressed'] = trial.response_responsed == 1
-        event['detect_pressed'] = trial.response_vis_responsed == 1
-        nan_default = lambda check, value: value if check else np.nan
-        check_present = lambda v: nan_default(event['target_present'], v)
-        # discrim_pressed = lambda v: nan_default(event['discrim_pressed'], v)
-        discrim_buttons = lambda v: nan_default(
-            v in ['left_green', 'left_yellow'], 1. * (v == 'left_green'))
-        detect_pressed = lambda v: nan_default(event['detect_pressed'], v)
-        phasebin = lambda v: np.digitize(
-            [v], np.linspace(0, 1, 7))[0] * 2 * np.pi / 6.
-        # Target
-        # XXX contrast should be 25, 75 or 100 FIXME
-        event['target_contrast'] = [0, .5, .75, 1][trial.contrast - 1]
-        event['target_spatialFreq'] = check_present(
-            trial.__getattribute__('lambda'))
-        event['target_angle'] = check_present(trial.orientation * 30 - 15)
-        event['target_circAngle'] = angle2circle(event['target_angle'])
-        event['target_phase'] = check_present(phasebin(
-                                              trial.gabors.target.phase))
-
-        # Probe
-        event['probe_angle'] = (trial.orientation * 30 - 15 +
-                                trial.tilt * 30) % 180
-        event['probe_circAngle'] = angle2circle(event['probe_angle'])
-        event['probe_tilt'] = check_present(trial.tilt)
-        event['probe_spatialFreq'] = \
-            trial.gabors.probe.__getattribute__('lambda')
-        event['probe_phase'] = phasebin(trial.gabors.probe.phase)
-        # Response 1: forced choice discrimination
-        event['discrim_button'] = discrim_buttons(trial.response_keyPressed)
-        event['discrim_correct'] = check_present(trial.correct == 1)
-        # Response 2: detection/visibility
-        event['detect_button'] = \
-            detect_pressed(trial.response_visibilityCode - 1)
-        event['detect_seen'] = event['detect_button'] > 0
-        if np.isnan(event['detect_button']):
-            event['detect_seen'] = np.nan
-        return event
-
-    events = list()
-    for t, trial in enumerate(trials):
-        # define previous trial
-        event = trial2event(trial)
-        events.append(event)
-    events = pd.DataFrame(events)
-    return events
+    # Probe
+    tilt = column('tilt')
+    events['probe_angle'] = (orientation * 30 - 15 + tilt * 30) % 180
+    events['probe_circAngle'] = angle2circle(events['probe_angle'])
+    events['probe_tilt'] = np.where(present, tilt, np.nan)
+    events['probe_spatialFreq'] = column('gabors', 'probe', 'lambda')
+    events['probe_phase'] = phasebin(column('gabors', 'probe', 'phase'))
+    # Response 1: forced choice discrimination; keys are empty arrays when
+    # no key was pressed
+    keys = [trial.response_keyPressed for trial in trials]
+    keys = np.array([key if np.size(key) == 1 else '' for key in keys])
+    events['discrim_button'] = np.where(
+        (keys == 'left_green') | (keys == 'left_yellow'),
+        1. * (keys == 'left_green'), np.nan)
+    events['discrim_correct'] = np.where(present, column('correct') == 1,
+                                         np.nan)
+    # Response 2: detection/visibility
+    events['detect_button'] = np.where(
+        detect_pressed, column('response_visibilityCode') - 1., np.nan)
+    events['detect_seen'] = np.where(detect_pressed,
+                                     events['detect_button'] > 0, np.nan)
+    return pd.DataFrame(events, columns=sorted(events.keys()))
 
 
 def angle2circle(angles):
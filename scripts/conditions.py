@@ -4,17 +4,10 @@
 
 """Define each analysis, its corresponding classifier & scoring metrics"""
 # Decoding parameters
+# matplotlib, sklearn and jr are only imported when needed, so that importing
+# the analyses remains fast, e.g. for the statistics and the parallel workers.
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
 from itertools import product
-from sklearn.preprocessing import StandardScaler
-from sklearn.pipeline import make_pipeline
-from sklearn.metrics import roc_auc_score
-from sklearn.linear_model import LogisticRegression, Ridge
-from jr.gat import force_predict, scorer_spearman, PolarRegression
-from jr.gat import scorer_angle as _scorer_angle
-from jr.stats import corr_linear_circular
 
 # Analysis Parameters: arbitrary time regions of interest
 tois = np.array([[-.150, 0.], [.100, .250], [.300, .800], [.900, 1.050]])
@@ -23,6 +16,7 @@ tois = np.array([[-.150, 0.], [.100, .250], [.300, .800], [.900, 1.050]])
 def scorer_angle(y_true, y_pred):
     """We are keeping the predicted radius for TOI averaging purposes.
     However we will not need it for most scorers."""
+    from jr.gat import scorer_angle as _scorer_angle
     y_pred = np.array(y_pred)
     if y_pred.ndim == 1:
         y_pred = y_pred[:, np.newaxis]
@@ -31,18 +25,88 @@ def scorer_angle(y_true, y_pred):
 
 def scorer_auc(y_true, y_pred):
     """Aux. function to return AUC score from a probabilistic prediction"""
+    from sklearn.metrics import roc_auc_score
     # FIXME jr.gat.scorers.scorer_auc crashes when too many values with the
     # same proba.
     return roc_auc_score(y_true == np.max(y_true), y_pred[:, 0])
 
 
+def scorer_spearman(y_true, y_pred):
+    """Aux. function to return Spearman R from a continuous prediction"""
+    from jr.gat import scorer_spearman as _scorer_spearman
+    return _scorer_spearman(y_true, y_pred)
+
+
 def scorer_circlin(y_line, y_circ):
     """Scoring function to compute pseudo R value from circular linear
     correlation"""
+    from jr.stats import corr_linear_circular
     R, R2, pval = corr_linear_circular(y_line, y_circ)
     return R
 
 
+def _make_clf(typ):
+    """Build the estimator of each type of analysis"""
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.pipeline import make_pipeline
+    from sklearn.linear_model import LogisticRegression, Ridge
+    from jr.gat import force_predict, PolarRegression
+    if typ == 'categorize':
+        # estimator is normalization + l2 Logistic Regression
+        return make_pipeline(
+            StandardScaler(),
+            force_predict(LogisticRegression(class_weight='balanced'), axis=1))
+    elif typ == 'regress':
+        # estimator is normalization + l2 Ridge
+        return make_pipeline(StandardScaler(), Ridge())
+    elif typ == 'circ_regress':
+        # estimator is normalization + l2 Logistic Regression on cos and sin
+        return make_pipeline(StandardScaler(), PolarRegression(Ridge()))
+
+
+class Analysis(dict):
+    """Parameters of an analysis. The estimator ('clf') and the colors
+    ('color', 'cmap') are only built when first accessed.
+
+    These lazy keys are always found by ``in`` and ``get``, but only appear
+    in ``keys()``, in iterations and in copies (e.g. ``dict(analysis)``) once
+    they have been accessed. Use ``definition()`` to hash or compare
+    analyses independently of what has been accessed."""
+
+    # position in the rainbow colormap, set once all analyses are defined
+    color_rank = 0.
+    _lazy = ('clf', 'color', 'cmap')
+
+    def __contains__(self, key):
+        return key in self._lazy or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def definition(self):
+        """The parameters on which the results depend, i.e. with the
+        estimator but without the colors"""
+        out = dict((key, value) for key, value in self.items()
+                   if key not in ('color', 'cmap'))
+        out['clf'] = self['clf']
+        return out
+
+    def __missing__(self, key):
+        if key == 'clf':
+            value = _make_clf(self['typ'])
+        elif key == 'color':
+            import matplotlib.pyplot as plt
+            value = np.array(plt.get_cmap('gist_rainbow')(self.color_rank))
+        elif key == 'cmap':
+            from matplotlib.colors import LinearSegmentedColormap
+            value = LinearSegmentedColormap.from_list(
+                'RdBu', ['w', self['color'], 'k'])
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+
 def analysis(name, typ, condition=None, query=None, title=None):
     """Wrapper to ensure that we attribute the same function for each type
     of analyses: e.g. categorical, regression, circular regression."""
@@ -52,29 +116,21 @@ def analysis(name, typ, condition=None, query=None, title=None):
     # e.g. target_present==False - target_present==True
 
     if typ == 'categorize':
-        # estimator is normalization + l2 Logistic Regression
-        clf = make_pipeline(
-            StandardScaler(),
-            force_predict(LogisticRegression(class_weight='balanced'), axis=1))
         scorer = scorer_auc
         chance = .5
     elif typ == 'regress':
-        # estimator is normalization + l2 Ridge
-        clf = make_pipeline(StandardScaler(), Ridge())
         scorer = scorer_spearman
         chance = 0.
     elif typ == 'circ_regress':
-        # estimator is normalization + l2 Logistic Regression on cos and sin
-        clf = make_pipeline(StandardScaler(), PolarRegression(Ridge()))
         scorer = scorer_angle
         chance = 0.
         # The univariate analysis needs a different scorer
         erf_function = scorer_circlin
     if condition is None:
         condition = name
-    return dict(name=name, condition=condition, query=query, clf=clf,
-                scorer=scorer, chance=chance, erf_function=erf_function,
-                cv=8, typ=typ, title=title, single_trial=True)
+    return Analysis(name=name, condition=condition, query=query,
+                    scorer=scorer, chance=chance, erf_function=erf_function,
+                    cv=8, typ=typ, title=title, single_trial=True)
 
 
 # For each analysis we need to specifically analyze a subset of trials to avoid
@@ -97,12 +153,8 @@ analyses = (
 )
 
 # Define a specific color for each analysis
-cmap = plt.get_cmap('gist_rainbow')
 for ii in range(len(analyses)):
-    color = np.array(cmap(float(ii) / len(analyses)))
-    analyses[ii]['color'] = color
-    analyses[ii]['cmap'] = LinearSegmentedColormap.from_list(
-        'RdBu', ['w', color, 'k'])
+    analyses[ii].color_rank = float(ii) / len(analyses)
 
 
 # To control for correlation across variables, we'll score the classifiers on a
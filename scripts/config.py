@@ -7,10 +7,8 @@ import numpy as np
 import pickle
 import os
 import os.path as op
-from mne import read_epochs
-from mne.io import Raw
-from jr.utils import OnlineReport
-from jr.cloud import Client
+from storage import (CachedClient, TransferManager, S3Bucket, LocalBucket,
+                     Manifest, file_hash)
 
 # Setup paths depending on we're computing locally or on AWS
 aws = False
@@ -21,15 +19,47 @@ if aws:
 else:
     data_path = '/media/jrking/harddrive/Niccolo/data/'
 
-# Setup client with AWS to save and retrieve data
-client = Client('S3', bucket='meg.niccolo', client_root=data_path)
+# Setup client with AWS to save and retrieve data. Files are transferred by
+# concurrent chunks, and uploads are performed in the background. A local
+# directory can replace the bucket (e.g. export bucket_root=/tmp/bucket).
+# Downloaded files are cached locally within a maximum number of bytes
+# (e.g. export cache_bytes=50e9).
+if 'bucket_root' in os.environ.keys():
+    bucket = LocalBucket(os.environ['bucket_root'])
+else:
+    bucket = S3Bucket('meg.niccolo')
+n_transfers = 4
+if 'n_transfers' in os.environ.keys():
+    n_transfers = int(os.environ['n_transfers'])
+cache_bytes = None
+if 'cache_bytes' in os.environ.keys():
+    cache_bytes = float(os.environ['cache_bytes'])
+client = TransferManager(bucket, client_root=data_path, n_jobs=n_transfers)
+client = CachedClient(client, cache_dir=op.join(data_path, '.cache'),
+                      max_bytes=cache_bytes)
+
+# Index of the local and remote artifacts, to check their existence without
+# a request per file (see exists()).
+manifest = Manifest(client, op.join(data_path, '.cache', 'manifest.json'))
+
+
+class _LazyReport(object):
+    """Create the online report on first use, as it imports matplotlib and
+    sets up its folders."""
+
+    def __getattr__(self, attr):
+        if attr == '_report':
+            from jr.utils import OnlineReport
+            self._report = OnlineReport()
+            return self._report
+        return getattr(self._report, attr)
+
 
 # Setup online HTML report to generate figures on each iteration
-report = OnlineReport()
+report = _LazyReport()
 
 # Experiment parameters
 base_path = op.dirname(op.dirname(__file__))
-print base_path
 
 
 # Define subjects id, and MRI
@@ -70,6 +100,7 @@ def paths(typ, subject='fsaverage', analysis='analysis', block=999):
         evoked=op.join(this_path, '%s_%s.pickle' % (subject, analysis)),
         evoked_source=op.join(this_path, '%s_%s.pickle' % (subject, analysis)),
         decod=op.join(this_path, '%s_%s.pickle' % (subject, analysis)),
+        decod_arrays=op.join(this_path, '%s_%s_decod' % (subject, analysis)),
         decod_tfr=op.join(this_path, '%s_%s_tfr.pickle' % (subject, analysis)),
         score=op.join(this_path, '%s_%s_scores.pickle' % (subject, analysis)),
         score_tfr=op.join(this_path,
@@ -78,6 +109,8 @@ def paths(typ, subject='fsaverage', analysis='analysis', block=999):
             this_path, '%s_%s_scores.npy' % (subject, analysis)),
         score_pval=op.join(
             this_path, '%s_%s_pval.npy' % (subject, analysis)),
+        group_stats=op.join(
+            this_path, '%s_%s_group_stats.pickle' % (subject, analysis)),
         freesurfer=op.join('data/'.join(data_path.split('data/')[:-1]),
                            'subjects'))
     this_file = path_template[typ]
@@ -90,46 +123,385 @@ def paths(typ, subject='fsaverage', analysis='analysis', block=999):
     return this_file
 
 
+def exists(typ, subject='fsaverage', analysis='analysis', block=999,
+           where='any', strict=False):
+    """Check whether a file exists locally and/or on the bucket, using the
+    manifest rather than a request per file.
+
+    Parameters
+    ----------
+    where : 'any' | 'local' | 'remote'
+        Where the file should be.
+    strict : bool
+        If True, a file missing from the listing of the bucket (which can be
+        up to 10 minutes old) is checked with a request.
+    """
+    fname = paths(typ, subject=subject, analysis=analysis, block=block)
+    return manifest.exists(fname, where=where, strict=strict)
+
+
+def _producer_version():
+    """Script and git commit which produce the saved files"""
+    if not hasattr(_producer_version, 'version'):
+        import sys
+        import subprocess
+        script = op.basename(sys.argv[0])
+        try:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=op.dirname(op.abspath(__file__))).strip().decode()
+        except (OSError, subprocess.CalledProcessError):
+            commit = 'unknown'
+        _producer_version.version = '%s@%s' % (script, commit)
+    return _producer_version.version
+
+
+# Arrays of a GeneralizationAcrossTime object that are stored separately from
+# the 'decod' pickle, so that they can be memory-mapped and partially read.
+decod_fields = ['y_pred_', 'scores_', 'train_times_', 'test_times_',
+                'y_true_', 'sel']
+
+
+def _get_decod_field(gat, sel, field):
+    """Aux. function to retrieve one storable array of a 'decod' result"""
+    if field == 'sel':
+        value = sel
+    elif field in ['train_times_', 'test_times_']:
+        value = getattr(gat, field, dict()).get('times', None)
+    else:
+        value = getattr(gat, field, None)
+    if value is None:
+        return None
+    value = np.asarray(value)
+    # irregular GAT (e.g. list of list of different lengths) cannot be mapped
+    if value.dtype == object:
+        return None
+    return value
+
+
+def _download_if_exists(fname):
+    """Download optional files, which may not have been saved online"""
+    if manifest.exists(fname, where='remote', strict=True):
+        client.download(fname)
+
+
+def _save_decod_arrays(gat, sel, folder):
+    """Save each array of a GeneralizationAcrossTime in a separate .npy file.
+
+    Returns the list of fields that have been saved."""
+    if not op.exists(folder):
+        os.makedirs(folder)
+    saved = list()
+    for field in decod_fields:
+        value = _get_decod_field(gat, sel, field)
+        fname = op.join(folder, '%s.npy' % field)
+        client.release(fname)  # detach it from the download cache
+        if value is None:
+            if op.exists(fname):  # remove obsolete array
+                os.remove(fname)
+            continue
+        # write then rename, so that a currently memory-mapped version of the
+        # same file remains valid
+        with open(fname + '.tmp', 'wb') as f:
+            np.save(f, value)
+        os.rename(fname + '.tmp', fname)
+        saved.append(field)
+    return saved
+
+
+def _diagonal_index(folder, download):
+    """Aux. function to find the testing time equal to each training time"""
+    times = _load_decod_arrays(folder, ['train_times_', 'test_times_'],
+                               download=download)
+    train_times, test_times = times['train_times_'], times['test_times_']
+    if train_times is None or test_times is None:
+        raise ValueError('The diagonal of %s cannot be read without its '
+                         'training and testing times' % folder)
+    index = list()
+    for train_time, these_times in zip(train_times, test_times):
+        match = np.where(np.isclose(these_times, train_time))[0]
+        if not len(match):
+            raise ValueError('The training time %s is not tested in %s' % (
+                             train_time, folder))
+        index.append(match[0])
+    return np.array(index)
+
+
+def _slice_gat_array(array, train_slice, test_slice, diagonal):
+    """Aux. function to read a subset of a (n_train, n_test, ...) array
+    without paging in the rest of the memory-mapped file. diagonal is None,
+    or the testing index of each training time."""
+    train_idx = np.arange(array.shape[0])[train_slice]
+    if diagonal is not None:
+        # read each diagonal element separately: each of them is contiguous
+        # on disk for a C-ordered (n_train, n_test, n_trials, n_dim) array.
+        return np.array([array[ii, diagonal[ii], ...] for ii in train_idx])
+    if test_slice is None:
+        test_slice = slice(None)
+    if isinstance(train_slice, slice):
+        # basic slicing keeps the memory map; only copy selected data.
+        return np.array(array[train_slice][:, test_slice, ...])
+    return np.array(array[train_idx][:, test_slice, ...])
+
+
+def _load_decod_arrays(folder, fields, train_slice=None, test_slice=None,
+                       diagonal=False, download=True):
+    """Partially read the arrays of a 'decod' result.
+
+    Parameters
+    ----------
+    folder : str
+        The 'decod_arrays' directory.
+    fields : list of str
+        The arrays to read, amongst ``decod_fields``.
+    train_slice : None | slice | array of int
+        Training times to read in ``y_pred_``, ``scores_``,
+        ``train_times_`` and ``test_times_``.
+    test_slice : None | slice | array of int
+        Testing times to read in ``y_pred_`` and ``scores_``.
+    diagonal : bool
+        If True, only read the elements for which training time == testing
+        time, matched on ``train_times_`` and ``test_times_``: ``y_pred_``
+        then has a shape (n_train, n_trials, n_dim) and ``scores_`` a shape
+        (n_train,). Cannot be combined with ``test_slice``.
+    download : bool
+        Download missing arrays.
+
+    Returns
+    -------
+    out : dict
+        The requested arrays. Arrays that were not saved (e.g. ``y_pred_``
+        discarded to save space) are None.
+    """
+    train_slice = slice(None) if train_slice is None else train_slice
+    if diagonal and test_slice is not None:
+        raise ValueError('test_slice cannot be used with diagonal=True')
+    index = None
+    if diagonal and any(field in ['y_pred_', 'scores_'] for field in fields):
+        index = _diagonal_index(folder, download)
+    out = dict()
+    for field in fields:
+        if field not in decod_fields:
+            raise ValueError('Unknown decod field %s, choose amongst %s' % (
+                             field, decod_fields))
+        fname = op.join(folder, '%s.npy' % field)
+        if not op.exists(fname) and download:
+            _download_if_exists(fname)
+        if not op.exists(fname):
+            out[field] = None
+            continue
+        array = np.load(fname, mmap_mode='r')
+        if field in ['y_pred_', 'scores_']:
+            array = _slice_gat_array(array, train_slice, test_slice, index)
+        elif field in ['train_times_', 'test_times_']:
+            array = np.array(array[train_slice])
+        else:
+            array = np.array(array)
+        out[field] = array
+    return out
+
+
+def _events_version():
+    """Checksum of the conversion of the events, i.e. of the LOAD DATA
+    section of base.py (read_events and its helpers)"""
+    if not hasattr(_events_version, 'version'):
+        import hashlib
+        with open(op.join(op.dirname(op.abspath(__file__)), 'base.py'),
+                  'rb') as f:
+            source = f.read()
+        source = source[source.index(b'# LOAD DATA'):]
+        _events_version.version = hashlib.sha1(source).hexdigest()[:10]
+    return _events_version.version
+
+
+def _read_behavior(fname):
+    """Events of a behavioral file. The converted events are cached as
+    columnar arrays, keyed by the checksum of the .mat file and by the
+    version of the conversion."""
+    from pandas import DataFrame
+    cache = op.join(data_path, '.cache', 'events', '%s_%s.npz' % (
+                    file_hash(fname), _events_version()))
+    if op.exists(cache):
+        columns = np.load(cache)
+        try:
+            names = list(columns['columns'])
+            return DataFrame(dict((name, columns['column_%s' % name])
+                                  for name in names), columns=names)
+        finally:
+            columns.close()
+    from base import read_events
+    events = read_events(fname)
+    if not op.exists(op.dirname(cache)):
+        os.makedirs(op.dirname(cache))
+    columns = dict(('column_%s' % name, np.asarray(events[name]))
+                   for name in events.columns)
+    # atomic write, as several processes can read the same subject
+    with open(cache + '.tmp%i' % os.getpid(), 'wb') as f:
+        np.savez(f, columns=np.array(events.columns, str), **columns)
+    os.rename(cache + '.tmp%i' % os.getpid(), cache)
+    return events
+
+
+def _mmap_fnames(fname, prepare=None):
+    """Sidecar files of the memory-mapped epochs: data and metadata. Each
+    preparation of the epochs has its own sidecars."""
+    root = op.splitext(fname)[0]
+    if prepare:
+        import hashlib
+        key = repr([(step, sorted(value.items()) if isinstance(value, dict)
+                     else value) for step, value in sorted(prepare.items())])
+        root += '-' + hashlib.sha1(key.encode()).hexdigest()[:8]
+    return root + '.npy', root + '-info.pickle'
+
+
+def _clear_mmap(fname):
+    """Remove the sidecar files of the memory-mapped epochs, if any, for all
+    their preparations"""
+    import glob
+    root = op.splitext(fname)[0]
+    for pattern in [root, root + '-' + '[0-9a-f]' * 8]:
+        for sidecar in (glob.glob(pattern + '.npy') +
+                        glob.glob(pattern + '-info.pickle')):
+            os.remove(sidecar)
+
+
+def _has_mmap(fname, prepare=None):
+    """Check whether the sidecar files exist and are up to date"""
+    fname_data, fname_info = _mmap_fnames(fname, prepare)
+    if not (op.exists(fname_data) and op.exists(fname_info)):
+        return False
+    if op.exists(fname):
+        return op.getmtime(fname_data) >= op.getmtime(fname)
+    return True
+
+
+def _write_mmap(fname, prepare=None):
+    """Read the FIF epochs once, apply the preparation steps, and store their
+    data in a float32 trial x channel x time .npy file, and the rest of the
+    Epochs object (info, events...) in a pickle."""
+    from mne import read_epochs
+    fname_data, fname_info = _mmap_fnames(fname, prepare)
+    epochs = read_epochs(fname, preload=True)
+    # the baseline is computed before the time window is cropped
+    prepare = dict() if prepare is None else prepare
+    if prepare.get('baseline') is not None:
+        epochs.apply_baseline(prepare['baseline'])
+    if prepare.get('picks') is not None:
+        epochs.pick_types(**prepare['picks'])
+    if prepare.get('crop') is not None:
+        epochs.crop(*prepare['crop'])
+    # other processes of the node may be writing the same files
+    suffix = '.%i.tmp' % os.getpid()
+    with open(fname_data + suffix, 'wb') as f:
+        np.save(f, epochs._data.astype(np.float32))
+    data, epochs._data = epochs._data, None
+    with open(fname_info + suffix, 'wb') as f:
+        pickle.dump(epochs, f)
+    epochs._data = data
+    os.rename(fname_data + suffix, fname_data)
+    os.rename(fname_info + suffix, fname_info)
+
+
+def _read_mmap(fname, mmap_mode='r', prepare=None):
+    """Return the Epochs whose data is memory mapped from the .npy sidecar,
+    so that the processes of the same node share the page cache."""
+    fname_data, fname_info = _mmap_fnames(fname, prepare)
+    with open(fname_info, 'rb') as f:
+        epochs = pickle.load(f)
+    epochs._data = np.load(fname_data, mmap_mode=mmap_mode)
+    epochs.preload = True
+    return epochs
+
+
 def load(typ, subject='fsaverage', analysis='analysis', block=999,
-         download=True, preload=False):
-    """Auxiliary saving function."""
+         download=True, preload=False, fields=None, train_slice=None,
+         test_slice=None, diagonal=False, mmap=False, prepare=None):
+    """Auxiliary saving function.
+
+    For 'decod' results, ``fields`` can be used to only read some arrays
+    (see ``decod_fields``) of the GeneralizationAcrossTime object, optionally
+    restricted to ``train_slice``, ``test_slice`` or to the ``diagonal``.
+    A dict of arrays is then returned instead of the pickled objects.
+
+    For epochs, ``mmap=True`` returns preloaded epochs whose data are
+    memory-mapped read-only from a .npy file written on first load. The data
+    are stored in float32, whatever the precision of the FIF file. Methods
+    modifying the data (e.g. ``pick_types``, ``crop``, ``apply_baseline``)
+    copy them in the private memory of the process: they are instead applied
+    once before the .npy file is written, with ``prepare``, a dict of the
+    optional steps 'baseline' (applied first, on all time samples), 'picks'
+    (the arguments of ``pick_types``) and 'crop' (tmin, tmax). Use
+    ``mmap='c'`` (copy-on-write) if the data must still be modified in
+    place."""
     # get file name
     fname = paths(typ, subject=subject, analysis=analysis, block=block)
 
+    # memory-mapped epochs: the FIF file is only parsed once
+    if mmap and typ in ['epo_block', 'epochs', 'epochs_decim', 'epochs_vhp']:
+        if not _has_mmap(fname, prepare):
+            if not op.exists(fname) and download:
+                client.download(fname)
+            _write_mmap(fname, prepare)
+        return _read_mmap(fname, 'r' if mmap is True else mmap, prepare)
+
+    # partial reading of decoding results, without unpickling the GAT
+    if typ == 'decod' and fields is not None:
+        folder = paths('decod_arrays', subject=subject, analysis=analysis)
+        return _load_decod_arrays(folder, fields, train_slice=train_slice,
+                                  test_slice=test_slice, diagonal=diagonal,
+                                  download=download)
+
     # check if file exists
     if not op.exists(fname) and download:
         client.download(fname)
-
-    # different data format depending file type
-    if typ == 'behavior':
-        from base import read_events
-        out = read_events(fname)
-    elif typ == 'sss':
-        out = Raw(fname, preload=preload)
-    elif typ in ['epo_block', 'epochs', 'epochs_decim', 'epochs_vhp']:
-        out = read_epochs(fname, preload=preload)
-    elif typ in ['cov']:
-        from mne.cov import read_cov
-        out = read_cov(fname)
-    elif typ in ['fwd']:
-        from mne import read_forward_solution
-        out = read_forward_solution(fname, surf_ori=True)
-    elif typ in ['inv']:
-        from mne.minimum_norm import read_inverse_operator
-        out = read_inverse_operator(fname)
-    elif typ in ['evoked', 'decod', 'decod_tfr', 'score', 'score_tfr',
-                 'evoked_source']:
-        with open(fname, 'rb') as f:
-            out = pickle.load(f)
-    elif typ == 'morph':
-        from scipy.sparse import csr_matrix
-        loader = np.load(fname)
-        out = csr_matrix((loader['data'], loader['indices'], loader['indptr']),
-                         shape=loader['shape'])
-    elif typ in ['score_source', 'score_pval']:
-        out = np.load(fname)
     else:
-        raise NotImplementedError()
+        client.touch(fname)
+
+    # different data format depending file type; the file cannot be evicted
+    # from the cache while it is being read.
+    with client.pinned(fname):
+        if typ == 'behavior':
+            out = _read_behavior(fname)
+        elif typ == 'sss':
+            from mne.io import Raw
+            out = Raw(fname, preload=preload)
+        elif typ in ['epo_block', 'epochs', 'epochs_decim', 'epochs_vhp']:
+            from mne import read_epochs
+            out = read_epochs(fname, preload=preload)
+        elif typ in ['cov']:
+            from mne.cov import read_cov
+            out = read_cov(fname)
+        elif typ in ['fwd']:
+            from mne import read_forward_solution
+            out = read_forward_solution(fname, surf_ori=True)
+        elif typ in ['inv']:
+            from mne.minimum_norm import read_inverse_operator
+            out = read_inverse_operator(fname)
+        elif typ in ['evoked', 'decod', 'decod_tfr', 'score', 'score_tfr',
+                     'evoked_source']:
+            with open(fname, 'rb') as f:
+                out = pickle.load(f)
+            if typ == 'decod' and getattr(out[0], 'y_pred_', None) is None:
+                # y_pred_ is stored separately: map it lazily from the disk
+                folder = paths('decod_arrays', subject=subject,
+                               analysis=analysis)
+                fname_pred = op.join(folder, 'y_pred_.npy')
+                if not op.exists(fname_pred) and download:
+                    _download_if_exists(fname_pred)
+                if op.exists(fname_pred):
+                    out[0].y_pred_ = np.load(fname_pred, mmap_mode='r')
+        elif typ == 'morph':
+            from scipy.sparse import csr_matrix
+            loader = np.load(fname)
+            out = csr_matrix((loader['data'], loader['indices'],
+                              loader['indptr']), shape=loader['shape'])
+        elif typ in ['score_source', 'score_pval']:
+            out = np.load(fname)
+        elif typ == 'group_stats':
+            with open(fname, 'rb') as f:
+                out = pickle.load(f)
+        else:
+            raise NotImplementedError()
     return out
 
 
@@ -143,11 +515,28 @@ def save(var, typ, subject='fsaverage', analysis='analysis', block=999,
     if op.exists(fname) and not overwrite:
         print('%s already exists. Skipped' % fname)
         return False
+    # a downloaded file is a hard link to the cached content: detach it
+    client.release(fname)
 
     # different data format depending file type
     if typ in ['epo_block', 'epochs', 'epochs_decim', 'cov', 'epochs_vhp']:
         var.save(fname)
-    elif typ in ['evoked', 'decod', 'decod_tfr', 'score', 'score_tfr',
+        _clear_mmap(fname)
+    elif typ == 'decod':
+        # store the arrays separately, and pickle the rest without y_pred_
+        gat, sel = var[0], var[2]
+        folder = paths('decod_arrays', subject=subject, analysis=analysis)
+        saved = _save_decod_arrays(gat, sel, folder)
+        y_pred = getattr(gat, 'y_pred_', None)
+        if 'y_pred_' in saved:
+            gat.y_pred_ = None
+        try:
+            with open(fname, 'wb') as f:
+                pickle.dump(var, f)
+        finally:
+            if 'y_pred_' in saved:
+                gat.y_pred_ = y_pred
+    elif typ in ['evoked', 'decod_tfr', 'score', 'score_tfr',
                  'evoked_source']:
         with open(fname, 'wb') as f:
             pickle.dump(var, f)
@@ -162,8 +551,83 @@ def save(var, typ, subject='fsaverage', analysis='analysis', block=999,
                  indptr=var.indptr, shape=var.shape)
     elif typ in ['score_source', 'score_pval']:
         np.save(fname, var)
+    elif typ == 'group_stats':
+        # large arrays: binary protocol
+        with open(fname, 'wb') as f:
+            pickle.dump(var, f, pickle.HIGHEST_PROTOCOL)
     else:
         raise NotImplementedError()
     if upload:
         client.upload(fname)
+        if typ == 'decod':
+            client.upload(folder)
+    manifest.record(fname, version=_producer_version(), remote=upload)
+    if typ == 'decod':
+        # the arrays are read separately: index them too
+        for field in saved:
+            manifest.record(op.join(folder, '%s.npy' % field),
+                            version=_producer_version(), remote=upload)
     return True
+
+
+def prefetch_subjects(subjects, load_subject, n_ahead=1):
+    """Iterate over subjects while loading the next ones in the background.
+
+    The data of the next subjects (e.g. epochs, behavior, inverse operator)
+    are read and downloaded by a thread while the current subject is being
+    analyzed.
+
+    Parameters
+    ----------
+    subjects : list
+        The subjects to iterate over.
+    load_subject : function
+        Function returning the data of a subject: load_subject(subject).
+    n_ahead : int
+        Maximum number of subjects loaded in advance, to bound the memory
+        usage: at most n_ahead + 1 subjects are in memory.
+
+    Yields
+    ------
+    subject : int | str
+        The subject.
+    data : object
+        The output of load_subject(subject).
+    """
+    import sys
+    import threading
+    try:
+        from Queue import Queue
+    except ImportError:  # Python 3
+        from queue import Queue
+    subjects = list(subjects)
+    slots = threading.Semaphore(n_ahead + 1)
+    stop = threading.Event()
+    queue = Queue()
+
+    def _producer():
+        for subject in subjects:
+            slots.acquire()
+            if stop.is_set():
+                return
+            try:
+                queue.put((subject, load_subject(subject), None))
+            except Exception:
+                queue.put((subject, None, sys.exc_info()))
+                return
+
+    thread = threading.Thread(target=_producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        for _ in subjects:
+            subject, data, error = queue.get()
+            if error is not None:
+                raise error[1]
+            yield subject, data
+            del data  # release the memory before loading another subject
+            slots.release()
+    finally:
+        # e.g. break in the loop: stop loading
+        stop.set()
+        slots.release()
@@ -0,0 +1,10 @@
+# Author: Jean-Remi King <jeanremi.king@gmail.com>
+#
+# Licence: BSD 3-clause
+
+"""The scripts import each other as top-level modules (e.g. config), which
+the tests do too"""
+import os.path as op
+import sys
+
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
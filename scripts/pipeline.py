@@ -0,0 +1,457 @@
+# Author: Jean-Remi King <jeanremi.king@gmail.com>
+#
+# Licence: BSD 3-clause
+
+"""Run the analyses as a graph of tasks, and only recompute the tasks whose
+code, parameters or inputs changed since their last run.
+
+Each task declares its inputs and outputs as config.paths types. Its
+signature hashes its source code, its parameters (e.g. the analysis
+dict, including its estimator, cv and scorer) and the signatures of the
+tasks producing its inputs. A task is recomputed when its signature differs
+from the one stamped at its last run, or when one of its outputs is missing,
+and so are the tasks which depend on it. Independent tasks (e.g. subject x
+analysis) run in parallel processes.
+
+Usage: python pipeline.py [--dry-run] [--n-jobs N] [--only PATTERN]
+"""
+import os
+import os.path as op
+import json
+import inspect
+import hashlib
+import fnmatch
+import numpy as np
+
+
+# Hashing #####################################################################
+
+
+def _hash(obj):
+    """Deterministic hash of the parameters of a task"""
+    sha1 = hashlib.sha1()
+
+    def _update(obj):
+        if isinstance(obj, dict):
+            sha1.update(b'{')
+            for key in sorted(obj.keys(), key=str):
+                _update(key)
+                _update(obj[key])
+            sha1.update(b'}')
+        elif isinstance(obj, (list, tuple)):
+            sha1.update(b'[')
+            for item in obj:
+                _update(item)
+            sha1.update(b']')
+        elif isinstance(obj, np.ndarray):
+            sha1.update(str(obj.dtype).encode() + str(obj.shape).encode())
+            sha1.update(np.ascontiguousarray(obj).tobytes())
+        elif inspect.isfunction(obj) or inspect.isclass(obj):
+            # functions, e.g. scorers, are identified by their source code
+            try:
+                sha1.update(inspect.getsource(obj).encode())
+            except (IOError, TypeError):
+                sha1.update(('%s.%s' % (obj.__module__, obj.__name__)
+                             ).encode())
+        elif hasattr(obj, 'get_params'):
+            # sklearn estimators, e.g. clf and cv
+            sha1.update(type(obj).__name__.encode())
+            _update(obj.get_params(deep=False))
+        elif hasattr(obj, '__dict__'):
+            # the default repr of other objects contains their address
+            sha1.update(type(obj).__name__.encode())
+            _update(vars(obj))
+        else:
+            sha1.update(repr(obj).encode())
+
+    _update(obj)
+    return sha1.hexdigest()
+
+
+def _source(module, name=None):
+    """Source of a script, of one of its top-level definitions (e.g.
+    'fit_gat') or of one of its sections (e.g. 'DECODING' for the lines
+    from '# DECODING ####' to the next section)"""
+    # scripts are located but not imported, as most run on import
+    with open(op.join(op.dirname(op.abspath(__file__)), module + '.py'),
+              'rb') as f:
+        source = f.read().decode('utf-8')
+    if name is None:
+        return source
+    lines = source.splitlines(True)
+    if name.isupper():
+        starts = [ii for ii, line in enumerate(lines)
+                  if line.startswith('# %s #' % name)]
+        ends = [ii for ii, line in enumerate(lines)
+                if line.startswith('# ') and line.rstrip().endswith('####')]
+    else:
+        starts = [ii for ii, line in enumerate(lines)
+                  if line.startswith(('def %s(' % name, 'class %s(' % name))]
+        # the definition ends with the next unindented line
+        ends = [ii for ii, line in enumerate(lines)
+                if line.strip() and not line[0].isspace()]
+    if not len(starts):
+        raise ValueError('%s not found in %s.py' % (name, module))
+    ends = [ii for ii in ends if ii > starts[0]] + [len(lines)]
+    return ''.join(lines[starts[0]:ends[0]])
+
+
+def _hash_code(func, modules=()):
+    """Hash the source of a function and of the scripts it relies on. A
+    module can be restricted to some of its definitions or sections with
+    'module:name'."""
+    sha1 = hashlib.sha1(inspect.getsource(func).encode())
+    for module in modules:
+        sha1.update(_source(*module.split(':')).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+# Graph #######################################################################
+
+
+class Task(object):
+    """A node of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Unique identifier, e.g. 'decoding/s1/target_present'.
+    func : function
+        Module-level function called with args to compute the outputs.
+    args : tuple
+        Arguments of func.
+    inputs : list of (typ, dict)
+        The config.paths type and keyword arguments of each input file.
+    outputs : list of (typ, dict)
+        The config.paths type and keyword arguments of each output file.
+    optional : list of (typ, dict)
+        Output files which are not always produced (e.g. statistics without
+        enough subjects): the task is not recomputed when they are missing.
+    params : None | object
+        Parameters on which the results depend in addition to args, e.g.
+        the analysis dict.
+    code : list of str
+        The scripts (e.g. 'run_decoding') whose source code determines the
+        results in addition to func. 'module:name' only considers a
+        top-level definition (e.g. 'base:fit_gat') or a section (e.g.
+        'base:DECODING') of the script.
+    """
+
+    def __init__(self, name, func, args=(), inputs=(), outputs=(),
+                 optional=(), params=None, code=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.optional = list(optional)
+        self.params = params
+        self.code = tuple(code)
+
+    def __repr__(self):
+        return '<Task %s>' % self.name
+
+
+def _file_key(typ, kwargs):
+    return (typ,) + tuple(sorted(kwargs.items()))
+
+
+class Pipeline(object):
+    """Graph of tasks, linked by the files they produce and read.
+
+    Parameters
+    ----------
+    stamp_dir : None | str
+        Directory in which the signature of each computed task is stored.
+        Defaults to the cache of the data path.
+    """
+
+    def __init__(self, stamp_dir=None):
+        if stamp_dir is None:
+            from config import data_path
+            stamp_dir = op.join(data_path, '.cache', 'pipeline')
+        self.stamp_dir = stamp_dir
+        self.tasks = list()
+        self._producers = dict()
+
+    def add(self, task):
+        """Add a task; its outputs must not be produced by another task"""
+        for typ, kwargs in task.outputs + task.optional:
+            key = _file_key(typ, kwargs)
+            if key in self._producers:
+                raise ValueError('%s is produced by both %s and %s' % (
+                    key, self._producers[key].name, task.name))
+            self._producers[key] = task
+        self.tasks.append(task)
+        return task
+
+    def dependencies(self, task):
+        """Tasks producing the inputs of a task. Other inputs (e.g. raw data)
+        are assumed to be fixed."""
+        deps = list()
+        for typ, kwargs in task.inputs:
+            producer = self._producers.get(_file_key(typ, kwargs))
+            if producer is not None and producer not in deps:
+                deps.append(producer)
+        return deps
+
+    def _waves(self):
+        """Sort the tasks in successive groups of independent tasks"""
+        level = dict()
+
+        def _level(task, stack=()):
+            if task.name in stack:
+                raise ValueError('Cyclic dependency: %s' % ' > '.join(
+                    stack + (task.name,)))
+            if task.name not in level:
+                deps = self.dependencies(task)
+                level[task.name] = 1 + max(
+                    [_level(dep, stack + (task.name,)) for dep in deps] +
+                    [-1])
+            return level[task.name]
+
+        for task in self.tasks:
+            _level(task)
+        waves = [list() for _ in range(max(level.values()) + 1)]
+        for task in self.tasks:
+            waves[level[task.name]].append(task)
+        return waves
+
+    # Signatures --------------------------------------------------------------
+
+    def signatures(self):
+        """Signature of each task, which changes with its code, its
+        parameters and the signatures of its dependencies"""
+        signatures = dict()
+        code = dict()
+        for wave in self._waves():
+            for task in wave:
+                key = (task.func, task.code)
+                if key not in code:
+                    code[key] = _hash_code(task.func, task.code)
+                signatures[task.name] = _hash([
+                    task.func.__name__, code[key], task.args, task.params,
+                    task.inputs, task.outputs, task.optional,
+                    [signatures[dep.name] for dep in self.dependencies(task)]])
+        return signatures
+
+    def _stamp(self, task):
+        return op.join(self.stamp_dir, task.name.replace('/', '_') + '.json')
+
+    def _read_stamp(self, task):
+        fname = self._stamp(task)
+        if not op.exists(fname):
+            return None
+        with open(fname, 'r') as f:
+            return json.load(f)['signature']
+
+    def _write_stamp(self, task, signature):
+        if not op.exists(self.stamp_dir):
+            os.makedirs(self.stamp_dir)
+        fname = self._stamp(task)
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(dict(name=task.name, signature=signature), f)
+        os.rename(fname + '.tmp', fname)
+
+    def _exists(self, typ, kwargs):
+        from config import exists
+        return exists(typ, **kwargs)
+
+    def outdated(self, signatures=None):
+        """Names of the tasks which need to be (re)computed: those whose
+        signature changed or whose outputs are missing, and the tasks
+        depending on them"""
+        signatures = self.signatures() if signatures is None else signatures
+        outdated = list()
+        for wave in self._waves():
+            for task in wave:
+                if (self._read_stamp(task) != signatures[task.name] or
+                        any(dep.name in outdated
+                            for dep in self.dependencies(task)) or
+                        not all(self._exists(typ, kwargs)
+                                for typ, kwargs in task.outputs)):
+                    outdated.append(task.name)
+        return [task.name for task in self.tasks if task.name in outdated]
+
+    # Execution ---------------------------------------------------------------
+
+    def run(self, n_jobs=1, only=None, dry_run=False):
+        """Compute the outdated tasks, wave by wave.
+
+        Parameters
+        ----------
+        n_jobs : int
+            Number of tasks computed in parallel processes.
+        only : None | str
+            fnmatch pattern of the names of the tasks to consider, e.g.
+            'decoding/*'.
+        dry_run : bool
+            If True, only print the outdated tasks.
+
+        Returns
+        -------
+        computed : list of str
+            The names of the computed tasks.
+        """
+        signatures = self.signatures()
+        outdated = self.outdated(signatures)
+        if only is not None:
+            outdated = [name for name in outdated
+                        if fnmatch.fnmatch(name, only)]
+        if dry_run:
+            for name in outdated:
+                print('outdated: %s' % name)
+            return outdated
+
+        pool = None
+        if n_jobs != 1 and len(outdated) > 1:
+            from multiprocessing import Pool
+            pool = Pool(None if n_jobs == -1 else n_jobs)
+        computed, failed = list(), dict()
+        try:
+            for wave in self._waves():
+                todo = list()
+                for task in wave:
+                    if task.name not in outdated:
+                        continue
+                    # do not compute tasks whose dependencies failed
+                    failed_deps = [dep.name for dep in self.dependencies(task)
+                                   if dep.name in failed]
+                    if len(failed_deps):
+                        failed[task.name] = 'failed dependency %s' % (
+                            failed_deps[0])
+                        continue
+                    todo.append(task)
+                calls = [(task.func, task.args) for task in todo]
+                if pool is None:
+                    errors = [_call(call) for call in calls]
+                else:
+                    errors = pool.map(_call, calls, chunksize=1)
+                for task, error in zip(todo, errors):
+                    if error is None:
+                        self._write_stamp(task, signatures[task.name])
+                        computed.append(task.name)
+                    else:
+                        failed[task.name] = error
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if len(failed):
+            raise RuntimeError('%i tasks failed:\n%s' % (
+                len(failed), '\n'.join('%s: %s' % item
+                                       for item in sorted(failed.items()))))
+        return computed
+
+
+def _call(call):
+    """Compute a task in a worker, and return the error if any"""
+    func, args = call
+    try:
+        func(*args)
+        # the task fails if its outputs could not be uploaded
+        from config import client
+        client.flush()
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return '%s: %s' % (type(e).__name__, e)
+
+
+# Stages ######################################################################
+
+
+def epoch_raw(subject, block):
+    from run_preprocessing import _epoch_raw
+    _epoch_raw(subject, block, overwrite=True)
+
+
+def concatenate_epochs(subject):
+    from run_preprocessing import _concatenate_epochs, _check_epochs
+    _concatenate_epochs(subject, overwrite=True)
+    _check_epochs(subject)
+
+
+def decimate_epochs(subject):
+    from run_preprocessing import _decimate_epochs
+    _decimate_epochs(subject, overwrite=True)
+
+
+def decoding(subject, name):
+    from run_decoding import run_decoding
+    from conditions import analyses
+    run_decoding(subject, [a for a in analyses if a['name'] == name][0])
+
+
+def stats_decoding(name):
+    from run_stats_decoding import run_stats_decoding
+    from conditions import analyses
+    run_stats_decoding([a for a in analyses if a['name'] == name][0])
+
+
+def build_pipeline(stamp_dir=None):
+    """Declare the preprocessing, decoding and decoding statistics stages"""
+    from config import subjects
+    from conditions import analyses
+    blocks = range(1, 6)
+    pipeline = Pipeline(stamp_dir=stamp_dir)
+    for subject in subjects:
+        subj = dict(subject=subject)
+        for block in blocks:
+            pipeline.add(Task(
+                'epoch_raw/s%i/%i' % (subject, block), epoch_raw,
+                args=(subject, block), code=['run_preprocessing'],
+                inputs=[('sss', dict(subject=subject, block=block))],
+                outputs=[('epo_block', dict(subject=subject, block=block))]))
+        pipeline.add(Task(
+            'concatenate_epochs/s%i' % subject, concatenate_epochs,
+            args=(subject,), code=['run_preprocessing'],
+            inputs=[('epo_block', dict(subject=subject, block=block))
+                    for block in blocks] + [('behavior', subj)],
+            outputs=[('epochs', subj)]))
+        pipeline.add(Task(
+            'decimate_epochs/s%i' % subject, decimate_epochs,
+            args=(subject,), code=['run_preprocessing'],
+            inputs=[('epochs', subj)],
+            outputs=[('epochs_decim', subj)]))
+
+    for analysis in analyses:
+        name = analysis['name']
+        # the results depend on the whole definition of the analysis
+        params = analysis.definition()
+        for subject in subjects:
+            subj = dict(subject=subject, analysis=name)
+            pipeline.add(Task(
+                'decoding/s%i/%s' % (subject, name), decoding,
+                args=(subject, name), params=params,
+                # the estimators are built by conditions, fitted and scored
+                # by the decoding section of base, and the data are read by
+                # config
+                code=['run_decoding', 'base:DECODING', 'base:SelectionIndex',
+                      'base:selection_index', 'conditions:_make_clf',
+                      'config:load', 'config:_read_mmap', 'config:_write_mmap',
+                      'config:_read_behavior'],
+                inputs=[('epochs_decim', dict(subject=subject)),
+                        ('behavior', dict(subject=subject))],
+                outputs=[('decod', subj), ('score', subj)]))
+        pipeline.add(Task(
+            'stats_decoding/%s' % name, stats_decoding, args=(name,),
+            params=params, code=['run_stats_decoding', 'base'],
+            inputs=[('score', dict(subject=subject, analysis=name))
+                    for subject in subjects],
+            outputs=[('group_stats', dict(analysis=name))],
+            # not saved when there are not enough subjects
+            optional=[('score', dict(analysis='stats_' + name))]))
+    return pipeline
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--only', default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    computed = build_pipeline().run(n_jobs=args.n_jobs, only=args.only,
+                                    dry_run=args.dry_run)
+    print('%i tasks' % len(computed))
@@ -8,7 +8,7 @@ whose orientation is correlated to the target's"""
 import numpy as np
 from jr.stats import circ_tuning, circ_mean, corr_circular_linear
 from config import load, save, subjects
-from base import stats
+from base import stats, stats_many
 from conditions import tois
 
 
@@ -200,18 +200,17 @@ for ii, train_analysis in enumerate(['target_circAngle', 'probe_circAngle']):
 
 # test significance of target versus probe train test
 # for biases (signed values)
+# and for accuracy (absolute values), all maps sharing the permutations
 results['bias_pval'] = np.zeros_like((results['bias'][0]))
-for ii in range(2):
-    for jj in range(2):
-        scores = results['bias'][:, ii, jj, :, :]
-        results['bias_pval'][ii, jj, :, :] = stats(scores)
-
-# for accuracy (absolute values)
 results['target_probe_pval'] = np.zeros((n_time, n_time, 2, 2))
-for ii in range(2):
-    for jj in range(2):
-        results['target_probe_pval'][:, :, ii, jj] = stats(
-            results['accuracy'][:, ii, jj, :, :])
+pairs = [(ii, jj) for ii in range(2) for jj in range(2)]
+p_values = stats_many(
+    [results['bias'][:, ii, jj, :, :] for ii, jj in pairs] +
+    [results['accuracy'][:, ii, jj, :, :] for ii, jj in pairs])
+for (ii, jj), p_bias, p_accuracy in zip(pairs, p_values[:len(pairs)],
+                                        p_values[len(pairs):]):
+    results['bias_pval'][ii, jj, :, :] = p_bias
+    results['target_probe_pval'][:, :, ii, jj] = p_accuracy
 
 # load absent target prediction to perform the control analysis of virtual
 # biases
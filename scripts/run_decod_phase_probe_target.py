@@ -9,7 +9,7 @@ extremely tiny"""
 import numpy as np
 from jr.gat import subscore
 from jr.plot import pretty_decod
-from base import stats
+from base import stats, selection_index, predict_gat
 from config import load, save, subjects
 from conditions import analyses
 
@@ -19,15 +19,12 @@ toi = [-.100, .305]
 scores = list()
 for s, subject in enumerate(subjects):  # Loop across each subject
     print(subject)
-    epochs = load('epochs', subject=subject, preload=True)
+    epochs = load('epochs', subject=subject, mmap=True)
     events = load('behavior', subject=subject)
 
     # select trials
-    query, condition = analysis['query'], analysis['condition']
-    sel = range(len(events)) if query is None \
-        else events.query(query).index
-    sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
-    y = np.array(events[condition], dtype=np.float32)
+    sel = selection_index(events)[analysis['name']]
+    y = np.array(events[analysis['condition']], dtype=np.float32)
 
     # Load classifier
     gat, _, sel_gat, _ = load('decod', subject=subject, analysis='probe_phase')
@@ -38,7 +35,7 @@ for s, subject in enumerate(subjects):  # Loop across each subject
     gat.train_times_['times'] = [gat.train_times_['times'][t] for t in toi_]
     gat.train_times_['slices'] = [gat.train_times_['slices'][t] for t in toi_]
     # predict all trials, including absent to keep cv scheme
-    gat.predict(epochs[sel_gat])
+    predict_gat(gat, epochs[sel_gat])
 
     # subscore on present only
     gat.scores_ = subscore(gat, sel, y[sel])
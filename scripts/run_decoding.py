@@ -7,23 +7,21 @@ separately.
 """
 import numpy as np
 from mne.decoding import GeneralizationAcrossTime
-from config import subjects, load, save
+from config import subjects, load, save, prefetch_subjects
+from base import selection_index, fit_gat, predict_gat, score_gat
 from conditions import analyses
 
 
-def _run(epochs, events, analysis):
+def _run(epochs, events, analysis, subject):
     """Runs temporal generalization for a given subject and analysis"""
     print(subject, analysis['name'])
 
     # subselect the trials (e.g. exclude absent trials) with a
-    # dataframe query defined in conditions.py
-    query, condition = analysis['query'], analysis['condition']
-    sel = range(len(events)) if query is None \
-        else events.query(query).index
-    sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
+    # dataframe query defined in conditions.py, evaluated once per subject
+    sel = selection_index(events)[analysis['name']]
 
     # The to-be-predicted value, for each trial:
-    y = np.array(events[condition], dtype=np.float32)
+    y = np.array(events[analysis['condition']], dtype=np.float32)
 
     print analysis['name'], np.unique(y[sel]), len(sel)
 
@@ -37,9 +35,20 @@ def _run(epochs, events, analysis):
                                    scorer=analysis['scorer'],
                                    n_jobs=-1)
     print(subject, analysis['name'], 'fit')
-    gat.fit(epochs[sel], y=y[sel])
+    fit_gat(gat, epochs[sel], y=y[sel])
     print(subject, analysis['name'], 'score')
-    score = gat.score(epochs[sel], y=y[sel])
+    # We need these individual prediction to control for the correlation
+    # between target and probe angle.
+    keep_y_pred = analysis['name'] in ['target_present', 'target_circAngle',
+                                       'probe_circAngle']
+    if keep_y_pred:
+        # predict in single precision to save space
+        predict_gat(gat, epochs[sel], dtype=np.float32)
+        score = gat.score(y=y[sel])
+    else:
+        # score each block of predictions as soon as it is computed, without
+        # keeping the predictions of all training and testing times
+        score = score_gat(gat, epochs[sel], y=y[sel])
     print(subject, analysis['name'], 'save')
 
     # save space
@@ -47,10 +56,7 @@ def _run(epochs, events, analysis):
         # we'll need the estimator trained on the probe_phase and to generalize
         # to the target phase and prove that there is a significant signal.
         gat.estimators_ = None
-    if analysis['name'] not in ['target_present', 'target_circAngle',
-                                'probe_circAngle']:
-        # We need these individual prediction to control for the correlation
-        # between target and probe angle.
+    if not keep_y_pred:
         gat.y_pred_ = None
 
     # Save analysis
@@ -63,20 +69,36 @@ def _run(epochs, events, analysis):
     return
 
 
-for s, subject in enumerate(subjects):  # Loop across each subject
-    print(subject)
+# the preparation of the epochs, applied before they are memory mapped
+prepare = dict(picks=dict(meg=True, eeg=False, stim=False, eog=False,
+                          ecg=False),
+               crop=(-.1, 1.4))
 
-    # load data
-    epochs = load('epochs_decim', subject=subject, preload=True)
 
-    # only analyze MEG from -100 ms to 1400 ms after target onset
-    epochs.pick_types(meg=True, eeg=False, stim=False, eog=False, ecg=False)
-    epochs.crop(-.1, 1.4)
+def _load(subject):
+    """Load the epochs and the behavior of a subject"""
+    # only analyze MEG from -100 ms to 1400 ms after target onset: the
+    # channels and times are selected before the data are memory mapped,
+    # to be shared by the processes of the node instead of copied
+    epochs = load('epochs_decim', subject=subject, mmap=True, prepare=prepare)
     events = load('behavior', subject=subject)
+    return epochs, events
 
-    # Apply to each analysis (e.g. presence, orientation, ...)
-    for analysis in analyses:
-        _run(epochs, events, analysis)
 
-    # Clear memory
-    del epochs, events
+def run_decoding(subject, analysis):
+    """Decode a single analysis of a subject (see pipeline.py)"""
+    epochs, events = _load(subject)
+    _run(epochs, events, analysis, subject)
+
+
+if __name__ == '__main__':
+    # Loop across each subject, while loading the next one in the background
+    for subject, (epochs, events) in prefetch_subjects(subjects, _load):
+        print(subject)
+
+        # Apply to each analysis (e.g. presence, orientation, ...)
+        for analysis in analyses:
+            _run(epochs, events, analysis, subject)
+
+        # Clear memory
+        del epochs, events
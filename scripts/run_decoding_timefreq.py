@@ -9,7 +9,8 @@ optimally predicts the trials' value from a single time slice.
 import numpy as np
 from jr.gat import TimeFrequencyDecoding
 from mne.decoding import TimeDecoding
-from config import subjects, load, save, client, paths
+from base import selection_index
+from config import subjects, load, save, exists
 from conditions import analyses
 
 
@@ -23,11 +24,8 @@ def _run(epochs, events, analysis):
     decim = slice(start, stop, 8)  # ~62 Hz after TFR
 
     # Select relevant trials (e.g. remove absent trials)
-    query, condition = analysis['query'], analysis['condition']
-    sel = range(len(events)) if query is None \
-        else events.query(query).index
-    sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
-    y = np.array(events[condition], dtype=np.float32)
+    sel = selection_index(events)[analysis['name']]
+    y = np.array(events[analysis['condition']], dtype=np.float32)
 
     print analysis['name'], np.unique(y[sel]), len(sel)
 
@@ -65,8 +63,7 @@ for s, subject in enumerate(subjects):  # Loop across each subject
 
     # Apply to each analysis
     for analysis in analyses:
-        fname = paths('score_tfr', subject=subject, analysis=analysis['name'])
-        if client.metadata(fname)['exist']:
+        if exists('score_tfr', subject=subject, analysis=analysis['name']):
             continue
         if not epochs.preload:
             epochs._data = epochs.get_data()
@@ -18,7 +18,7 @@ from jr.plot import (pretty_plot, pretty_gat, share_clim, pretty_axes,
                      pretty_decod, plot_sem, bar_sem)
 from jr.utils import align_on_diag, table2html
 from config import subjects, load, save, paths, report
-from base import stats
+from base import stats, stats_many
 from conditions import analyses, tois
 
 # Restrict subscore analyses to target presence and target orientation.
@@ -60,9 +60,8 @@ def _subscore_pipeline(analysis):  # FIXME merge with subscore
     all_scores = np.array(all_scores)
 
     # stats
-    pval = list()
-    for vis in range(4):
-        pval.append(stats(all_scores[:, vis, :, :] - analysis['chance']))
+    pval = stats_many([all_scores[:, vis, :, :] - analysis['chance']
+                       for vis in range(4)])
 
     save([all_scores, pval, times],
          'score', analysis=ana_name, overwrite=True, upload=True)
@@ -186,10 +185,13 @@ def _analyze_continuous(analysis):
     R = dict(visibility=np.zeros((n_subject, n_time)),
              contrast=np.zeros((n_subject, n_time)),)
     for s, subject in enumerate(subjects):
-        gat, _, events_sel, events = load('decod', subject=subject,
-                                          analysis=analysis['name'])
-        events = events.iloc[events_sel].reset_index()
-        y_pred = np.transpose(get_diagonal_ypred(gat), [1, 0, 2])[..., 0]
+        # only read the diagonal predictions, not the whole GAT
+        decod = load('decod', subject=subject, analysis=analysis['name'],
+                     fields=['y_pred_', 'train_times_', 'sel'],
+                     diagonal=True)
+        events = load('behavior', subject=subject)
+        events = events.iloc[decod['sel']].reset_index()
+        y_pred = np.transpose(decod['y_pred_'], [1, 0, 2])[..., 0]
         for factor in ['visibility', 'contrast']:
             # subscore per condition (e.g. each visibility rating)
             scores[factor][s, :, :] = _subscore(y_pred, events,
@@ -198,7 +200,7 @@ def _analyze_continuous(analysis):
             R[factor][s, :] = _subregress(y_pred, events,
                                           analysis, factor, True)
 
-    times = gat.train_times_['times']
+    times = decod['train_times_']
     save([scores, R, times], 'score', analysis=ana_name,
          overwrite=True, upload=True)
     return [scores, R, times]
@@ -302,7 +304,10 @@ def _duration_toi(analysis):
             toi = np.where((times >= toi[0]) & (times <= toi[1]))[0]
             score_toi = np.mean(scores[:, toi, :], axis=1)
             all_score_tois[:, vis, t, :] = score_toi
-            all_pval_tois[vis, t, :] = stats(score_toi - analysis['chance'])
+    # the TOIs and visibility levels share the same permutations
+    p_values = stats_many([all_score_tois[:, vis, t, :] - analysis['chance']
+                           for vis in range(4) for t in range(len(tois))])
+    all_pval_tois[...] = np.reshape(p_values, all_pval_tois.shape)
     save([all_score_tois, all_pval_tois, times], 'score', analysis=ana_name)
     return [all_score_tois, all_pval_tois, times]
 
@@ -316,11 +321,10 @@ for analysis in analyses:
     # Plot correlation of decoding score with visibility and contrast
     scores, R, times = _analyze_continuous(analysis)
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=[20, 10])
-    sig = stats(R['visibility']) < .05
-    pretty_decod(-R['visibility'], times=times, sig=sig, ax=ax1,
+    p_vis, p_contrast = stats_many([R['visibility'], R['contrast']])
+    pretty_decod(-R['visibility'], times=times, sig=p_vis < .05, ax=ax1,
                  color='purple', fill=True)
-    sig = stats(R['contrast']) < .05
-    pretty_decod(-R['contrast'], times=times, sig=sig, ax=ax2,
+    pretty_decod(-R['contrast'], times=times, sig=p_contrast < .05, ax=ax2,
                  color='orange', fill=True)
     report.add_figs_to_section([fig], ['continuous regress'], analysis['name'])
 
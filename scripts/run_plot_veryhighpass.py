@@ -14,7 +14,7 @@ from mne import Epochs, find_events, create_info, concatenate_epochs
 from jr.plot import pretty_gat
 from config import load, save, paths, report
 from conditions import analyses
-from base import stats
+from base import stats, selection_index, fit_gat, score_gat
 
 
 def _get_epochs(subject):
@@ -105,10 +105,8 @@ def _decod(subject, analysis):
     epochs.crop(0., .900)
     epochs.decimate(2)
 
-    query, condition = analysis['query'], analysis['condition']
-    sel = range(len(events)) if query is None else events.query(query).index
-    sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
-    y = np.array(events[condition], dtype=np.float32)
+    sel = selection_index(events)[analysis['name']]
+    y = np.array(events[analysis['condition']], dtype=np.float32)
 
     print analysis['name'], np.unique(y[sel]), len(sel)
 
@@ -121,9 +119,10 @@ def _decod(subject, analysis):
                                    scorer=analysis['scorer'],
                                    n_jobs=-1)
     print(subject, analysis['name'], 'fit')
-    gat.fit(epochs[sel], y=y[sel])
+    fit_gat(gat, epochs[sel], y=y[sel])
     print(subject, analysis['name'], 'score')
-    score = gat.score(epochs[sel], y=y[sel])
+    # the predictions are scored by blocks, and not kept
+    score = score_gat(gat, epochs[sel], y=y[sel])
     print(subject, analysis['name'], 'save')
 
     # save space
@@ -130,13 +130,15 @@ def _decimate_epochs(subject, overwrite=True):
     epochs.decimate(10)
     save(epochs, 'epochs_decim', subject=subject, overwrite=True, upload=True)
 
-for subject in range(1, 21):
-    # high pass filter and epoch
-    for block in range(1, 6):
-        _epoch_raw(subject, block, overwrite=False)
-    # concatenate epochs
-    _concatenate_epochs(subject, overwrite=False)
-    # check that match behavioral file
-    _check_epochs(subject)
-    # save decimated copy for ERF analyses
-    _decimate_epochs(subject, overwrite=True)
+
+if __name__ == '__main__':
+    for subject in range(1, 21):
+        # high pass filter and epoch
+        for block in range(1, 6):
+            _epoch_raw(subject, block, overwrite=False)
+        # concatenate epochs
+        _concatenate_epochs(subject, overwrite=False)
+        # check that match behavioral file
+        _check_epochs(subject)
+        # save decimated copy for ERF analyses
+        _decimate_epochs(subject, overwrite=True)
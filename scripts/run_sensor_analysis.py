@@ -3,30 +3,34 @@
 # Licence: BSD 3-clause
 
 """Performs sensor analysis within each subjects separately"""
-from base import nested_analysis
-from config import subjects, load, save
+from base import nested_analyses
+from config import subjects, load, save, prefetch_subjects
 from conditions import analyses
 
-for subject in subjects:
-    print('load %s' % subject)
+# maximum size of the blocks of memory-mapped data read at once
+max_bytes = 1e9
+
 
-    epochs = load('epochs_decim', subject=subject, preload=True)
+def _load(subject):
+    print('load %s' % subject)
+    epochs = load('epochs_decim', subject=subject, mmap=True)
     events = load('behavior', subject=subject)
+    return epochs, events
 
-    # Apply each analysis
-    for analysis in analyses:
-        print(analysis['name'])
 
-        # This functions computes nested contrast and return the effect size
-        # for each level of comparison.
-        # FIXME : This is an overkill here since we only apply 1 level analysis
-        coef, sub = nested_analysis(
-            epochs._data, events, analysis['condition'],
-            function=analysis.get('erf_function', None),
-            query=analysis.get('query', None),
-            single_trial=analysis.get('single_trial', False),
-            y=analysis.get('y', None), n_jobs=-1)
+# the next subject is loaded while the current one is analyzed
+for subject, (epochs, events) in prefetch_subjects(subjects, _load):
+
+    # This functions computes nested contrast and return the effect size
+    # for each level of comparison. The analyses selecting the same trials
+    # share the ranking of the data.
+    # FIXME : This is an overkill here since we only apply 1 level analysis
+    results = nested_analyses(epochs._data, events, analyses, n_jobs=-1,
+                              max_bytes=max_bytes)
 
+    # Save each analysis
+    for analysis, (coef, sub) in zip(analyses, results):
+        print(analysis['name'])
         evoked = epochs.average()
         evoked.data = coef
 
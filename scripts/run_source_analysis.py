@@ -6,10 +6,11 @@
 separately"""
 
 import numpy as np
+from mne import EpochsArray
 from mne.minimum_norm import apply_inverse, apply_inverse_epochs
 
 from conditions import analyses
-from config import load, save, bad_mri, subjects_id
+from config import load, save, bad_mri, subjects_id, prefetch_subjects
 from base import nested_analysis
 
 # params
@@ -18,51 +19,72 @@ inv_params = dict(lambda2=1.0 / (2 ** 3.0),
                   pick_ori='normal',
                   verbose=False)
 
-for meg_subject, subject in zip(range(1, 21), subjects_id):
-    # load single subject effects (across trials)
-    if subject in bad_mri:
-        continue
-    epochs = load('epochs_decim', subject=meg_subject, preload=True)
+
+# maximum size of the single-trial source estimates held in memory
+max_bytes = 2e9
+
+# the preparation of the epochs, applied before they are memory mapped
+prepare = dict(baseline=(None, 0), picks=dict(meg=True, eeg=False, eog=False))
+
+
+def _load(meg_subject):
+    # the baseline and the channels are applied before the data are memory
+    # mapped, to be shared by the processes of the node instead of copied
+    epochs = load('epochs_decim', subject=meg_subject, mmap=True,
+                  prepare=prepare)
     events = load('behavior', subject=meg_subject)
-    epochs.apply_baseline((None, 0))
-    epochs.pick_types(meg=True, eeg=False, eog=False)
+    inv = load('inv', subject=meg_subject)
+    return epochs, events, inv
 
+
+def _stc_blocks(epochs, inv, n_vertices):
+    """Single-trial source estimates, by blocks of time samples fitting in
+    max_bytes. The blocks are sliced on the sample indices, as cropping on
+    their times can drop a sample through rounding."""
+    step = max(1, int(max_bytes // (len(epochs) * n_vertices * 8)))
+    for start in range(0, len(epochs.times), step):
+        block = EpochsArray(epochs._data[:, :, start:start + step],
+                            epochs.info, epochs.events,
+                            tmin=epochs.times[start],
+                            event_id=epochs.event_id, proj=False,
+                            verbose=False)
+        stcs = apply_inverse_epochs(block, inv, **inv_params)
+        yield np.array([stc.data for stc in stcs])
+
+
+# load single subject effects (across trials), the next subject being loaded
+# while the current one is analyzed
+meg_subjects = [meg_subject for meg_subject, subject in
+                zip(range(1, 21), subjects_id) if subject not in bad_mri]
+subjects_data = prefetch_subjects(meg_subjects, _load)
+for meg_subject, (epochs, events, inv) in subjects_data:
     # Setup source data container
     evoked = epochs.average()
-    inv = load('inv', subject=meg_subject)
     stc = apply_inverse(evoked, inv, **inv_params)
 
     # run each analysis within subject
     for analysis in analyses:
-        # source transforming should be applied as early as possible,
-        # but here I'm struggling on memory
-        coefs = list()
-        n_chunk = 20
-        for time in np.array_split(epochs.times, n_chunk):
-            stcs = apply_inverse_epochs(epochs.copy().crop(time[0], time[-1]),
-                                        inv, **inv_params)
-            stcs_data = np.array([ii.data for ii in stcs])
-
-            # then we applied the same function as for the sensor analysis
-            # FIXME this nested_analysis is here an overkill since we only
-            # 1 level analysis
-            coef, sub = nested_analysis(
-                stcs_data, events, analysis['condition'],
-                function=analysis.get('erf_function', None),
-                query=analysis.get('query', None),
-                single_trial=analysis.get('single_trial', False),
-                y=analysis.get('y', None),
-                n_jobs=-1)
-            coefs.append(coef)
-        stc._data = np.hstack(coefs)
+        # source transforming should be applied as early as possible, but
+        # the single trials do not fit in memory: they are streamed by blocks
+        # of time samples through the analysis, whose trial grouping is only
+        # computed once.
+        # FIXME this nested_analysis is here an overkill since we only
+        # 1 level analysis
+        coef, sub = nested_analysis(
+            _stc_blocks(epochs, inv, len(stc.data)), events,
+            analysis['condition'],
+            function=analysis.get('erf_function', None),
+            query=analysis.get('query', None),
+            single_trial=analysis.get('single_trial', False),
+            y=analysis.get('y', None),
+            n_jobs=-1, n_times=len(epochs.times))
+        stc._data = coef
 
         # Save all_evokeds
         save([stc, sub, analysis], 'evoked_source', subject=meg_subject,
              analysis=analysis['name'], overwrite=True)
 
         # Clean memory
-        for ii in stcs:
-            ii._data = None
-        del stcs, stcs_data, coef, sub
+        del coef, sub
     epochs._data = None
     del epochs
@@ -2,43 +2,115 @@
 #
 # Licence: BSD 3-clause
 
-"""Performs stats across subjects of decoding scores fitted within subjects"""
+"""Performs stats across subjects of decoding scores fitted within subjects.
+
+The permutation statistics are stored in a 'group_stats' file per analysis,
+and only updated with the subjects whose scores changed since the last run.
+"""
+import os.path as op
 import numpy as np
-from base import stats
-from config import subjects, load, save
+from base import GroupStats
+from config import subjects, load, save, paths, exists, manifest
 from conditions import analyses
 
-# For each analysis of interest
-for analysis in analyses:
-    # Load decoding results
-    print('load', analysis['name'])
-    scores = list()
+# the three maps share the sign flips of each subject
+maps = ['scores', 'off', 'diag']
+# parameters of the permutations, identical to base.stats
+params = dict(n_permutations=2 ** 12, seed=0, threshold=None, sigma=0.,
+              method='cluster')
+# version of the stored state, to increment when its format changes
+state_version = 1
+
+
+def _maps(score, chance):
+    """Is decoding different from theoretical chance level, and does it
+    differ from the diagonal"""
+    score = np.array(score)
+    diag = np.diag(score)
+    return dict(scores=score - chance, off=score - diag[np.newaxis, :],
+                diag=diag - chance)
+
+
+def _state_key(analysis):
+    """The parameters on which the stored permutation sums depend"""
+    import inspect
+    return dict(params, version=state_version, chance=analysis['chance'],
+                maps=inspect.getsource(_maps))
+
+
+def _stamp(subject, analysis):
+    """Version of the scores of a subject, without reading them"""
+    fname = paths('score', subject=subject, analysis=analysis['name'])
+    if op.exists(fname):
+        return manifest.checksum(fname), op.getsize(fname)
+    entry = manifest.get(fname)
+    if entry is None or entry.get('etag') is None:
+        return None
+    return entry['etag'], entry['remote_bytes']
+
+
+def _load_state(analysis):
+    """Group statistics of the last run, or empty ones"""
+    key = _state_key(analysis)
+    if exists('group_stats', analysis=analysis['name']):
+        state = load('group_stats', analysis=analysis['name'])
+        if state.get('key') == key:
+            return state
+    return dict(key=key, times=None, excluded=dict(),
+                stats=dict((name, GroupStats(**params)) for name in maps))
+
+
+def run_stats_decoding(analysis):
+    """Second level statistics of the decoding scores of an analysis"""
+    state = _load_state(analysis)
+    stats = state['stats']
+    chance = analysis['chance']
+
+    # Update the subjects whose scores changed
+    for subject in set(stats['scores'].maps) - set(subjects):
+        for key in maps:
+            stats[key].remove(subject)
     for subject in subjects:
-        # define path to file to be loaded
+        stamp = _stamp(subject, analysis)
+        if stamp is not None and stamp in (
+                stats['scores'].stamps.get(subject),
+                state['excluded'].get(subject)):
+            continue
+        print('load', analysis['name'], subject)
         score, times = load('score', subject=subject,
                             analysis=analysis['name'])
-        scores.append(score)
+        state['times'] = times
+        if np.isnan(score[0][0]):
+            state['excluded'][subject] = stamp
+            if subject in stats['scores'].maps:
+                for key in maps:
+                    stats[key].remove(subject)
+            continue
+        state['excluded'].pop(subject, None)
+        for key, X in _maps(score, chance).items():
+            stats[key].update(subject, X, stamp)
+    save(state, 'group_stats', analysis=analysis['name'], overwrite=True)
 
-    scores = [sc for sc in scores if not np.isnan(sc[0][0])]
-    if len(scores) < 7:
+    included = [s for s in subjects if s in stats['scores'].maps]
+    if len(included) < 7:
         print('%s: not enough subjects' % analysis['name'])
-        continue
-    chance = analysis['chance']
-    alpha = 0.05
+        return
 
-    # Compute stats: is decoding different from theoretical chance level (using
-    # permutations across subjects)
+    # Compute stats: permutations across subjects
     print('stats', analysis['name'])
-    p_values = stats(np.array(scores) - chance)
-    diag_offdiag = scores - np.tile([np.diag(sc) for sc in scores],
-                                    [len(times), 1, 1]).transpose(1, 0, 2)
-    p_values_off = stats(diag_offdiag)
-
-    scores_diag = [np.diag(sc) for sc in scores]
-    p_values_diag = stats(np.array(scores_diag)[:, :, None] - chance)
+    p_values, p_values_off, p_values_diag = [
+        stats[key].p_values(n_jobs=-1) for key in maps]
 
     # Save stats results
     print('save', analysis['name'])
+    scores = [stats['scores'].maps[subject] + chance for subject in included]
     out = dict(scores=scores, p_values=p_values, p_values_off=p_values_off,
-               times=times, analysis=analysis, p_values_diag=p_values_diag)
+               times=state['times'], analysis=analysis,
+               p_values_diag=p_values_diag)
     save(out, 'score',  analysis=('stats_' + analysis['name']), overwrite=True)
+
+
+if __name__ == '__main__':
+    # For each analysis of interest
+    for analysis in analyses:
+        run_stats_decoding(analysis)
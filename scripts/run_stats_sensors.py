@@ -7,9 +7,9 @@ import numpy as np
 from jr.stats import robust_mean
 import mne
 from mne.epochs import EpochsArray
-from mne.stats import spatio_temporal_cluster_1samp_test as stats
 from mne.channels import read_ch_connectivity
 from config import save, load, subjects
+from base import stats
 from conditions import analyses
 
 # Apply contrast on each type of epoch
@@ -49,12 +49,9 @@ for analysis in analyses:
     epochs.pick_types('mag')
     connectivity, _ = read_ch_connectivity('neuromag306mag')
     X = np.transpose(epochs._data, [0, 2, 1])
-    _, clusters, cl_p_val, _ = stats(
-        X, out_type='mask', n_permutations=2 ** 11,
-        connectivity=connectivity, n_jobs=-1)
-    p_values = np.ones_like(X[0]).T
-    for cluster, pval in zip(clusters, cl_p_val):
-        p_values[cluster.T] = pval
+    # the number of permutations adapts to the p-value of each cluster
+    p_values = stats(X, connectivity=connectivity, n_jobs=-1,
+                     n_permutations='auto').T
     sig = p_values < .05
 
     # Save contrast
@@ -9,7 +9,7 @@ import numpy as np
 from mne import morph_data_precomputed
 from mne import spatial_tris_connectivity, grade_to_tris
 
-from config import load, save, bad_mri, subjects_id
+from config import load, save, exists, bad_mri, subjects_id
 from conditions import analyses
 from base import stats
 
@@ -46,11 +46,8 @@ connectivity = spatial_tris_connectivity(grade_to_tris(5))
 for analysis in analyses:
     print(analysis)
     # don't compute if already on S3
-    try:
-        load('score_pval', subject='fsaverage', analysis=analysis['name'])
+    if exists('score_pval', subject='fsaverage', analysis=analysis['name']):
         continue
-    except Exception:
-        pass
 
     # Retrieve data
     chance = analysis['chance']
@@ -0,0 +1,893 @@
+# Author: Jean-Remi King <jeanremi.king@gmail.com>
+#
+# Licence: BSD 3-clause
+
+"""Local storage layers in front of jr.cloud.Client"""
+import os
+import os.path as op
+import json
+import time
+import errno
+import hashlib
+import shutil
+from contextlib import contextmanager
+
+
+def file_hash(fname, block_size=2 ** 20):
+    """Compute the sha1 checksum of a file, reading it by blocks"""
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _pid_alive(pid):
+    """Check whether a process is still running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+@contextmanager
+def _flock(fname):
+    """Lock a file across the processes of the node"""
+    import fcntl
+    if not op.exists(op.dirname(fname)):
+        os.makedirs(op.dirname(fname))
+    with open(fname, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CachedClient(object):
+    """Content-addressed download cache with a size cap and LRU eviction.
+
+    Downloaded files are stored once per content hash in
+    ``cache_dir/objects`` and hard linked to their usual location in the
+    client root, so that scripts keep reading them from ``config.paths``. The
+    index is shared by all processes of the node. Files must be released
+    (see ``release``) before being written in place, otherwise the cached
+    content would be modified too.
+
+    Parameters
+    ----------
+    client : jr.cloud.Client
+        The client to download from. Other methods (upload, metadata...) are
+        forwarded to it.
+    cache_dir : str
+        Directory of the cache. Must be on the same file system as the client
+        root for the hard links to be possible.
+    max_bytes : None | float
+        Maximum size of the cached files. Least recently used files which are
+        not pinned are removed when exceeded. If None, no limit.
+    """
+
+    def __init__(self, client, cache_dir, max_bytes=None):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # counters of the current process; the index keeps the node's ones
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, attr):
+        # Forward upload, metadata, delete... to the actual client
+        if attr == 'client':
+            raise AttributeError(attr)
+        return getattr(self.client, attr)
+
+    # Index -------------------------------------------------------------------
+
+    def _key(self, fname):
+        return self.client._strip_client_root(fname)
+
+    def _local(self, key):
+        return op.join(self.client.client_root, key)
+
+    def _object(self, sha1):
+        return op.join(self.cache_dir, 'objects', sha1[:2], sha1)
+
+    def _lock(self):
+        """Lock the index across the processes of the node"""
+        return _flock(op.join(self.cache_dir, 'lock'))
+
+    def _read_index(self):
+        fname = op.join(self.cache_dir, 'index.json')
+        if not op.exists(fname):
+            return dict(entries=dict(), pins=dict(),
+                        counters=dict(hits=0, misses=0, evictions=0))
+        with open(fname, 'r') as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        fname = op.join(self.cache_dir, 'index.json')
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(fname + '.tmp', fname)
+
+    def _shares(self, sha1, fname):
+        """Check whether a file is a hard link to a cached object"""
+        return (op.exists(fname) and op.exists(self._object(sha1)) and
+                os.stat(fname).st_ino == os.stat(self._object(sha1)).st_ino)
+
+    def _drop(self, index, sha1):
+        """Remove a cached object which is not used by any entry"""
+        if sha1 in [entry['hash'] for entry in index['entries'].values()]:
+            return
+        if op.exists(self._object(sha1)):
+            os.remove(self._object(sha1))
+
+    def _remote(self, f_server):
+        """Size and checksum of the remote file, to revalidate the cache"""
+        try:
+            metadata = self.client.metadata(f_server)
+        except Exception:  # e.g. offline: trust the cache
+            return None
+        if not metadata.get('exist', True):
+            return None
+        return dict(bytes=metadata.get('bytes'), etag=metadata.get('etag'))
+
+    @staticmethod
+    def _stale(entry, remote):
+        """Check whether the remote file changed since it was cached"""
+        if remote is None:
+            return False
+        if remote['bytes'] is not None and remote['bytes'] != entry['bytes']:
+            return True
+        etag = entry.get('etag')
+        return (None not in (etag, remote['etag']) and
+                etag != remote['etag'])
+
+    def _link(self, sha1, fname):
+        """Make the cached object available at its usual location"""
+        if self._shares(sha1, fname):
+            return
+        if op.exists(fname):
+            os.remove(fname)
+        folder = op.dirname(fname)
+        if not op.exists(folder):
+            os.makedirs(folder)
+        try:
+            os.link(self._object(sha1), fname)
+        except OSError:  # e.g. different file systems
+            shutil.copy2(self._object(sha1), fname)
+
+    # Client ------------------------------------------------------------------
+
+    def download(self, f_server, f_client=None, overwrite=None):
+        """Download a file unless its content is already in the cache.
+
+        The cached content is only used if the size and the checksum of the
+        remote file have not changed since it was downloaded.
+
+        Returns True if the file was downloaded."""
+        key = self._key(f_server)
+        fname = self._local(key) if f_client is None else f_client
+        remote = self._remote(f_server)
+        with self._lock():
+            index = self._read_index()
+            entry = index['entries'].get(key)
+            if entry is not None and op.exists(self._object(entry['hash'])):
+                if not self._stale(entry, remote):
+                    self._link(entry['hash'], fname)
+                    entry['atime'] = time.time()
+                    index['counters']['hits'] += 1
+                    self._write_index(index)
+                    self.hits += 1
+                    return False
+                # re-uploaded: never download over the cached content
+                if self._shares(entry['hash'], fname):
+                    os.remove(fname)
+                overwrite = True
+
+        # Download outside the lock: other processes may use the cache.
+        self.client.download(f_server, f_client=fname, overwrite=overwrite)
+        if not op.exists(fname):  # e.g. offline client
+            return False
+        sha1 = file_hash(fname)
+
+        with self._lock():
+            index = self._read_index()
+            obj = self._object(sha1)
+            if not op.exists(obj):
+                if not op.exists(op.dirname(obj)):
+                    os.makedirs(op.dirname(obj))
+                try:
+                    os.link(fname, obj)
+                except OSError:
+                    shutil.copy2(fname, obj)
+            else:
+                # identical content already cached: deduplicate
+                self._link(sha1, fname)
+            previous = index['entries'].get(key)
+            index['entries'][key] = dict(
+                hash=sha1, bytes=op.getsize(obj), atime=time.time(),
+                etag=None if remote is None else remote['etag'])
+            if previous is not None and previous['hash'] != sha1:
+                self._drop(index, previous['hash'])
+            index['counters']['misses'] += 1
+            self.misses += 1
+            self._evict(index, keep=[key])
+            self._write_index(index)
+        return True
+
+    def release(self, fname):
+        """Detach a file from the cache before it is overwritten.
+
+        The hard link to the cached content is removed, so that writing the
+        file modifies neither the cached object nor the other files sharing
+        it, and the file is removed from the index."""
+        key = self._key(fname)
+        with self._lock():
+            index = self._read_index()
+            entry = index['entries'].pop(key, None)
+            if op.exists(fname) and os.stat(fname).st_nlink > 1:
+                os.remove(fname)
+            if entry is not None:
+                self._drop(index, entry['hash'])
+                self._write_index(index)
+
+    def touch(self, fname):
+        """Mark a cached file as recently used"""
+        key = self._key(fname)
+        with self._lock():
+            index = self._read_index()
+            if key in index['entries']:
+                index['entries'][key]['atime'] = time.time()
+                index['counters']['hits'] += 1
+                self.hits += 1
+                self._write_index(index)
+
+    # Pinning -----------------------------------------------------------------
+
+    def pin(self, fname):
+        """Prevent a file from being evicted while the process uses it"""
+        key = self._key(fname)
+        with self._lock():
+            index = self._read_index()
+            pids = index['pins'].setdefault(key, list())
+            pids.append(os.getpid())
+            self._write_index(index)
+
+    def unpin(self, fname):
+        key = self._key(fname)
+        with self._lock():
+            index = self._read_index()
+            pids = index['pins'].get(key, list())
+            if os.getpid() in pids:
+                pids.remove(os.getpid())
+            if not len(pids):
+                index['pins'].pop(key, None)
+            self._write_index(index)
+
+    @contextmanager
+    def pinned(self, fname):
+        self.pin(fname)
+        try:
+            yield
+        finally:
+            self.unpin(fname)
+
+    # Eviction ----------------------------------------------------------------
+
+    def _evict(self, index, keep=()):
+        """Remove least recently used files until the cache fits max_bytes"""
+        if self.max_bytes is None:
+            return
+        # pins of processes that crashed are ignored
+        pinned = [key for key, pids in index['pins'].items()
+                  if any(_pid_alive(pid) for pid in pids)]
+        entries = index['entries']
+        sizes = dict((entry['hash'], entry['bytes'])
+                     for entry in entries.values())
+        total = sum(sizes.values())
+        for key in sorted(entries, key=lambda key: entries[key]['atime']):
+            if total <= self.max_bytes:
+                break
+            if key in pinned or key in keep:
+                continue
+            sha1 = entries.pop(key)['hash']
+            if op.exists(self._local(key)):
+                os.remove(self._local(key))
+            index['counters']['evictions'] += 1
+            # only remove the content if no other file shares it
+            if sha1 not in [entry['hash'] for entry in entries.values()]:
+                if op.exists(self._object(sha1)):
+                    os.remove(self._object(sha1))
+                total -= sizes[sha1]
+
+    @property
+    def counters(self):
+        """Hits, misses and evictions of the node"""
+        with self._lock():
+            index = self._read_index()
+        counters = dict(index['counters'])
+        counters['bytes'] = sum(dict((entry['hash'], entry['bytes'])
+                                     for entry in
+                                     index['entries'].values()).values())
+        return counters
+
+
+# Transfers ###################################################################
+
+
+class LocalBucket(object):
+    """Stand-in of an S3 bucket stored in a local directory, e.g. to test the
+    transfers without network.
+
+    Parameters
+    ----------
+    root : str
+        The directory playing the role of the bucket.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _fname(self, key):
+        return op.join(self.root, key)
+
+    def _parts(self, upload_id):
+        return op.join(self.root, '.multipart', upload_id)
+
+    def metadata(self, key):
+        fname = self._fname(key)
+        if not op.isfile(fname):
+            return dict(exist=False, bytes=0, etag=None)
+        return dict(exist=True, bytes=op.getsize(fname), etag=None)
+
+    def list(self, prefix=''):
+        """Size and checksum of all keys, in a single listing"""
+        out = dict()
+        for root, dirs, files in os.walk(self.root):
+            if root == self.root and '.multipart' in dirs:
+                dirs.remove('.multipart')
+            for filename in files:
+                if filename.endswith('.tmp'):
+                    continue
+                fname = op.join(root, filename)
+                key = op.relpath(fname, self.root)
+                if key.startswith(prefix):
+                    out[key] = dict(bytes=op.getsize(fname), etag=None)
+        return out
+
+    def read_range(self, key, start, stop):
+        with open(self._fname(key), 'rb') as f:
+            f.seek(start)
+            return f.read(stop - start)
+
+    def put(self, key, fname):
+        target = self._fname(key)
+        if not op.exists(op.dirname(target)):
+            os.makedirs(op.dirname(target))
+        shutil.copyfile(fname, target + '.tmp')
+        os.rename(target + '.tmp', target)
+
+    def start_multipart(self, key):
+        upload_id = hashlib.sha1(('%s%f' % (key, time.time())).encode()
+                                 ).hexdigest()
+        os.makedirs(self._parts(upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        fname = op.join(self._parts(upload_id), '%05i' % part_number)
+        with open(fname + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(fname + '.tmp', fname)
+
+    def list_parts(self, key, upload_id):
+        if not op.exists(self._parts(upload_id)):
+            return None  # unknown or expired upload
+        return [int(part) for part in os.listdir(self._parts(upload_id))
+                if not part.endswith('.tmp')]
+
+    def complete_multipart(self, key, upload_id):
+        target = self._fname(key)
+        if not op.exists(op.dirname(target)):
+            os.makedirs(op.dirname(target))
+        parts = sorted(self.list_parts(key, upload_id))
+        with open(target + '.tmp', 'wb') as f:
+            for part in parts:
+                with open(op.join(self._parts(upload_id),
+                                  '%05i' % part), 'rb') as f_part:
+                    shutil.copyfileobj(f_part, f)
+        os.rename(target + '.tmp', target)
+        shutil.rmtree(self._parts(upload_id))
+
+
+class S3Bucket(object):
+    """S3 bucket accessed with boto, with one connection per thread.
+
+    Parameters
+    ----------
+    bucket : str
+        The bucket name.
+    credentials : None | str | dict
+        See jr.cloud.S3_client.
+    """
+
+    def __init__(self, bucket, credentials=None):
+        import threading
+        self.bucket = bucket
+        self.credentials = credentials
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        # boto connections cannot be shared across threads
+        if not hasattr(self._local, 'client'):
+            from jr.cloud import S3_client
+            self._local.client = S3_client(self.credentials,
+                                           self.bucket).client
+        return self._local.client
+
+    def _multipart(self, key, upload_id):
+        from boto.s3.multipart import MultiPartUpload
+        mp = MultiPartUpload(self.client)
+        mp.key_name = key
+        mp.id = upload_id
+        return mp
+
+    def metadata(self, key):
+        key = self.client.get_key(key)
+        if key is None:
+            return dict(exist=False, bytes=0, etag=None)
+        return dict(exist=True, bytes=key.size, etag=key.etag.strip('"'))
+
+    def list(self, prefix=''):
+        """Size and checksum of all keys, in a single paginated listing"""
+        return dict((key.name, dict(bytes=key.size, etag=key.etag.strip('"')))
+                    for key in self.client.list(prefix=prefix))
+
+    def read_range(self, key, start, stop):
+        key = self.client.get_key(key)
+        headers = dict(Range='bytes=%i-%i' % (start, stop - 1))
+        return key.get_contents_as_string(headers=headers)
+
+    def put(self, key, fname):
+        s3_key = self.client.get_key(key)
+        if s3_key is None:
+            s3_key = self.client.new_key(key)
+        s3_key.set_contents_from_filename(fname)
+
+    def start_multipart(self, key):
+        return self.client.initiate_multipart_upload(key).id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        from io import BytesIO
+        self._multipart(key, upload_id).upload_part_from_file(
+            BytesIO(data), part_num=part_number, size=len(data))
+
+    def list_parts(self, key, upload_id):
+        from boto.exception import S3ResponseError
+        try:
+            return [part.part_number
+                    for part in self._multipart(key, upload_id)]
+        except S3ResponseError:
+            return None  # unknown or expired upload
+
+    def complete_multipart(self, key, upload_id):
+        self._multipart(key, upload_id).complete_upload()
+
+
+# temporary files of interrupted transfers
+_transfer_suffixes = ('.part', '.part.json', '.upload.json', '.tmp')
+
+
+def _read_json(fname):
+    if not op.exists(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def _write_json(obj, fname):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.rename(fname + '.tmp', fname)
+
+
+class TransferManager(object):
+    """Concurrent, multipart and resumable transfers with a bucket.
+
+    Large files are split in chunks which are transferred by a bounded pool
+    of threads. The completed chunks are recorded next to the local file, so
+    that an interrupted transfer restarts where it stopped. Uploads can be
+    queued and performed in the background while computing: the queue is
+    flushed at exit, where the failed uploads are only reported. Call
+    ``flush`` to wait for the uploads and get their errors.
+
+    It has the same interface as jr.cloud.Client (download, upload,
+    metadata), and can thus be wrapped by a CachedClient.
+
+    Parameters
+    ----------
+    bucket : S3Bucket | LocalBucket
+        The remote storage.
+    client_root : str
+        Local directory corresponding to the root of the bucket.
+    n_jobs : int
+        Number of concurrent chunk transfers.
+    chunk_size : int
+        Size of each part, in bytes. S3 requires at least 5 MB.
+    asynchronous : bool
+        Default upload mode: if True, uploads are queued and this function
+        returns immediately.
+    """
+
+    def __init__(self, bucket, client_root, n_jobs=4, chunk_size=64 * 2 ** 20,
+                 asynchronous=True):
+        self.bucket = bucket
+        self.client_root = client_root
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.asynchronous = asynchronous
+        self.errors = list()
+        # the pool and the queue are created on first use, possibly by the
+        # main thread and the upload worker at once
+        import threading
+        self._init_lock = threading.Lock()
+
+    def _strip_client_root(self, f_server):
+        """remove the client root path from the server file"""
+        if f_server.startswith(self.client_root):
+            f_server = f_server[len(self.client_root):]
+        return f_server.lstrip('/')
+
+    def _map(self, func, iterable):
+        """Run func in the thread pool, which is only created when needed"""
+        with self._init_lock:
+            if not hasattr(self, '_pool'):
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(processes=self.n_jobs)
+        return self._pool.map(func, iterable)
+
+    def _chunks(self, size):
+        starts = range(0, size, self.chunk_size)
+        return [(start, min(start + self.chunk_size, size))
+                for start in starts]
+
+    def metadata(self, f_server):
+        return self.bucket.metadata(self._strip_client_root(f_server))
+
+    def list(self, prefix=''):
+        return self.bucket.list(prefix=prefix)
+
+    # Download ----------------------------------------------------------------
+
+    def download(self, f_server, f_client=None, overwrite='auto'):
+        """Download a file by concurrent chunks.
+
+        Returns True if the file was downloaded."""
+        key = self._strip_client_root(f_server)
+        if f_client is None:
+            f_client = op.join(self.client_root, key)
+        overwrite = 'auto' if overwrite is None else overwrite
+        metadata = self.bucket.metadata(key)
+        if not metadata['exist']:
+            raise IOError('%s does not exist online' % key)
+        if op.exists(f_client):
+            if overwrite is False:
+                return False
+            elif (overwrite == 'auto' and
+                    metadata['bytes'] == op.getsize(f_client)):
+                return False
+        if not op.exists(op.dirname(f_client)):
+            os.makedirs(op.dirname(f_client))
+
+        # Resume a previously interrupted download of the same file
+        f_part, f_state = f_client + '.part', f_client + '.part.json'
+        size = metadata['bytes']
+        state = _read_json(f_state)
+        if (state is None or state['bytes'] != size or
+                not op.exists(f_part)):
+            state = dict(bytes=size, done=list())
+            with open(f_part, 'wb') as f:
+                f.truncate(size)
+            _write_json(state, f_state)
+        todo = [chunk for chunk in self._chunks(size)
+                if chunk[0] not in state['done']]
+
+        import threading
+        lock = threading.Lock()
+
+        def _download_chunk(chunk):
+            start, stop = chunk
+            data = self.bucket.read_range(key, start, stop)
+            with open(f_part, 'r+b') as f:
+                f.seek(start)
+                f.write(data)
+            with lock:
+                state['done'].append(start)
+                _write_json(state, f_state)
+
+        self._map(_download_chunk, todo)
+        os.rename(f_part, f_client)
+        os.remove(f_state)
+        print('Downloaded: %s > %s' % (key, f_client))
+        return True
+
+    # Upload ------------------------------------------------------------------
+
+    def upload(self, f_client, f_server=None, overwrite=True, wait=None):
+        """Upload a file or a directory.
+
+        If wait is False (default: not self.asynchronous), the upload is
+        queued and performed in the background."""
+        wait = not self.asynchronous if wait is None else wait
+        f_server = f_client if f_server is None else f_server
+        if not wait:
+            self._enqueue(f_client, f_server, overwrite)
+            return
+        if op.isdir(f_client):
+            out = list()
+            for root, dirs, files in os.walk(f_client):
+                for filename in files:
+                    if filename.endswith(_transfer_suffixes):
+                        continue
+                    local_path = op.join(root, filename)
+                    out.append(self._upload_file(
+                        local_path, f_server + local_path[len(f_client):],
+                        overwrite))
+            return sum(out)
+        elif op.isfile(f_client):
+            return self._upload_file(f_client, f_server, overwrite)
+        raise ValueError('File not found %s' % f_client)
+
+    def _upload_file(self, f_client, f_server, overwrite):
+        key = self._strip_client_root(f_server)
+        size = op.getsize(f_client)
+        if overwrite is not True:
+            metadata = self.bucket.metadata(key)
+            if metadata['exist'] and (overwrite is False or
+                                      metadata['bytes'] == size):
+                return False
+        if size <= self.chunk_size:
+            self.bucket.put(key, f_client)
+            print('Uploaded: %s > %s' % (f_client, key))
+            return True
+
+        # Resume a multipart upload if the local file has not changed since
+        f_state = f_client + '.upload.json'
+        mtime = op.getmtime(f_client)
+        state = _read_json(f_state)
+        done = None
+        if (state is not None and state['bytes'] == size and
+                state['mtime'] == mtime and state['key'] == key):
+            done = self.bucket.list_parts(key, state['upload_id'])
+        if done is None:
+            state = dict(key=key, bytes=size, mtime=mtime,
+                         upload_id=self.bucket.start_multipart(key))
+            _write_json(state, f_state)
+            done = list()
+        parts = [(ii + 1, chunk) for ii, chunk in
+                 enumerate(self._chunks(size)) if ii + 1 not in done]
+
+        def _upload_chunk(part):
+            part_number, (start, stop) = part
+            with open(f_client, 'rb') as f:
+                f.seek(start)
+                data = f.read(stop - start)
+            self.bucket.upload_part(key, state['upload_id'], part_number,
+                                    data)
+
+        self._map(_upload_chunk, parts)
+        self.bucket.complete_multipart(key, state['upload_id'])
+        os.remove(f_state)
+        print('Uploaded: %s > %s' % (f_client, key))
+        return True
+
+    def _enqueue(self, f_client, f_server, overwrite):
+        """Queue an upload, performed by a background thread"""
+        with self._init_lock:
+            if not hasattr(self, '_queue'):
+                import atexit
+                import threading
+                try:
+                    from Queue import Queue
+                except ImportError:  # Python 3
+                    from queue import Queue
+                self._queue = Queue()
+                worker = threading.Thread(target=self._worker)
+                worker.daemon = True
+                worker.start()
+                atexit.register(self._flush_at_exit)
+        self._queue.put((f_client, f_server, overwrite))
+
+    def _worker(self):
+        while True:
+            f_client, f_server, overwrite = self._queue.get()
+            try:
+                self.upload(f_client, f_server, overwrite, wait=True)
+            except Exception as e:
+                self.errors.append((f_client, e))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait for the queued uploads to be completed.
+
+        Raises a RuntimeError listing the uploads that failed."""
+        if hasattr(self, '_queue'):
+            self._queue.join()
+        if len(self.errors):
+            errors, self.errors = self.errors, list()
+            raise RuntimeError('Failed uploads: %s' % errors)
+
+    def _flush_at_exit(self):
+        """Complete the queued uploads at exit, and only report the failures:
+        raising here would come after, and hide, the script's own error."""
+        import sys
+        try:
+            self.flush()
+        except RuntimeError as e:
+            sys.stderr.write('%s\n' % e)
+
+
+# Manifest ####################################################################
+
+
+class Manifest(object):
+    """Index of the artifacts available locally and on the bucket.
+
+    Each file is indexed by its path relative to the client root, i.e. by its
+    ``config.paths`` template, with its local and remote presence, its size,
+    its modification time, its remote etag and the version of the code that
+    produced it. The remote presence is refreshed with a single listing of
+    the bucket, so that checking whether an artifact exists does not require
+    a request per file. The checksum of a local file is only computed on
+    demand (see checksum).
+
+    Parameters
+    ----------
+    client : TransferManager | CachedClient
+        The client of the bucket.
+    fname : str
+        The json file storing the manifest, shared by the processes of the
+        node.
+    max_age : float
+        Time, in seconds, after which the remote listing is refreshed.
+    """
+
+    def __init__(self, client, fname, max_age=600.):
+        self.client = client
+        self.fname = fname
+        self.max_age = max_age
+        self._manifest = None
+        self._mtime = None
+
+    def _lock(self):
+        return _flock(self.fname + '.lock')
+
+    def _read(self):
+        """Read the manifest from disk if another process changed it"""
+        if not op.exists(self.fname):
+            self._manifest = dict(refreshed=0., entries=dict())
+        elif self._mtime != op.getmtime(self.fname):
+            with open(self.fname, 'r') as f:
+                self._manifest = json.load(f)
+            self._mtime = op.getmtime(self.fname)
+        return self._manifest
+
+    def _write(self, manifest):
+        _write_json(manifest, self.fname)
+        self._manifest = manifest
+        self._mtime = op.getmtime(self.fname)
+
+    def _key(self, fname):
+        return self.client._strip_client_root(fname)
+
+    def refresh(self):
+        """List the bucket and the local files at once"""
+        remote = self.client.list()
+        local = dict()
+        root = self.client.client_root
+        for this_root, dirs, files in os.walk(root):
+            # skip the cache and other hidden folders
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for filename in files:
+                if filename.endswith(_transfer_suffixes):
+                    continue
+                fname = op.join(this_root, filename)
+                local[op.relpath(fname, root)] = os.stat(fname)
+        with self._lock():
+            manifest = self._read()
+            entries = dict()
+            for key in set(remote.keys()) | set(local.keys()):
+                entry = manifest['entries'].get(key, dict())
+                stat = local.get(key)
+                if stat is not None and (
+                        entry.get('bytes') != stat.st_size or
+                        entry.get('mtime') != stat.st_mtime):
+                    # modified outside of save(): unknown checksum and version
+                    entry = dict(bytes=stat.st_size, mtime=stat.st_mtime)
+                entry['local'] = stat is not None
+                entry['remote'] = key in remote
+                if key in remote:
+                    entry['remote_bytes'] = remote[key]['bytes']
+                    entry['etag'] = remote[key]['etag']
+                    entry.setdefault('bytes', remote[key]['bytes'])
+                entries[key] = entry
+            manifest = dict(refreshed=time.time(), entries=entries)
+            self._write(manifest)
+        return manifest
+
+    def get(self, fname):
+        """The manifest entry of a file, or None if unknown"""
+        manifest = self._read()
+        if time.time() - manifest['refreshed'] > self.max_age:
+            manifest = self.refresh()
+        return manifest['entries'].get(self._key(fname))
+
+    def exists(self, fname, where='any', strict=False):
+        """Check whether a file exists locally, remotely, or either.
+
+        The listing, at most max_age old, is authoritative. If strict, a
+        file missing from it is checked with a request, e.g. in case it was
+        uploaded by another node since."""
+        if where not in ('any', 'local', 'remote'):
+            raise ValueError("where must be 'any', 'local' or 'remote'")
+        # local presence only costs a stat
+        if where in ('any', 'local') and op.isfile(fname):
+            return True
+        if where == 'local':
+            return False
+        entry = self.get(fname)
+        if entry is not None and entry['remote']:
+            return True
+        if not strict:
+            return False
+        metadata = self.client.metadata(fname)
+        if not metadata['exist']:
+            return False
+        with self._lock():
+            manifest = self._read()
+            entry = manifest['entries'].setdefault(self._key(fname), dict(
+                local=False, bytes=metadata['bytes']))
+            entry['remote'] = True
+            entry['remote_bytes'] = metadata['bytes']
+            entry['etag'] = metadata.get('etag')
+            self._write(manifest)
+        return True
+
+    def record(self, fname, version=None, remote=False):
+        """Index a file which has just been produced.
+
+        remote indicates that the file has been uploaded (or queued for
+        upload); this is checked at the next refresh."""
+        stat = os.stat(fname)
+        entry = dict(local=True, bytes=stat.st_size, mtime=stat.st_mtime,
+                     version=version)
+        with self._lock():
+            manifest = self._read()
+            previous = manifest['entries'].get(self._key(fname), dict())
+            entry['remote'] = remote or previous.get('remote', False)
+            manifest['entries'][self._key(fname)] = entry
+            self._write(manifest)
+        return entry
+
+    def checksum(self, fname):
+        """The sha1 of a local file. It is computed on demand, as the files
+        can be large, and kept in the manifest until the file changes."""
+        stat = os.stat(fname)
+        key = self._key(fname)
+        entry = self._read()['entries'].get(key, dict())
+        if (entry.get('checksum') is not None and
+                (entry.get('bytes'), entry.get('mtime')) ==
+                (stat.st_size, stat.st_mtime)):
+            return entry['checksum']
+        checksum = file_hash(fname)
+        with self._lock():
+            manifest = self._read()
+            entry = manifest['entries'].setdefault(key, dict(
+                local=True, remote=False))
+            entry.update(bytes=stat.st_size, mtime=stat.st_mtime,
+                         checksum=checksum)
+            self._write(manifest)
+        return checksum
@@ -0,0 +1,66 @@
+# Author: Jean-Remi King <jeanremi.king@gmail.com>
+#
+# Licence: BSD 3-clause
+
+"""Check that config and conditions can be imported quickly, and without
+their heavy dependencies, which are only imported on first use.
+
+Usage: python -m pytest scripts/test_import_time.py
+"""
+import os.path as op
+import subprocess
+import sys
+
+# Maximum import time of config and conditions, numpy excluded, in seconds.
+# About 20 ms were measured, with numpy already imported: the margin absorbs
+# slow file systems, but not a heavy import (e.g. mne alone takes ~1 s).
+budget = .25
+# Modules that must only be imported when needed
+heavy_modules = ['mne', 'matplotlib', 'sklearn', 'scipy', 'pandas', 'jr',
+                 'boto']
+
+
+def _import_times(statement):
+    """Run statement in a new interpreter with -X importtime, and return the
+    cumulative import time, in seconds, of each top-level module"""
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=op.dirname(op.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    assert process.returncode == 0, err.decode()
+    times = dict()
+    for line in err.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented
+        if not name[1:].startswith(' '):
+            times[name.strip()] = float(cumulative) / 1e6
+    return times
+
+
+def test_import_time():
+    """Importing config and conditions stays within the budget"""
+    if sys.version_info < (3, 7):
+        import pytest
+        pytest.skip('-X importtime requires Python 3.7')
+    # numpy is needed anyway: import it first to exclude it from the budget
+    statement = 'import numpy; import config, conditions'
+    # the fastest of a few runs, to be robust to a busy machine
+    elapsed = min(sum(_import_times(statement).get(module, 0.)
+                      for module in ['config', 'conditions'])
+                  for _ in range(3))
+    assert elapsed < budget, 'import took %.3f s > %.3f s' % (elapsed,
+                                                              budget)
+
+
+def test_no_heavy_import():
+    """Heavy dependencies are not imported by config and conditions"""
+    statement = ('import sys; import config, conditions; '
+                 'print(" ".join(sys.modules))')
+    out = subprocess.check_output([sys.executable, '-c', statement],
+                                  cwd=op.dirname(op.abspath(__file__)))
+    modules = set(module.split('.')[0] for module in out.decode().split())
+    imported = [module for module in heavy_modules if module in modules]
+    assert not len(imported), 'imported on startup: %s' % imported
@@ -0,0 +1,86 @@
+# Author: Jean-Remi King <jeanremi.king@gmail.com>
+#
+# Licence: BSD 3-clause
+
+"""Check the signatures and the outdated tasks of the pipeline on dummy
+tasks, whose files are only recorded in memory.
+
+Usage: python -m pytest scripts/test_pipeline.py
+"""
+import shutil
+import tempfile
+from pipeline import Pipeline, Task
+
+# the files produced by the dummy tasks
+files = set()
+
+
+def _produce(*outputs):
+    for output in outputs:
+        files.add(output)
+
+
+class _Pipeline(Pipeline):
+    """Pipeline whose files exist when produced by the dummy tasks"""
+
+    def _exists(self, typ, kwargs):
+        return typ in files
+
+
+def _chain(params=None):
+    """a > b > c, and d independent; c optionally produces 'c_opt'"""
+    pipeline = _Pipeline(stamp_dir=tempfile.mkdtemp())
+    pipeline.add(Task('a', _produce, args=('a',), outputs=[('a', dict())]))
+    pipeline.add(Task('b', _produce, args=('b',), params=params,
+                      inputs=[('a', dict())], outputs=[('b', dict())]))
+    pipeline.add(Task('c', _produce, args=('c',), inputs=[('b', dict())],
+                      outputs=[('c', dict())], optional=[('c_opt', dict())]))
+    pipeline.add(Task('d', _produce, args=('d',), outputs=[('d', dict())]))
+    return pipeline
+
+
+def test_pipeline():
+    """Tasks are recomputed when outdated, with the tasks depending on them"""
+    files.clear()
+    pipeline = _chain()
+    try:
+        assert [[task.name for task in wave]
+                for wave in pipeline._waves()] == [['a', 'd'], ['b'], ['c']]
+        assert pipeline.run() == ['a', 'd', 'b', 'c']
+        # up to date, although the optional output is missing
+        assert pipeline.outdated() == list()
+        assert pipeline.run() == list()
+
+        # a missing output recomputes the task and its dependents
+        files.remove('a')
+        assert pipeline.outdated() == ['a', 'b', 'c']
+        assert pipeline.run() == ['a', 'b', 'c']
+        files.remove('b')
+        assert pipeline.outdated() == ['b', 'c']
+        pipeline.run()
+
+        # changing the parameters of a task changes the signatures of its
+        # dependents
+        other = _chain(params=dict(alpha=1.))
+        other.stamp_dir, stamp_dir = pipeline.stamp_dir, other.stamp_dir
+        shutil.rmtree(stamp_dir)
+        signatures, other_signatures = (pipeline.signatures(),
+                                        other.signatures())
+        assert [name for name in 'abcd' if signatures[name] !=
+                other_signatures[name]] == ['b', 'c']
+        assert other.outdated() == ['b', 'c']
+        assert other.run(dry_run=True) == ['b', 'c']
+    finally:
+        shutil.rmtree(pipeline.stamp_dir)
+
+
+def test_duplicate_outputs():
+    """A file cannot be produced by two tasks"""
+    pipeline = _chain()
+    shutil.rmtree(pipeline.stamp_dir)
+    try:
+        pipeline.add(Task('e', _produce, outputs=[('c_opt', dict())]))
+    except ValueError as e:
+        assert 'produced by both' in str(e)
+    else:
+        raise AssertionError('duplicate outputs should raise')
@@ -0,0 +1,144 @@
+# Author: Jean-Remi King <jeanremi.king@gmail.com>
+#
+# Licence: BSD 3-clause
+
+"""Check the chunked, resumable and background transfers against a local
+stand-in of the bucket.
+
+Usage: python -m pytest scripts/test_storage.py
+"""
+import os
+import os.path as op
+import shutil
+import tempfile
+from storage import LocalBucket, TransferManager
+
+chunk_size = 1000
+
+
+class _FlakyBucket(LocalBucket):
+    """Local bucket which fails on the chunks listed in fail, and records
+    the chunks that are transferred"""
+
+    def __init__(self, root):
+        LocalBucket.__init__(self, root)
+        self.fail = list()
+        self.reads, self.parts = list(), list()
+
+    def read_range(self, key, start, stop):
+        if start in self.fail:
+            raise IOError('interrupted')
+        self.reads.append(start)
+        return LocalBucket.read_range(self, key, start, stop)
+
+    def upload_part(self, key, upload_id, part_number, data):
+        if part_number in self.fail:
+            raise IOError('interrupted')
+        self.parts.append(part_number)
+        LocalBucket.upload_part(self, key, upload_id, part_number, data)
+
+
+def _setup():
+    root = tempfile.mkdtemp()
+    bucket = _FlakyBucket(op.join(root, 'bucket'))
+    client_root = op.join(root, 'client') + '/'
+    os.makedirs(op.join(bucket.root, 'sub'))
+    os.makedirs(op.join(client_root, 'sub'))
+    client = TransferManager(bucket, client_root, n_jobs=3,
+                             chunk_size=chunk_size, asynchronous=False)
+    return root, bucket, client
+
+
+def _write(fname, size, seed=0):
+    data = bytes(bytearray((seed + ii * 7) % 256 for ii in range(size)))
+    with open(fname, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def _read(fname):
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+def test_download():
+    """Chunked download, resumed after an interruption"""
+    root, bucket, client = _setup()
+    try:
+        data = _write(op.join(bucket.root, 'sub', 'a.bin'), 10500)
+        fname = op.join(client.client_root, 'sub', 'a.bin')
+        bucket.fail = [3000, 7000]
+        try:
+            client.download(fname)
+        except IOError:
+            pass
+        else:
+            raise AssertionError('the download should have been interrupted')
+        assert not op.exists(fname)
+        assert op.exists(fname + '.part.json')
+        # only the missing chunks are downloaded
+        done, bucket.reads, bucket.fail = list(bucket.reads), list(), list()
+        assert client.download(fname)
+        assert sorted(done + bucket.reads) == list(range(0, 10500, 1000))
+        assert set(bucket.reads) >= set([3000, 7000])
+        assert _read(fname) == data
+        assert not op.exists(fname + '.part.json')
+        # same size: not downloaded again
+        assert not client.download(fname)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_upload():
+    """Multipart upload, resumed after an interruption, and small files"""
+    root, bucket, client = _setup()
+    try:
+        fname = op.join(client.client_root, 'sub', 'b.bin')
+        data = _write(fname, 4200, seed=3)
+        bucket.fail = [2]
+        try:
+            client.upload(fname)
+        except IOError:
+            pass
+        else:
+            raise AssertionError('the upload should have been interrupted')
+        assert not op.exists(op.join(bucket.root, 'sub', 'b.bin'))
+        done, bucket.parts, bucket.fail = list(bucket.parts), list(), list()
+        assert client.upload(fname)
+        assert sorted(done + bucket.parts) == [1, 2, 3, 4, 5]
+        assert 2 in bucket.parts
+        assert _read(op.join(bucket.root, 'sub', 'b.bin')) == data
+        # small files are uploaded at once
+        small = op.join(client.client_root, 'sub', 'c.bin')
+        data = _write(small, 10)
+        assert client.upload(small)
+        assert _read(op.join(bucket.root, 'sub', 'c.bin')) == data
+        assert not client.upload(small, overwrite='auto')
+    finally:
+        shutil.rmtree(root)
+
+
+def test_flush():
+    """Background uploads, whose errors are raised by flush"""
+    root, bucket, client = _setup()
+    try:
+        fnames = [op.join(client.client_root, 'sub', '%i.bin' % ii)
+                  for ii in range(3)]
+        for ii, fname in enumerate(fnames):
+            _write(fname, 2500 * ii + 1, seed=ii)
+            client.upload(fname, wait=False)
+        client.flush()
+        for fname in fnames:
+            assert _read(fname) == _read(op.join(bucket.root, 'sub',
+                                                 op.basename(fname)))
+        client.upload(op.join(client.client_root, 'missing.bin'), wait=False)
+        try:
+            client.flush()
+        except RuntimeError as e:
+            assert 'missing.bin' in str(e)
+        else:
+            raise AssertionError('flush should raise the failed uploads')
+        # the errors are only raised once
+        client.flush()
+    finally:
+        shutil.rmtree(root)